@@ -0,0 +1,115 @@
+# Copyright (c) 2023 J.Jarrard / JJFX
+# The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
+
+'''
+KLIPPER SETTINGS BACKUP
+-----------------------
+Setting backups and tuning tower presets of each machine in a local JSON file.
+The file is read once at startup; Changes are buffered in memory and written together,
+so saving many settings, presets or machines never writes Cura preferences.
+'''
+
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from typing import Any, Callable, Dict, IO, Optional
+
+from .KlipperGcode import Logger
+
+
+def writeFileAtomic(file_path: str, write_data: Callable[[IO[Any]], Any], description: str, binary: bool=False) -> bool:
+    """Writes a file through a temporary file in the same directory, replacing it only when complete.
+
+    Returns true if the file was written; Errors are logged and the previous file is kept.
+     * file_path: String of the file to replace.
+     * write_data: Function called with the open temporary file.
+     * description: String naming the file in logged errors.
+     + binary: Opens the temporary file in binary mode if true.
+    """
+    temp_path = None # type: Optional[str]
+    try:
+        os.makedirs(os.path.dirname(file_path), exist_ok = True)
+        temp_fd, temp_path = tempfile.mkstemp(prefix = ".klipper_settings.", dir = os.path.dirname(file_path))
+        with (os.fdopen(temp_fd, "wb") if binary else os.fdopen(temp_fd, "w", encoding = "utf-8")) as f:
+            write_data(f)
+        os.replace(temp_path, file_path)
+    except OSError as e:
+        Logger.log('w', "Could not write klipper settings %s %s: %s", description, file_path, e)
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+    return True
+
+
+class SettingBackupStore:
+    """Typed setting values in named sections for each machine.
+
+    Sections are 'user' for settings overridden by presets and 'preset<int>' for custom presets.
+     * file_path: String of the JSON backup file.
+     + schedule_flush: Function called when unsaved changes are first made to schedule flush.
+    """
+    _format = 1 # Increase when the file layout changes
+
+    def __init__(self, file_path: str, schedule_flush: Optional[Callable[[], Any]]=None) -> None:
+        self._file_path = file_path
+        self._schedule_flush = schedule_flush
+        self._machines = OrderedDict() # type: Dict[str, Dict[str, Dict[str, Any]]]
+        self._dirty = False
+
+    def load(self) -> None:
+        """Reads every machine backup from the file.
+
+        """
+        try:
+            with open(self._file_path, encoding = "utf-8") as f:
+                backup = json.load(f, object_pairs_hook = OrderedDict)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            Logger.log('w', "Could not read klipper settings backup %s: %s", self._file_path, e)
+            return
+
+        if backup.get("format") != self._format:
+            Logger.log('w', "Unknown klipper settings backup format: %s", backup.get("format"))
+            return
+        self._machines = backup.get("machines", OrderedDict())
+
+    def getBackup(self, machine_id: str, section: str) -> Dict[str, Any]:
+        """Returns copy of setting values in a section of a machine backup.
+
+        """
+        return OrderedDict(self._machines.get(machine_id, {}).get(section, {}))
+
+    def setValue(self, machine_id: str, section: str, key: str, value: Any) -> None:
+        settings = self._machines.setdefault(machine_id, OrderedDict()).setdefault(section, OrderedDict())
+        if key not in settings or settings[key] != value:
+            settings[key] = value
+            self._changed()
+
+    def removeValue(self, machine_id: str, section: str, key: str) -> None:
+        settings = self._machines.get(machine_id, {}).get(section, {})
+        if key in settings:
+            del settings[key]
+            self._changed()
+
+    def _changed(self) -> None:
+        if not self._dirty and self._schedule_flush:
+            self._schedule_flush()
+        self._dirty = True
+
+    def flush(self) -> bool:
+        """Writes unsaved changes to the file, replacing it only when complete.
+
+        Returns true if the file was written.
+        """
+        if not self._dirty:
+            return False
+
+        backup = {"format": self._format, "machines": self._machines}
+        if not writeFileAtomic(self._file_path, lambda f: json.dump(backup, f, indent = 1), "backup"):
+            return False
+
+        self._dirty = False
+        return True
@@ -0,0 +1,588 @@
+# Copyright (c) 2023 J.Jarrard / JJFX
+# The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
+
+'''
+KLIPPER GCODE BENCHMARKS
+------------------------
+Measures time and peak memory of gcode post-processing for each Klipper feature
+using synthetic gcode and stand-in Cura stacks, without launching Cura.
+    python -m KlipperSettingsPlugin.KlipperBenchmark --layers 200 --lines 2000 --extruders 2
+Parallel layer processing can be compared with the serial baseline for each worker count:
+    python -m KlipperSettingsPlugin.KlipperBenchmark --worker-sweep 1,2,4,8,16 --layers 500 --eager
+Layer 0 z offset matching can be compared with the previous per-line regex:
+    python -m KlipperSettingsPlugin.KlipperBenchmark --z-offset 20000
+Processing time can be scaled over the number of gcode lines to show it grows linearly:
+    python -m KlipperSettingsPlugin.KlipperBenchmark --scaling 10000,100000,1000000,10000000
+Setting change signals can be replayed through the plugin handlers with the Python of a Cura install:
+    python -m KlipperSettingsPlugin.KlipperBenchmark --signals 50000
+Per-object pressure advance can be scaled over the number of objects on the plate:
+    python -m KlipperSettingsPlugin.KlipperBenchmark --objects 1,10,100,1000,2000 --layers 20
+'''
+
+import argparse
+import bisect
+import gc
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from .KlipperHeadless import HeadlessSettings, loadSettingDefinitions, comment
+from .KlipperGcode import GcodeState, ZOffsetStage
+from .KlipperDefinitions import flattenDefinitions, parseDefinitions
+
+# Relative frequency of gcode features printed for each mesh
+default_feature_mix = OrderedDict([
+    ("WALL-OUTER", 2),
+    ("WALL-INNER", 2),
+    ("SKIN", 1),
+    ("FILL", 3),
+    ("SUPPORT", 1),
+    ("SUPPORT-INTERFACE", 0.5)
+]) # type: Dict[str, float]
+
+
+def generateGcode(layers: int=100, lines_per_layer: int=1000, meshes: int=2, extruders: int=1,
+                  feature_mix: Optional[Dict[str, float]]=None, seed: int=0,
+                  layer_height: float=0.2, layer_0_height: float=0.3) -> List[str]:
+    """Returns synthetic sliced gcode in the layout of a Cura gcode list.
+
+    [0] header, [1] start gcode, then one chunk for each layer and the end gcode.
+    Layers print every mesh with a random selection of features; Multiple extruders
+    alternate between meshes and add a prime tower. Layer 0 starts with a skirt.
+     * layers: Integer for number of layers.
+     * lines_per_layer: Integer for approximate number of move lines in each layer.
+     * meshes: Integer for number of mesh objects.
+     * extruders: Integer for number of extruders.
+     + feature_mix: Dict of gcode feature types and their relative frequency.
+     + seed: Integer for the random number generator.
+    """
+    rand = random.Random(seed)
+    feature_mix = feature_mix or default_feature_mix
+    features = list(feature_mix)
+    cumulative_weights = list(itertools.accumulate(feature_mix.values()))
+    mesh_names = ["mesh_%d.stl" % mesh_nr for mesh_nr in range(meshes)]
+    features_per_mesh = 3
+    lines_per_feature = max(lines_per_layer // max(meshes * features_per_mesh, 1), 1)
+
+    gcode_list = [
+        ";FLAVOR:Klipper\n;TIME:%d\n;Filament used: 1.0m\n;Layer height: %g\n"
+        ";Generated with Cura_SteamEngine 5.4.0\n" % (layers * 10, layer_height),
+        "T0\nM190 S60\nM109 S210\nG28\nG92 E0\n;LAYER_COUNT:%d\n" % layers
+    ]
+
+    extruder_nr = 0
+    z = layer_0_height
+    for layer_nr in range(layers):
+        lines = [";LAYER:%d" % layer_nr, "M117 Layer %d" % layer_nr, "G0 F9000 X50 Y50 Z%g" % z]
+
+        ## Non-mesh features
+        lines.append(";MESH:NONMESH")
+        if layer_nr == 0:
+            lines.append(";TYPE:SKIRT")
+            lines.extend(_moves(rand, lines_per_feature, z))
+        if extruders > 1:
+            lines.append(";TYPE:PRIME-TOWER")
+            lines.extend(_moves(rand, lines_per_feature // 4 + 1, z))
+
+        ## Mesh features
+        for mesh_nr, mesh_name in enumerate(mesh_names):
+            mesh_extruder_nr = mesh_nr % extruders
+            if mesh_extruder_nr != extruder_nr:
+                extruder_nr = mesh_extruder_nr
+                lines.append("T%d" % extruder_nr)
+
+            lines.append(";MESH:%s" % mesh_name)
+            for _ in range(features_per_mesh): # Weighted random features
+                feature = features[bisect.bisect(cumulative_weights, rand.random() * cumulative_weights[-1])]
+                lines.append(";TYPE:%s" % feature)
+                lines.extend(_moves(rand, lines_per_feature, z))
+
+        lines.append(";MESH:NONMESH")
+        lines.append("G0 F9000 Z%g" % round(z + layer_height, 3))
+        gcode_list.append("\n".join(lines) + "\n")
+        z = round(z + layer_height, 3)
+
+    gcode_list.append(";End of Gcode\nM104 S0\nM140 S0\nM84\n")
+
+    return gcode_list
+
+
+def _moves(rand: random.Random, count: int, z: float) -> List[str]:
+    """Returns extrusion moves with occasional retractions and travel moves.
+
+    """
+    moves = []
+    for _ in range(count):
+        if rand.random() < 0.05:
+            moves.append("G1 F2700 E-0.8")
+            moves.append("G0 F9000 X%.3f Y%.3f Z%g" % (rand.uniform(0, 200), rand.uniform(0, 200), z))
+            moves.append("G1 F2700 E0.8")
+        else:
+            moves.append("G1 X%.3f Y%.3f E%.5f" % (rand.uniform(0, 200), rand.uniform(0, 200), rand.uniform(0, 0.1)))
+    return moves
+
+
+def benchmarkSettings(extruders: int=1, meshes: int=2) -> Dict[str, Dict[str, Any]]:
+    """Returns settings that enable each Klipper feature for benchmarks.
+
+    'baseline' has no features enabled and 'all' combines every feature.
+    """
+    extruder_values = {str(extruder_nr): {"klipper_pressure_advance_factor": 0.04 + 0.01 * extruder_nr,
+                                          "klipper_retract_length": 0.5 + 0.1 * extruder_nr}
+                       for extruder_nr in range(extruders)}
+
+    features = OrderedDict([
+        ("baseline", {}),
+        ("pressure_advance", {
+            "klipper_pressure_advance_enable": True,
+            "klipper_pressure_advance_wall_0": 0.03,
+            "klipper_pressure_advance_infill": 0.06,
+            "klipper_pressure_advance_support": 0.05,
+            "meshes": {"mesh_%d.stl" % (meshes - 1): {"extruder_nr": (meshes - 1) % extruders,
+                                                    "klipper_pressure_advance_topbottom": 0.02}}
+        }),
+        ("smooth_time", {"klipper_smooth_time_enable": True}),
+        ("firmware_retraction", {"machine_firmware_retract": True}),
+        ("z_offset", {
+            "klipper_z_offset_control_enable": True,
+            "klipper_z_offset_layer_0": -0.05,
+            "layer_height_0": 0.3
+        }),
+        ("velocity_limits", {"klipper_velocity_limits_enable": True, "klipper_accel_limit": 3000}),
+        ("input_shaper", {"klipper_input_shaper_enable": True, "klipper_shaper_freq_x": 50, "klipper_shaper_type": "mzv"}),
+        ("tuning_tower", {
+            "klipper_tuning_tower_enable": True,
+            "klipper_tuning_tower_command": "SET_PRESSURE_ADVANCE",
+            "klipper_tuning_tower_parameter": "ADVANCE",
+            "klipper_tuning_tower_factor": 0.005
+        })
+    ]) # type: Dict[str, Dict[str, Any]]
+
+    all_features = {}
+    for name, values in features.items():
+        all_features.update(values)
+        values["extruders"] = extruder_values
+    all_features["extruders"] = extruder_values
+    features["all"] = all_features
+
+    return features
+
+
+def runBenchmark(gcode_list: List[str], settings: HeadlessSettings, repeat: int=3, lazy: bool=True,
+                 workers: int=1) -> Dict[str, Any]:
+    """Returns time and peak memory of processing gcode and writing the result.
+
+    Time is the best of each repeat; Peak memory is measured in a separate run with tracemalloc.
+     * gcode_list: List of gcode strings to process; Copied for each run.
+     * settings: HeadlessSettings to apply.
+    """
+    gcode_size = sum(len(chunk) for chunk in gcode_list)
+    best_time = best_write_time = None # type: Optional[float]
+    stage_timings = {} # type: Dict[str, float]
+
+    for run_nr in range(repeat):
+        gcode_dict = {0: list(gcode_list)}
+        timings = {} # type: Dict[str, float]
+        gc.collect()
+
+        start_time = time.perf_counter()
+        settings.createProcessor().processGcodeDict(gcode_dict, lazy, timings if workers <= 1 else None, workers)
+        process_time = time.perf_counter() - start_time
+        output_size = sum(len(chunk) for chunk in gcode_dict[0]) # Writers read every chunk
+        write_time = time.perf_counter() - start_time - process_time
+
+        if best_time is None or process_time + write_time < best_time + best_write_time:
+            best_time, best_write_time, stage_timings = process_time, write_time, timings
+
+    ## Peak memory
+    gcode_dict = {0: list(gcode_list)}
+    gc.collect()
+    tracemalloc.start()
+    settings.createProcessor().processGcodeDict(gcode_dict, lazy, None, workers)
+    for chunk in gcode_dict[0]:
+        pass
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return OrderedDict([
+        ("process_seconds", best_time),
+        ("write_seconds", best_write_time),
+        ("mb_per_second", gcode_size / 1e6 / max(best_time + best_write_time, 1e-9)),
+        ("peak_memory_mb", peak_memory / 1e6),
+        ("added_bytes", output_size - gcode_size),
+        ("stage_seconds", OrderedDict(sorted(stage_timings.items())))
+    ])
+
+
+def benchmarkZOffset(lines: int=20000, layer_0_height: float=0.3, repeat: int=5) -> Dict[str, Any]:
+    """Returns time of matching layer 0 z moves with the previous regex and with ZOffsetStage.
+
+    Both read the same layer string; The regex was matched on every line after splitting the layer,
+    while the stage only reads lines containing a Z.
+     * lines: Integer for approximate number of lines in layer 0.
+    """
+    layer = generateGcode(1, lines, layer_0_height = layer_0_height)[2]
+    line_count = layer.count("\n") + 1
+    z_offset_regex = re.compile(r"^G[01]\s.*Z(%g)(?!.*%s)" % (layer_0_height, re.escape(comment)))
+    stage = ZOffsetStage(comment, -0.05, layer_0_height)
+
+    def regexMatches() -> int:
+        return sum(1 for line in layer.split("\n") if z_offset_regex.fullmatch(line))
+
+    def stageMatches() -> int:
+        return len(stage.onLines(layer, 0, len(layer), GcodeState(0)))
+
+    results = OrderedDict() # type: Dict[str, Any]
+    for name, matcher in [("regex", regexMatches), ("tokenizer", stageMatches)]:
+        best_time = None # type: Optional[float]
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            matches = matcher()
+            run_time = time.perf_counter() - start_time
+            best_time = run_time if best_time is None else min(best_time, run_time)
+        results[name] = OrderedDict([("seconds", best_time), ("matches", matches),
+                                     ("us_per_line", best_time * 1e6 / max(line_count, 1))])
+
+    return results
+
+
+def benchmarkWorkers(gcode_list: List[str], settings: HeadlessSettings, worker_counts: List[int],
+                     repeat: int=3, lazy: bool=True) -> Dict[str, Any]:
+    """Returns time of processing gcode with each number of worker processes.
+
+    A single worker is the serial baseline; Speedup of every count is relative to it.
+    The sequential prepass is also timed, so the speedup limit of each count is reported
+    even where fewer processor cores are available than workers.
+     * gcode_list: List of gcode strings to process; Copied for each run.
+     * settings: HeadlessSettings to apply.
+     * worker_counts: List of integers for number of worker processes.
+    """
+    gcode_pipeline = settings.createProcessor().buildPipeline(gcode_list[1])
+    gcode_pipeline._bindHandlers()
+    prepass_time = None # type: Optional[float]
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        gcode_pipeline._prepass(gcode_list)
+        run_time = time.perf_counter() - start_time
+        prepass_time = run_time if prepass_time is None else min(prepass_time, run_time)
+
+    results = OrderedDict() # type: Dict[str, Any]
+    serial_time = None # type: Optional[float]
+
+    for workers in [1] + [count for count in worker_counts if count != 1]:
+        result = runBenchmark(gcode_list, settings, repeat, lazy, workers)
+        seconds = result["process_seconds"] + result["write_seconds"]
+        serial_time = serial_time or seconds
+        serial_fraction = min(prepass_time / serial_time, 1.0)
+        results[str(workers)] = OrderedDict([
+            ("seconds", seconds),
+            ("mb_per_second", result["mb_per_second"]),
+            ("speedup", serial_time / max(seconds, 1e-9)),
+            ("speedup_limit", 1 / (serial_fraction + (1 - serial_fraction) / workers))
+        ])
+
+    return OrderedDict([("cpu_count", os.cpu_count()), ("prepass_seconds", prepass_time),
+                        ("serial_seconds", serial_time), ("results", results)])
+
+
+def benchmarkScaling(line_counts: List[int], lines_per_layer: int=2000, meshes: int=2, extruders: int=1,
+                     repeat: int=3, lazy: bool=True) -> Dict[str, Any]:
+    """Returns time of processing gcode with every Klipper feature for each number of lines.
+
+    Layers are added to reach each line count, so time per line should stay flat as gcode grows.
+     * line_counts: List of integers for approximate number of gcode lines.
+     + lines_per_layer: Integer for number of move lines in each layer.
+    """
+    definitions = loadSettingDefinitions()
+    settings = HeadlessSettings(benchmarkSettings(extruders, meshes)["all"], definitions)
+    results = OrderedDict() # type: Dict[str, Any]
+
+    for line_count in line_counts:
+        gcode_list = generateGcode(max(line_count // lines_per_layer, 1), min(lines_per_layer, line_count), meshes, extruders)
+        total_lines = sum(chunk.count("\n") for chunk in gcode_list)
+        result = runBenchmark(gcode_list, settings, repeat, lazy)
+        del gcode_list
+
+        seconds = result["process_seconds"] + result["write_seconds"]
+        results[str(line_count)] = OrderedDict([
+            ("lines", total_lines),
+            ("seconds", seconds),
+            ("us_per_line", seconds * 1e6 / max(total_lines, 1)),
+            ("peak_memory_mb", result["peak_memory_mb"])
+        ])
+
+    return results
+
+
+def benchmarkObjects(object_counts: List[int], layers: int=20, extruders: int=1, repeat: int=3) -> Dict[str, Any]:
+    """Returns time of per-object pressure advance for each number of objects on the plate.
+
+    Every object has its own per-object factors, so each MESH and TYPE transition looks up
+    a factor of a different object; Cost per transition should not grow with the object count.
+     * object_counts: List of integers for number of mesh objects.
+     + layers: Integer for number of gcode layers.
+    """
+    definitions = loadSettingDefinitions()
+    results = OrderedDict() # type: Dict[str, Any]
+
+    for object_count in object_counts:
+        # Few moves per feature so transitions dominate
+        gcode_list = generateGcode(layers, object_count * 6, object_count, extruders)
+        transitions = sum(chunk.count(";MESH:") + chunk.count(";TYPE:") for chunk in gcode_list)
+        mesh_settings = OrderedDict(("mesh_%d.stl" % mesh_nr, {
+            "extruder_nr": mesh_nr % extruders,
+            "klipper_pressure_advance_infill": round(0.02 + 0.001 * (mesh_nr % 7), 3),
+            "klipper_pressure_advance_wall_0": round(0.03 + 0.001 * (mesh_nr % 5), 3)
+        }) for mesh_nr in range(object_count))
+        settings = HeadlessSettings({"klipper_pressure_advance_enable": True, "klipper_pressure_advance_factor": 0.04,
+                                     "meshes": mesh_settings}, definitions)
+
+        best_time = None # type: Optional[float]
+        for _ in range(repeat):
+            timings = {} # type: Dict[str, float]
+            gc.collect()
+            settings.createProcessor().processGcodeDict({0: list(gcode_list)}, True, timings)
+            stage_time = timings.get("pressure_advance", 0.0)
+            best_time = stage_time if best_time is None else min(best_time, stage_time)
+
+        results[str(object_count)] = OrderedDict([
+            ("transitions", transitions),
+            ("stage_seconds", best_time),
+            ("ns_per_transition", best_time * 1e9 / max(transitions, 1))
+        ])
+
+    return results
+
+
+# Cura setting properties sent by propertyChanged signals
+_signal_properties = ["value", "enabled", "state", "validationState", "limit_to_extruder", "resolve", "warning_value"]
+
+
+class _SignalStack:
+    """Stand-in container stack that counts value lookups.
+
+    """
+    def __init__(self, stack_id: str, values: Dict[str, Any]) -> None:
+        self._id = stack_id
+        self._values = values
+        self.lookups = 0
+
+    def getId(self) -> str:
+        return self._id
+
+    def getProperty(self, key: str, property_name: str) -> Any:
+        self.lookups += 1
+        return self._values.get(key)
+
+
+def _createSignalPlugin(setting_table: Dict[str, Dict[str, Any]], handler: Callable[[str], Any]) -> Any:
+    """Returns KlipperSettingsPlugin with only the state used by its setting change handlers.
+
+    The Cura application is not created; Tuning tower and retraction handlers are replaced by handler.
+    """
+    from .KlipperSettingsPlugin import KlipperSettingsPlugin # Requires Cura and Uranium packages
+
+    plugin = KlipperSettingsPlugin.__new__(KlipperSettingsPlugin)
+    plugin._setting_table = setting_table
+    plugin._value_cache = {}
+    plugin._batch_changes = None
+    plugin._onTuningTowerSettingChanged = plugin._onRetractionSettingChanged = handler
+    plugin._buildSettingDispatchers()
+
+    return plugin
+
+
+def benchmarkSignals(events: int=50000, klipper_share: float=0.02, reads_per_event: int=1,
+                     repeat: int=3, seed: int=0) -> Dict[str, Any]:
+    """Returns time of handling a storm of setting change signals in the plugin handlers.
+
+    Events mostly change Cura settings, as when slicing or switching profiles, with a share of
+    Klipper settings. Signals are sent to the bound _onGlobalSettingChanged and _onExtruderSettingChanged
+    of a plugin created without Cura; Tuning tower and retraction handlers only count calls.
+    Klipper settings are also read through the plugin value cache between events and
+    lookups of the stand-in stacks are counted, so cache evictions are measured.
+    The plugin module imports Cura, so this runs with the Python environment of a Cura install.
+     * events: Integer for number of propertyChanged signals.
+     + klipper_share: Float for the fraction of events changing Klipper settings.
+     + reads_per_event: Integer for number of Klipper setting values read after each event.
+    """
+    rand = random.Random(seed)
+    setting_table = flattenDefinitions(parseDefinitions())
+    klipper_keys = list(setting_table)
+    cura_keys = ["%s_%d" % (name, index) for index in range(40) for name in
+                 ["layer_height", "wall_line_width", "infill_sparse_density", "speed_print", "retraction_amount",
+                  "material_print_temperature", "support_enable", "cool_fan_speed", "adhesion_type", "skin_overlap"]]
+    signals = [(rand.random() < 0.5, rand.choice(klipper_keys if rand.random() < klipper_share else cura_keys),
+                rand.choice(_signal_properties)) for _ in range(events)]
+    reads = [[rand.choice(klipper_keys) for _ in range(reads_per_event)] for _ in range(events)]
+    values = {key: metadata.get("default_value") for key, metadata in setting_table.items()}
+
+    calls = [0]
+
+    def handler(setting: str) -> None:
+        calls[0] += 1
+
+    results = OrderedDict() # type: Dict[str, Any]
+    for name, read_values in [("handlers", False), ("handlers_and_reads", True)]:
+        best_time = None # type: Optional[float]
+        for _ in range(repeat):
+            plugin = _createSignalPlugin(setting_table, handler)
+            global_stack, extruder_stack = _SignalStack("global", values), _SignalStack("extruder", values)
+            calls[0] = 0
+            start_time = time.perf_counter()
+            for (global_signal, setting, property), read_keys in zip(signals, reads):
+                if global_signal:
+                    plugin._onGlobalSettingChanged(setting, property)
+                else:
+                    plugin._onExtruderSettingChanged(setting, property)
+                if read_values:
+                    for key in read_keys:
+                        plugin._getCachedValue(global_stack, key)
+                        plugin._getCachedValue(extruder_stack, key)
+            run_time = time.perf_counter() - start_time
+            best_time = run_time if best_time is None else min(best_time, run_time)
+
+        value_reads = 2 * events * reads_per_event if read_values else 0
+        stack_lookups = global_stack.lookups + extruder_stack.lookups
+        results[name] = OrderedDict([("seconds", best_time), ("handler_calls", calls[0]),
+                                     ("value_reads", value_reads), ("stack_lookups", stack_lookups),
+                                     ("cache_hit_rate", 1 - stack_lookups / value_reads if value_reads else 0.0),
+                                     ("events_per_second", events / max(best_time, 1e-9))])
+
+    return results
+
+
+def main(argv: Optional[List[str]]=None) -> int:
+    """Command line entry point for benchmarks.
+
+    """
+    parser = argparse.ArgumentParser(prog = "python -m KlipperSettingsPlugin.KlipperBenchmark",
+        description = "Benchmark Klipper gcode post-processing for each feature.")
+    parser.add_argument("--layers", type = int, default = 100, help = "number of gcode layers (default: %(default)s)")
+    parser.add_argument("--lines", type = int, default = 2000, help = "move lines per layer (default: %(default)s)")
+    parser.add_argument("--meshes", type = int, default = 2, help = "number of mesh objects (default: %(default)s)")
+    parser.add_argument("--extruders", type = int, default = 1, help = "number of extruders (default: %(default)s)")
+    parser.add_argument("--features", help = "comma separated features to run (default: all)")
+    parser.add_argument("--repeat", type = int, default = 3, help = "runs of each feature (default: %(default)s)")
+    parser.add_argument("--workers", type = int, default = 1, help = "processes used to rewrite layers (default: %(default)s)")
+    parser.add_argument("--eager", action = "store_true", help = "rewrite layers instead of keeping lazy patches")
+    parser.add_argument("--json", help = "file to write results as JSON")
+    parser.add_argument("--signals", type = int, help = "replay this many setting change signals instead")
+    parser.add_argument("--z-offset", type = int, help = "compare layer 0 z offset matching over this many lines instead")
+    parser.add_argument("--worker-sweep", help = "comma separated worker counts to compare with a single worker instead")
+    parser.add_argument("--scaling", help = "comma separated line counts to scale gcode size instead")
+    parser.add_argument("--objects", help = "comma separated object counts to scale per-object pressure advance instead")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.WARNING)
+
+    if args.z_offset:
+        results = benchmarkZOffset(args.z_offset, repeat = args.repeat)
+        print("Layer 0 z offset matching: %d lines" % args.z_offset)
+        print("%-12s %10s %10s %10s" % ("matcher", "seconds", "us/line", "matches"))
+        for name, result in results.items():
+            print("%-12s %10.4f %10.3f %10d" % (name, result["seconds"], result["us_per_line"], result["matches"]))
+        if args.json:
+            with open(args.json, "w", encoding = "utf-8") as f:
+                json.dump({"lines": args.z_offset, "results": results}, f, indent = 2)
+        return 0
+
+    if args.worker_sweep:
+        worker_counts = [int(count) for count in args.worker_sweep.split(",")]
+        gcode_list = generateGcode(args.layers, args.lines, args.meshes, args.extruders)
+        settings = HeadlessSettings(benchmarkSettings(args.extruders, args.meshes)["all"], loadSettingDefinitions())
+        sweep = benchmarkWorkers(gcode_list, settings, worker_counts, args.repeat, not args.eager)
+        print("Worker sweep: all features, %d layers, %.1f MB, %s processor cores" % (
+            args.layers, sum(len(chunk) for chunk in gcode_list) / 1e6, sweep["cpu_count"]))
+        print("Sequential prepass %.3f s of %.3f s serial run" % (sweep["prepass_seconds"], sweep["serial_seconds"]))
+        print("%-10s %10s %10s %10s %10s" % ("workers", "seconds", "MB/s", "speedup", "limit"))
+        for workers, result in sweep["results"].items():
+            print("%-10s %10.3f %10.1f %10.2f %10.2f" % (workers, result["seconds"], result["mb_per_second"],
+                                                         result["speedup"], result["speedup_limit"]))
+        if args.json:
+            with open(args.json, "w", encoding = "utf-8") as f:
+                json.dump(dict(sweep, workers = worker_counts, layers = args.layers), f, indent = 2)
+        return 0
+
+    if args.scaling:
+        line_counts = [int(count) for count in args.scaling.split(",")]
+        results = benchmarkScaling(line_counts, args.lines, args.meshes, args.extruders, args.repeat, not args.eager)
+        print("Gcode size scaling: all features, %d meshes, %d extruders" % (args.meshes, args.extruders))
+        print("%-12s %12s %10s %12s %10s" % ("size", "lines", "seconds", "us/line", "peak MB"))
+        for line_count, result in results.items():
+            print("%-12s %12d %10.3f %12.3f %10.2f" % (line_count, result["lines"], result["seconds"],
+                                                       result["us_per_line"], result["peak_memory_mb"]))
+        if args.json:
+            with open(args.json, "w", encoding = "utf-8") as f:
+                json.dump({"scaling": line_counts, "results": results}, f, indent = 2)
+        return 0
+
+    if args.objects:
+        object_counts = [int(count) for count in args.objects.split(",")]
+        results = benchmarkObjects(object_counts, args.layers, args.extruders, args.repeat)
+        print("Per-object pressure advance: %d layers, %d extruders" % (args.layers, args.extruders))
+        print("%-10s %14s %12s %18s" % ("objects", "transitions", "stage s", "ns/transition"))
+        for object_count, result in results.items():
+            print("%-10s %14d %12.4f %18.1f" % (object_count, result["transitions"], result["stage_seconds"],
+                                                 result["ns_per_transition"]))
+        if args.json:
+            with open(args.json, "w", encoding = "utf-8") as f:
+                json.dump({"objects": object_counts, "results": results}, f, indent = 2)
+        return 0
+
+    if args.signals:
+        try:
+            results = benchmarkSignals(args.signals, repeat = args.repeat)
+        except ImportError as e:
+            print("Error: Setting change signals need the Python environment of a Cura install: %s" % e, file = sys.stderr)
+            return 1
+        print("Setting change signals: %d events" % args.signals)
+        print("%-20s %10s %14s %8s %10s %14s %10s" % ("run", "seconds", "events/s", "calls", "reads", "stack lookups", "hit rate"))
+        for name, result in results.items():
+            print("%-20s %10.4f %14.0f %8d %10d %14d %10.3f" % (name, result["seconds"], result["events_per_second"],
+                result["handler_calls"], result["value_reads"], result["stack_lookups"], result["cache_hit_rate"]))
+        if args.json:
+            with open(args.json, "w", encoding = "utf-8") as f:
+                json.dump({"signals": args.signals, "results": results}, f, indent = 2)
+        return 0
+
+    gcode_list = generateGcode(args.layers, args.lines, args.meshes, args.extruders)
+    gcode_size = sum(len(chunk) for chunk in gcode_list)
+    definitions = loadSettingDefinitions()
+
+    feature_settings = benchmarkSettings(args.extruders, args.meshes)
+    if args.features:
+        feature_settings = OrderedDict((name, feature_settings[name]) for name in args.features.split(","))
+
+    print("Synthetic gcode: %d layers, %d meshes, %d extruders, %.1f MB" % (
+        args.layers, args.meshes, args.extruders, gcode_size / 1e6))
+    print("%-20s %10s %10s %10s %10s  %s" % ("feature", "process s", "write s", "MB/s", "peak MB", "stages"))
+
+    results = OrderedDict() # type: Dict[str, Any]
+    for name, values in feature_settings.items():
+        result = runBenchmark(gcode_list, HeadlessSettings(values, definitions), args.repeat, not args.eager, args.workers)
+        results[name] = result
+        print("%-20s %10.3f %10.3f %10.1f %10.2f  %s" % (name, result["process_seconds"], result["write_seconds"],
+            result["mb_per_second"], result["peak_memory_mb"],
+            " ".join("%s=%.3f" % stage for stage in result["stage_seconds"].items() if stage[0] != "pipeline")))
+
+    if args.json:
+        with open(args.json, "w", encoding = "utf-8") as f:
+            json.dump({"gcode": {"layers": args.layers, "lines": args.lines, "meshes": args.meshes,
+                                 "extruders": args.extruders, "bytes": gcode_size, "workers": args.workers,
+                                 "lazy": not args.eager},
+                       "results": results}, f, indent = 2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# Copyright (c) 2023 J.Jarrard / JJFX
+# The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
+
+'''
+KLIPPER SETTING DEFINITIONS
+---------------------------
+Loads klipper_settings.def.json as a setting definition tree and a flat table of setting metadata.
+The compiled tree and table are cached in a single pickle file keyed by the Cura version,
+so startup skips JSON parsing and compatibility changes while the definition file is unchanged.
+'''
+
+import hashlib
+import json
+import os
+import pickle
+import sys
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .KlipperBackup import writeFileAtomic
+from .KlipperGcode import Logger
+
+definition_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "klipper_settings.def.json")
+plugin_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugin.json")
+
+_cache_format = 1 # Increase when the compiled cache layout changes
+
+
+def internDefinitions(definitions: Any) -> Any:
+    """Returns a copy of setting definition data with every string interned.
+
+    Keys, descriptions and expressions repeated across settings become a single object.
+     * definitions: Parsed setting definition data.
+    """
+    if isinstance(definitions, str):
+        return sys.intern(definitions)
+    if isinstance(definitions, dict):
+        return OrderedDict((sys.intern(key), internDefinitions(value)) for key, value in definitions.items())
+    if isinstance(definitions, list):
+        return [internDefinitions(value) for value in definitions]
+    return definitions
+
+
+def flattenDefinitions(settings_dict: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Returns flat dict of setting keys and their metadata in definition order.
+
+    Metadata includes every setting property except children, with 'parent' set to
+    the key of the parent setting or None for top level settings.
+     * settings_dict: Setting definition tree.
+    """
+    setting_table = OrderedDict() # type: Dict[str, Dict[str, Any]]
+    pending = [(setting_key, definition, None) for setting_key, definition in settings_dict.items()]
+    while pending:
+        setting_key, definition, parent_key = pending.pop(0)
+        metadata = OrderedDict((name, value) for name, value in definition.items() if name != "children")
+        metadata["parent"] = parent_key
+        setting_table[setting_key] = metadata
+        pending.extend((child_key, child, setting_key) for child_key, child in definition.get("children", {}).items())
+
+    return setting_table
+
+
+def parseDefinitions(file_path: str=definition_file) -> Dict[str, Any]:
+    """Returns setting definition tree parsed from json in file order.
+
+    """
+    with open(file_path, encoding = "utf-8") as f:
+        return json.load(f, object_pairs_hook = OrderedDict)
+
+
+def loadCompiledDefinitions(cache_dir: str, cura_version: str, file_path: str=definition_file,
+                            compile_definitions: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]]=None
+                            ) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """Returns setting definition tree and flat metadata table, compiled from cache if valid.
+
+    The cache is valid for the same format, Cura version, plugin version, compiling code and
+    definition file; A changed file modification time only recompiles the definitions if
+    the file content changed.
+    Cache errors are logged and the definitions are compiled from json instead.
+     * cache_dir: String of the directory for the compiled cache file.
+     * cura_version: String of the Cura version the definitions are compiled for.
+     + file_path: String of the setting definition json file.
+     + compile_definitions: Function returning the definition tree modified for the Cura version.
+    """
+    cache_file = os.path.join(cache_dir, "klipper_settings.def.%s.cache" % cura_version)
+    file_stat = os.stat(file_path)
+    file_hash = None # type: Optional[str]
+    compiler = _compilerVersion(compile_definitions)
+
+    try:
+        with open(cache_file, "rb") as f:
+            cache = pickle.load(f)
+    except FileNotFoundError:
+        cache = None
+    except Exception as e:
+        Logger.log('w', "Ignoring invalid klipper settings cache %s: %s", cache_file, e)
+        cache = None
+
+    if (isinstance(cache, dict) and cache.get("format") == _cache_format
+            and cache.get("cura_version") == cura_version and cache.get("compiler") == compiler
+            and cache.get("size") == file_stat.st_size):
+        if cache.get("mtime") == file_stat.st_mtime_ns:
+            return cache["settings"], cache["setting_table"]
+
+        file_hash = _fileHash(file_path)
+        if cache.get("hash") == file_hash: # Only the modification time changed
+            cache["mtime"] = file_stat.st_mtime_ns
+            _writeCache(cache_file, cache)
+            return cache["settings"], cache["setting_table"]
+
+    Logger.log('d', "Compiling klipper settings definitions for Cura %s", cura_version)
+    settings_dict = parseDefinitions(file_path)
+    if compile_definitions is not None:
+        settings_dict = compile_definitions(settings_dict)
+    settings_dict = internDefinitions(settings_dict)
+
+    cache = {
+        "format": _cache_format,
+        "cura_version": cura_version,
+        "compiler": compiler,
+        "mtime": file_stat.st_mtime_ns,
+        "size": file_stat.st_size,
+        "hash": file_hash or _fileHash(file_path),
+        "settings": settings_dict,
+        "setting_table": flattenDefinitions(settings_dict)
+    }
+    _writeCache(cache_file, cache)
+
+    return cache["settings"], cache["setting_table"]
+
+
+def _fileHash(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _compilerVersion(compile_definitions: Optional[Callable[..., Any]]) -> str:
+    """Returns the plugin version and a hash of the modules compiling the definitions.
+
+    Cached definitions are compiled again after a plugin update or any change to this
+    module or the module of compile_definitions.
+     * compile_definitions: Function modifying the definitions or None.
+    """
+    try:
+        with open(plugin_file, encoding = "utf-8") as f:
+            plugin_version = str(json.load(f).get("version", ""))
+    except (OSError, ValueError) as e:
+        Logger.log('w', "Could not read klipper settings plugin version: %s", e)
+        plugin_version = ""
+
+    source_files = [os.path.abspath(__file__)]
+    compile_module = sys.modules.get(getattr(compile_definitions, "__module__", None) or "")
+    compile_file = getattr(compile_module, "__file__", None)
+    if compile_file and os.path.isfile(compile_file) and os.path.abspath(compile_file) not in source_files:
+        source_files.append(os.path.abspath(compile_file))
+
+    try:
+        source_hash = ":".join(_fileHash(source_file) for source_file in source_files)
+    except OSError as e:
+        Logger.log('w', "Could not hash klipper settings compiler source: %s", e)
+        source_hash = ""
+
+    return "%s:%s" % (plugin_version, source_hash)
+
+
+def _writeCache(cache_file: str, cache: Dict[str, Any]) -> None:
+    """Writes compiled definitions to the cache file, replacing it only when complete.
+
+    """
+    writeFileAtomic(cache_file, lambda f: pickle.dump(cache, f, protocol = pickle.HIGHEST_PROTOCOL), "cache", binary = True)
+
+
+class SettingDispatcher:
+    """Calls the handler of a changed setting property from a precomputed key table.
+
+    Unrelated settings are rejected with a single dict lookup, so it can be connected
+    to container stack propertyChanged signals that fire for every Cura setting.
+     + properties: Setting properties that call handlers.
+    """
+    def __init__(self, properties: Tuple[str, ...]=("value", "enabled")) -> None:
+        self._properties = frozenset(properties)
+        self._handlers = {} # type: Dict[str, Callable[[str], Any]]
+
+    def addHandler(self, setting_keys: Any, handler: Callable[[str], Any]) -> None:
+        """Calls handler with the setting key when any of the settings change.
+
+         * setting_keys: Iterable of setting keys.
+         * handler: Function of the changed setting key.
+        """
+        for setting_key in setting_keys:
+            self._handlers[setting_key] = handler
+
+    def dispatch(self, setting: str, property: str) -> None:
+        handler = self._handlers.get(setting)
+        if handler is not None and property in self._properties:
+            handler(setting)
+
+    def __contains__(self, setting: str) -> bool:
+        return setting in self._handlers
+
+    def __len__(self) -> int:
+        return len(self._handlers)
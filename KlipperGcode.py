@@ -0,0 +1,1436 @@
+# Copyright (c) 2023 J.Jarrard / JJFX
+# The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
+
+'''
+KLIPPER GCODE POST-PROCESSING
+-----------------------------
+Gcode processing used by the KlipperSettingsPlugin when a sliced file is saved.
+Does not depend on Cura so gcode can also be processed outside of the application.
+'''
+
+import hashlib
+import itertools
+import json
+import re
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple, OrderedDict
+from collections.abc import MutableSequence
+from typing import Callable, Iterable, Iterator, List, Optional, Any, Dict, Set, Tuple
+
+try:
+    from UM.Logger import Logger # Debug logging
+except ImportError: # Running outside of Cura
+    import logging
+
+    class Logger:
+        """Minimal stand-in for the Cura logger."""
+        _levels = {'d': logging.DEBUG, 'i': logging.INFO, 'w': logging.WARNING, 'e': logging.ERROR, 'c': logging.CRITICAL}
+        _logger = logging.getLogger("KlipperSettingsPlugin")
+
+        @classmethod
+        def log(cls, log_type: str, message: str, *args: Any) -> None:
+            cls._logger.log(cls._levels.get(log_type, logging.INFO), message, *args)
+
+        @classmethod
+        def logException(cls, log_type: str, message: str, *args: Any) -> None:
+            cls._logger.log(cls._levels.get(log_type, logging.ERROR), message, *args, exc_info = True)
+
+
+## Klipper gcode parameters of each setting; Dict order must be preserved
+pressure_advance_setting_key = OrderedDict([
+    ("_FACTORS", "klipper_pressure_advance_factor"),  ## [0-3] Parent settings
+    ("_WALLS", "klipper_pressure_advance_wall"),
+    ("_SUPPORTS", "klipper_pressure_advance_support"),
+    ("LAYER_0", "klipper_pressure_advance_layer_0"),
+    ("WALL-OUTER", "klipper_pressure_advance_wall_0"),  ## [4-7] Gcode mesh features
+    ("WALL-INNER", "klipper_pressure_advance_wall_x"),
+    ("SKIN", "klipper_pressure_advance_topbottom"),
+    ("FILL", "klipper_pressure_advance_infill"),
+    ("SUPPORT", "klipper_pressure_advance_support_infill"),  ## [8-11] Gcode non-mesh features
+    ("SUPPORT-INTERFACE", "klipper_pressure_advance_support_interface"),
+    ("PRIME-TOWER", "klipper_pressure_advance_prime_tower"),
+    ("SKIRT", "klipper_pressure_advance_skirt_brim")
+]) # Older cura compatibility
+
+tuning_tower_setting_key = OrderedDict([
+    ("tuning_method", "klipper_tuning_tower_method"),
+    ("command", "klipper_tuning_tower_command"),
+    ("parameter", "klipper_tuning_tower_parameter"),
+    ("start", "klipper_tuning_tower_start"),
+    ("skip", "klipper_tuning_tower_skip"),
+    ("factor", "klipper_tuning_tower_factor"),
+    ("band", "klipper_tuning_tower_band"),
+    ("step_delta", "klipper_tuning_tower_step_delta"),
+    ("step_height", "klipper_tuning_tower_step_height")
+])
+
+velocity_limit_setting_key = {
+    "velocity": "klipper_velocity_limit",
+    "accel": "klipper_accel_limit",
+    "accel_to_decel": "klipper_accel_to_decel_limit",
+    "square_corner_velocity": "klipper_corner_velocity_limit"
+}
+firmware_retraction_setting_key = {
+    "retract_length": "klipper_retract_length",
+    "unretract_extra_length": "klipper_retract_prime_length",
+    "retract_speed": "klipper_retract_speed",
+    "unretract_speed": "klipper_retract_prime_speed"
+}
+input_shaper_setting_key = {
+    "shaper_freq_x": "klipper_shaper_freq_x",
+    "shaper_freq_y": "klipper_shaper_freq_y",
+    "shaper_type_x": "klipper_shaper_type_x",
+    "shaper_type_y": "klipper_shaper_type_y",
+    "damping_ratio_x": "klipper_damping_ratio_x",
+    "damping_ratio_y": "klipper_damping_ratio_y"
+}
+
+
+def pressureAdvanceFeatures(feature_key: str) -> List[str]:
+    """Returns gcode features controlled by a pressure advance setting key.
+
+    Parent settings apply their value to each child feature.
+    """
+    return (["WALL-OUTER", "WALL-INNER", "SKIN", "FILL"] if feature_key == "_FACTORS"
+            else ['WALL-OUTER', 'WALL-INNER'] if feature_key == "_WALLS"
+            else ['SUPPORT', 'SUPPORT-INTERFACE'] if feature_key == "_SUPPORTS"
+            else [feature_key])
+
+
+def gcodeSearch(gcode: str, command: str, ignore_comment: bool=False) -> bool:
+    """Returns true if command exists in gcode string.
+
+    Looks up active or inactive gcode command in the cached command index of the gcode.
+    Any parameters on the line after the command are ignored.
+     * gcode: String containing gcode to search in.
+     * command: String for gcode command to find.
+     + ignore_comment: True includes commented command as a match.
+    """
+    command_index = indexGcodeCommands(gcode)
+    result = False
+
+    if command_index.hasCommand(command):
+        Logger.log('i', "Active command found in gcode: '%s'", command)
+        result = True
+    elif ignore_comment and command_index.hasCommand(command, include_comments = True):
+        result = command_index.getCommentedLine(command) # Full line returned
+        Logger.log('i', "Inactive command found in gcode: '%s'", result)
+
+    return result
+
+
+class GcodeCommandIndex:
+    """Active and commented commands of a gcode string with the parameters of each active command.
+
+    Commands are the first word of a line, or of the text after ';' for commented commands;
+    Command names and parameter keys are upper case. Traditional gcode words (S60) and
+    Klipper parameters (ACCEL=3000) are both indexed as parameters.
+     * gcode: String of gcode to index, usually the start gcode.
+    """
+    __slots__ = ("_active", "_commented")
+
+    def __init__(self, gcode: str) -> None:
+        self._active = {} # type: Dict[str, List[Dict[str, str]]]
+        self._commented = {} # type: Dict[str, str]
+
+        for line in gcode.split("\n"):
+            code, comment_mark, comment = line.partition(";")
+            active_command = self._parseCommand(code)
+            if active_command is not None:
+                self._active.setdefault(active_command[0], []).append(active_command[1])
+
+            commented_command = self._parseCommand(comment) if comment_mark else None
+            if commented_command is not None and commented_command[0] not in self._commented:
+                self._commented[commented_command[0]] = line.strip()
+
+    @staticmethod
+    def _parseCommand(text: str) -> Optional[Tuple[str, Dict[str, str]]]:
+        """Returns (command, parameters) of a gcode command string or None if it is empty.
+
+        """
+        words = text.split()
+        if not words:
+            return None
+
+        parameters = OrderedDict() # type: Dict[str, str]
+        for word in words[1:]:
+            key, assign, value = word.partition("=")
+            if assign: # Klipper parameter
+                parameters[key.upper()] = value
+            else: # Traditional gcode word
+                parameters[word[:1].upper()] = word[1:]
+
+        return words[0].upper(), parameters
+
+    def hasCommand(self, command: str, include_comments: bool=False) -> bool:
+        """Returns true if the command is active in the gcode.
+
+         + include_comments: True also returns true for a commented command.
+        """
+        command = command.upper()
+        return command in self._active or (include_comments and command in self._commented)
+
+    def getCommentedLine(self, command: str) -> Optional[str]:
+        """Returns the first line with the commented command or None.
+
+        """
+        return self._commented.get(command.upper())
+
+    def getParameters(self, command: str) -> Optional[Dict[str, str]]:
+        """Returns parameters of the first active command or None if it is not active.
+
+        """
+        occurrences = self._active.get(command.upper())
+        return dict(occurrences[0]) if occurrences else None
+
+    def setsValues(self, command_line: str) -> bool:
+        """Returns true if the last active command sets every parameter of a command line to the same value.
+
+        Earlier occurrences are ignored because the last one sets the values that remain active.
+        Numeric values are compared as numbers, so 'ACCEL=3000' matches 'ACCEL=3000.0'.
+         * command_line: String of a single gcode command; Any comment is ignored.
+        """
+        command = self._parseCommand(command_line.partition(";")[0])
+        if command is None or not command[1]:
+            return False
+
+        command_name, parameters = command
+        occurrences = self._active.get(command_name)
+        if not occurrences:
+            return False
+
+        existing = occurrences[-1]
+        return all(key in existing and _sameGcodeValue(existing[key], value) for key, value in parameters.items())
+
+
+def _sameGcodeValue(value: str, other: str) -> bool:
+    try:
+        return float(value) == float(other)
+    except ValueError:
+        return value.upper() == other.upper()
+
+
+# Command indexes of recent gcode strings by content hash
+_command_index_cache = OrderedDict() # type: OrderedDict[str, GcodeCommandIndex]
+_command_index_cache_size = 8
+
+def indexGcodeCommands(gcode: str) -> GcodeCommandIndex:
+    """Returns command index of a gcode string, parsed once for the same gcode content.
+
+     * gcode: String of gcode to index, usually the start gcode.
+    """
+    content_hash = hashlib.sha1(gcode.encode("utf-8", "surrogateescape")).hexdigest()
+    command_index = _command_index_cache.get(content_hash)
+
+    if command_index is None:
+        command_index = _command_index_cache[content_hash] = GcodeCommandIndex(gcode)
+        if len(_command_index_cache) > _command_index_cache_size:
+            _command_index_cache.popitem(last = False) # Remove oldest index
+    else:
+        _command_index_cache.move_to_end(content_hash)
+
+    return command_index
+
+
+def gcodeUiSupport(gcode: str, comment: str, bed_temp: float, nozzle_temp: float, nozzle_start_temp: float=0) -> str:
+    """Command string of commented print start temps.
+
+    Allows fluidd/mainsail to detect gcode print temps when start gcode uses
+    klipper macros without visible M190 and M109 gcode commands.
+     * gcode: String containing gcode to search in.
+    """
+    bed_temp_exists = gcodeSearch(gcode, "M190", True)
+    nozzle_temp_exists = gcodeSearch(gcode, "M109", True)
+
+    gcode_comment = ""
+    if not bed_temp_exists:
+        gcode_comment += ";M190 S%s %s\n" % (bed_temp, comment)
+    if not nozzle_temp_exists:
+        nozzle_temp = nozzle_start_temp if nozzle_start_temp > 0 else nozzle_temp
+        gcode_comment += ";M109 S%s %s\n" % (nozzle_temp, comment)
+
+    if gcode_comment:
+       gcode_comment = ";Support for Klipper UI\n" + gcode_comment
+
+    return gcode_comment
+
+def gcodePressureAdvance(extruder_nr: str, comment: str, pressure_advance: float=-1, smooth_time: float=0) -> str:
+    """Returns enabled pressure advance settings as gcode command string.
+
+    """
+    gcode_command = "SET_PRESSURE_ADVANCE"
+
+    if pressure_advance >= 0:
+        gcode_command += " ADVANCE=%g" % pressure_advance
+
+    if smooth_time > 0:
+        gcode_command += " SMOOTH_TIME=%g" % smooth_time
+
+    gcode_command += " EXTRUDER=extruder%s %s" % (extruder_nr, comment)
+
+    return gcode_command
+
+
+def gcodeVelocityLimits(velocity_limits: Dict[str, float], warnings: Optional[List[str]]=None) -> str:
+    """Returns enabled velocity settings as gcode command string.
+
+     + warnings: List of warning messages to add to for values that may be unintended.
+    """
+    # Remove disabled settings
+    velocity_limits = {key: d for key, d in velocity_limits.items() if (
+        key != "square_corner_velocity" and d > 0) or (
+        key == "square_corner_velocity" and d >= 0)}
+
+    if velocity_limits:
+        gcode_command = "SET_VELOCITY_LIMIT "
+
+        for key, value in velocity_limits.items():
+            gcode_command += "%s=%d " % (key.upper(), value)
+
+            if warnings is not None and (key == "square_corner_velocity" and value == 0):
+                warnings.append("•  Square Corner Velocity Limit = <b>0</b>")
+
+        return gcode_command # TypeError msg if no return
+
+
+def gcodeFirmwareRetraction(retraction_settings: Dict[str, float]) -> str:
+    """Returns enabled firmware retraction settings as gcode command string.
+
+    """
+    # Remove disabled settings
+    retraction_settings = {key: d for key, d in retraction_settings.items() if (
+        key.endswith("speed") and d > 0) or (key.endswith("length") and d >= 0)}
+
+    if retraction_settings:
+        gcode_command = "SET_RETRACTION "
+
+        for key, value in retraction_settings.items():
+            gcode_command += "%s=%g " % (key.upper(), value) # Create gcode command
+
+        return gcode_command # TypeError msg if no return
+
+
+def gcodeInputShaper(shaper_settings: Dict[str, Any], warnings: Optional[List[str]]=None) -> str:
+    """Returns enabled input shaper settings as gcode command string.
+
+     + warnings: List of warning messages to add to for values that may be unintended.
+    """
+    if shaper_settings['shaper_type_x'] == shaper_settings['shaper_type_y']:
+        shaper_settings['shaper_type'] = shaper_settings.pop('shaper_type_x')
+        del shaper_settings['shaper_type_y'] # Use single command for both axes
+
+    # Remove all disabled settings
+    shaper_settings = {key: v for key, v in shaper_settings.items() if (
+        key.startswith("type", 7) and v != "disabled") or (not key.startswith("type", 7) and v >= 0)}
+
+    value_warnings = len([v for v in shaper_settings.values() if v == 0]) # Number of values set to 0
+
+    if shaper_settings:
+        gcode_command = "SET_INPUT_SHAPER "
+
+        for key, value in shaper_settings.items():
+            value = value.upper() if key.startswith("type", 7) else value
+            gcode_command += "%s=%s " % (key.upper(), value) # Create gcode command
+
+        if warnings is not None and value_warnings:
+            warnings.append("•  <b>%d</b> Input Shaper setting(s) = <b>0</b>" % value_warnings)
+
+        return gcode_command # TypeError msg if no return
+
+
+def gcodeTuningTower(tower_settings: Dict[str, Any], warnings: Optional[List[str]]=None, extruder_count: int=1) -> str:
+    """Returns enabled tuning tower settings as gcode command string.
+
+    Real-time string input validation done with regex patterns in setting definitions;
+    Accepts only word characters but 'command' also allows spaces, 'single-quotes' and '='.
+    'command' allows multiple words, up to arbitrary limit of 60 approved characters.
+    'parameter' allows single word up to arbitrary limit of 40 word characters.
+     + warnings: List of warning messages to add the final tuning tower warning to.
+     + extruder_count: Integer for number of extruders used by the print.
+    """
+    gcode_settings = OrderedDict() # Preserve dict order in all Cura versions
+
+    # Remove disabled and optional values
+    for setting, value in tower_settings.items():
+        if not (setting in ['skip', 'band'] and value == 0):
+            gcode_settings[setting] = value
+
+    # Strips any white space, quotes and '=' from ends of 'command' string
+    gcode_settings['command'] = gcode_settings['command'].strip(" \t'=")
+    # Add single quotes if 'command' has multiple words
+    if len(gcode_settings['command'].split()) > 1:
+        gcode_settings['command'] = "'%s'" % gcode_settings['command']
+
+    gcode_command = "TUNING_TOWER "
+    method = gcode_settings.pop('tuning_method')
+
+    for key, value in gcode_settings.items():
+        if method == "factor" and key in ['step_delta', 'step_height']:
+            continue
+        if method == "step" and key in ['factor', 'band']:
+            continue
+
+        gcode_command += "%s=%s " % (key.upper(), value)
+
+    ## Final Tuning Tower Warning Message
+    if warnings is not None:
+        warning_msg = "<i>Tuning Tower is Active:</i><br/>%s<br/><br/>" % gcode_command
+        if extruder_count > 1:
+            warning_msg += "<b><i>Tuning Tower</i> with multiple extruders could be unpredictable!</b><br/><br/>"
+        warning_msg += "<i>Tuning tower calibration affects <b>all objects</b> on the build plate.</i>"
+
+        warnings.append(warning_msg)
+
+    return gcode_command # TypeError stop if no return
+
+
+# Gcode line edit returned by pipeline stages;
+# 'before' and 'after' are new command lines, 'append' is added to the end of the line or None.
+LineEdit = namedtuple("LineEdit", ["before", "append", "after"])
+
+# Region of a gcode layer starting at a marker line with the gcode state that applies to it;
+# 'marker' is LAYER, MESH, TYPE, T or None for the region before the first marker.
+GcodeSpan = namedtuple("GcodeSpan", ["marker", "layer_nr", "extruder_nr", "mesh", "feature_type", "start", "line_end", "end"])
+
+
+class GcodeState:
+    """Current gcode position shared by all pipeline stages.
+
+    """
+    __slots__ = ("layer_nr", "extruder_nr", "mesh", "feature_type")
+
+    def __init__(self, extruder_nr: int) -> None:
+        self.layer_nr = -1 # Integer for current gcode layer
+        self.extruder_nr = extruder_nr # Active extruder number
+        self.mesh = None  # type: Optional[str]
+        self.feature_type = None  # type: Optional[str]
+
+    def save(self) -> tuple:
+        return (self.layer_nr, self.extruder_nr, self.mesh, self.feature_type)
+
+    def restore(self, saved_state: tuple) -> None:
+        self.layer_nr, self.extruder_nr, self.mesh, self.feature_type = saved_state
+
+
+class GcodeStage:
+    """Base class for a Klipper feature applied by the gcode pipeline.
+
+    Stages only receive the gcode events listed in 'events';
+    'layer', 'mesh', 'type' and 'tool' for marker lines or 'line' for all other lines of an accepted layer.
+    Marker event handlers return a LineEdit for the current line or None if unchanged.
+    Stages that keep their own state between layers must support saveState and restoreState.
+     * name: String to identify the stage in timing results.
+     + header: String of commands added to the beginning of the start gcode.
+     + prefix: String inserted before the start gcode.
+     + suffix: String appended to the start gcode.
+    """
+    events = () # type: tuple
+
+    def __init__(self, name: str, header: str="", prefix: str="", suffix: str="") -> None:
+        self.name = name
+        self.header = header
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def acceptsLayer(self, layer_nr: int) -> bool:
+        """Returns true if 'line' events are needed for the gcode layer.
+
+        """
+        return False
+
+    def saveState(self) -> Any:
+        """Returns a picklable copy of any stage state carried between layers.
+
+        """
+        return None
+
+    def restoreState(self, saved_state: Any) -> None:
+        pass
+
+    def onLayer(self, state: GcodeState) -> None:
+        pass
+
+    def onMesh(self, line: str, state: GcodeState) -> Optional[LineEdit]:
+        return None
+
+    def onType(self, line: str, state: GcodeState) -> Optional[LineEdit]:
+        return None
+
+    def onToolChange(self, line: str, state: GcodeState) -> Optional[LineEdit]:
+        return None
+
+    def onLines(self, layer: str, start: int, end: int, state: GcodeState) -> List[tuple]:
+        """Returns (line_start, line_end, LineEdit) for each changed line between two offsets of a layer.
+
+        """
+        return []
+
+
+class ZOffsetStage(GcodeStage):
+    """Offsets z axis changes in layer 0 equal to the layer 0 height.
+
+    Z offset only applies if z axis coordinate equals the layer 0 height and is the last word
+    of a G0 or G1 move, as in layer height moves; This is safer and necessary to avoid conflicts
+    with settings such as z hop. Coordinates are compared as numbers so formatting
+    such as 'Z.2' or 'Z0.20' still matches.
+    """
+    events = ("line",)
+
+    _z_tolerance = 0.0001 # Below gcode coordinate resolution
+    _move_prefixes = ("G0 ", "G1 ", "G0\t", "G1\t")
+
+    def __init__(self, comment: str, z_offset: float, layer_0_height: float, **kwargs: Any) -> None:
+        super().__init__("z_offset", **kwargs)
+
+        self.comment = comment
+        self._z_offset = z_offset
+        self._z_offset_adjust_pattern = "SET_GCODE_OFFSET Z_ADJUST=%g " + comment
+        self._layer_0_height = float(layer_0_height)
+
+    def acceptsLayer(self, layer_nr: int) -> bool:
+        return layer_nr == 0
+
+    def onLines(self, layer: str, start: int, end: int, state: GcodeState) -> List[tuple]:
+        edits = [] # type: List[tuple]
+
+        # Only lines containing a 'Z' are read; Others are skipped by substring search
+        position = layer.find("Z", start, end)
+        while position >= 0:
+            line_end = layer.find("\n", position, end)
+            if line_end < 0:
+                line_end = end
+            z_start = layer.rfind("Z", position, line_end) # Last Z word of the line
+            position = layer.find("Z", line_end, end) if line_end < end else -1
+
+            # Matches move ending with z coordinate equal to layer 0 height
+            if layer[z_start - 1] not in " \t" or layer[line_end - 1] in " \t\r" or layer.find(" ", z_start, line_end) >= 0:
+                continue
+            line_start = layer.rfind("\n", start, z_start) + 1 or start
+            if not layer.startswith(self._move_prefixes, line_start, z_start):
+                continue
+            try:
+                z_position = float(layer[z_start + 1:line_end])
+            except ValueError: # Includes lines that have already been processed
+                continue
+            if abs(z_position - self._layer_0_height) > self._z_tolerance:
+                continue
+
+            # Inserts z offset command before matched line, then instructs klipper to
+            # revert the offset on the next z axis change even if the print is stopped.
+            edits.append((line_start, line_end, LineEdit(
+                self._z_offset_adjust_pattern % self._z_offset,
+                self.comment, # Prevents matching a processed line
+                self._z_offset_adjust_pattern % -(self._z_offset))))
+
+        return edits
+
+
+class FirmwareRetractionStage(GcodeStage):
+    """Applies firmware retraction values of each extruder after tool changes.
+
+     * extruder_fw_retraction: Dict of retraction command for each extruder number.
+    """
+    events = ("tool",)
+
+    def __init__(self, extruder_fw_retraction: Dict[int, str], **kwargs: Any) -> None:
+        super().__init__("firmware_retraction", **kwargs)
+
+        self._extruder_fw_retraction = extruder_fw_retraction
+        if not extruder_fw_retraction:
+            self.events = ()
+
+    def onToolChange(self, line: str, state: GcodeState) -> Optional[LineEdit]:
+        if state.layer_nr < 0:
+            return None
+
+        return LineEdit(None, None, self._extruder_fw_retraction[state.extruder_nr])
+
+
+_no_factor = None # Table value of a feature without an extruder factor
+
+class PressureAdvanceStage(GcodeStage):
+    """Applies pressure advance factors at each new feature type.
+
+    Mesh names and features are interned to integer IDs when the stage is created and factors are
+    resolved into a dense table of each extruder with a row for every mesh with per-object values;
+    Each transition is a list lookup, so its cost does not grow with the number of objects.
+     * comment: String appended to new gcode commands.
+     * extruder_factors: Dict of (extruder_nr, feature) keys for extruder values.
+     * per_mesh_factors: Dict of (mesh_name, feature) keys for per-object values.
+     * current_factor: Dict of initial factor set for each extruder.
+     * active_mesh_features: Set of features with per-object values.
+    """
+    events = ("layer", "mesh", "type")
+
+    def __init__(self, comment: str, extruder_factors: Dict[Any, float], per_mesh_factors: Dict[Any, float],
+                 current_factor: Dict[int, float], active_mesh_features: Set[str], **kwargs: Any) -> None:
+        super().__init__("pressure_advance", **kwargs)
+
+        self.comment = comment
+        self._current_factor = current_factor
+        self._active_mesh_features = active_mesh_features
+
+        features = list(OrderedDict.fromkeys(feature for _, feature in itertools.chain(extruder_factors, per_mesh_factors)))
+        self._feature_ids = {feature: feature_id for feature_id, feature in enumerate(features)} # type: Dict[str, int]
+        # Offset of the table row of each mesh; Row 0 has the extruder values used by every other mesh
+        self._mesh_rows = {} # type: Dict[str, int]
+        for mesh_name, _ in per_mesh_factors:
+            self._mesh_rows.setdefault(mesh_name, (len(self._mesh_rows) + 1) * len(features))
+
+        self._factor_table = {} # type: Dict[int, List[Any]]
+        self._command_table = {} # type: Dict[int, List[Optional[str]]]
+        for extruder_nr in OrderedDict.fromkeys(extruder_nr for extruder_nr, _ in extruder_factors):
+            factor_table = [extruder_factors.get((extruder_nr, feature), _no_factor) for feature in features]
+            factor_table *= len(self._mesh_rows) + 1
+            for (mesh_name, feature), factor in per_mesh_factors.items():
+                factor_table[self._mesh_rows[mesh_name] + self._feature_ids[feature]] = factor
+            self._factor_table[extruder_nr] = factor_table
+            self._command_table[extruder_nr] = [None] * len(factor_table) # Commands created when first used
+
+        self._feature_type = None # type: Optional[str]
+        self._feature_type_error = False
+        self._new_layer = False
+
+        if not extruder_factors: # Only initial commands are needed
+            self.events = ()
+
+    def saveState(self) -> Any:
+        return (self._feature_type, self._feature_type_error, self._new_layer, dict(self._current_factor))
+
+    def restoreState(self, saved_state: Any) -> None:
+        self._feature_type, self._feature_type_error, self._new_layer, current_factor = saved_state
+        self._current_factor = dict(current_factor)
+
+    def onLayer(self, state: GcodeState) -> None:
+        self._new_layer = bool(self._active_mesh_features) # Sanity check for mesh features
+
+    def onMesh(self, line: str, state: GcodeState) -> Optional[LineEdit]:
+        if not self._feature_type_error:
+            return None
+
+        self._feature_type_error = False
+        command = self._nextPressureAdvance(state)
+
+        return LineEdit(command, None, None) if command else None # Command emitted before current line
+
+    def onType(self, line: str, state: GcodeState) -> Optional[LineEdit]:
+        feature_type = state.feature_type
+
+        if state.layer_nr <= 0 and feature_type != "SKIRT":
+            feature_type = "LAYER_0"
+        self._feature_type = feature_type
+
+        # Fixes when MESH name is not specified prior to its feature TYPE
+        # Mostly an issue in older cura versions.
+        if self._new_layer and feature_type in self._active_mesh_features:
+            self._feature_type_error = True # Error corrected at next MESH line
+            return None
+
+        command = self._nextPressureAdvance(state)
+
+        return LineEdit(None, None, command) if command else None # Command emitted after current line
+
+    def _nextPressureAdvance(self, state: GcodeState) -> Optional[str]:
+        """Returns pressure advance command if the factor for the current feature has changed.
+
+        Feature types and extruders without a factor keep the current factor.
+        """
+        extruder_nr = state.extruder_nr
+        feature_id = self._feature_ids.get(self._feature_type)
+        factor_table = self._factor_table.get(extruder_nr)
+        if feature_id is None or factor_table is None: # Feature type unknown to Cura settings
+            return None
+
+        # Mesh row if a mesh setting exists, otherwise the current extruder value
+        factor_index = self._mesh_rows.get(state.mesh, 0) + feature_id
+        pressure_advance_factor = factor_table[factor_index]
+        if pressure_advance_factor is _no_factor: # Extruder value was not set
+            return None
+        self._new_layer = False
+
+        # Sets new factor if different from the active value
+        if pressure_advance_factor == self._current_factor.get(extruder_nr, None):
+            return None
+
+        self._current_factor[extruder_nr] = pressure_advance_factor
+
+        commands = self._command_table[extruder_nr]
+        if commands[factor_index] is None:
+            commands[factor_index] = gcodePressureAdvance(str(extruder_nr).strip('0'), self.comment, pressure_advance_factor)
+        return commands[factor_index]
+
+
+class GcodeLayerIndex:
+    """Marker lines of a gcode layer and the gcode state of each region between them.
+
+    Built with a single regex scan of the layer string so every stage shares one tokenization.
+    Spans only begin at tool changes between tracked extruders and at meshes other than NONMESH.
+     * layer: String of a gcode layer.
+     * state: GcodeState at the start of the layer.
+     + tool_change_lines: Set of tracked tool change lines (T0,T1...).
+    """
+    __slots__ = ("spans",)
+
+    # Marker lines after the first line of a layer
+    _marker_regex = re.compile(r"\n(?:;(LAYER|MESH|TYPE):([^\n]*)|(T[0-9]+)(?=\n|\Z))")
+    _first_marker_regex = re.compile(r";(LAYER|MESH|TYPE):([^\n]*)|(T[0-9]+)(?=\n|\Z)")
+
+    def __init__(self, layer: str, state: GcodeState, tool_change_lines: Optional[Set[str]]=None) -> None:
+        layer_nr, extruder_nr, mesh, feature_type = state.save()
+        tool_change_lines = tool_change_lines or set()
+        spans = [] # type: List[GcodeSpan]
+        marker = None
+        start = line_end = 0
+
+        first_match = self._first_marker_regex.match(layer)
+        matches = self._marker_regex.finditer(layer)
+
+        for match in itertools.chain([first_match] if first_match else [], matches):
+            marker_type, value, tool_change = match.groups()
+
+            if tool_change:
+                if tool_change not in tool_change_lines:
+                    continue
+                new_marker = "T"
+            elif marker_type == "MESH" and value == "NONMESH":
+                continue
+            elif marker_type == "LAYER":
+                try:
+                    int(value)
+                except ValueError:
+                    Logger.log('w', "Could not get layer number: %s", match.group().strip())
+                    continue
+                new_marker = marker_type
+            else:
+                new_marker = marker_type
+
+            # Closes the previous span at the start of the marker line
+            line_start = match.start() if match is first_match else match.start() + 1
+            if line_start > start or marker:
+                spans.append(GcodeSpan(marker, layer_nr, extruder_nr, mesh, feature_type, start, line_end, line_start))
+
+            marker = new_marker
+            if marker == "T":
+                extruder_nr = int(tool_change[1:]) # Active extruder number
+            elif marker == "LAYER":
+                layer_nr = int(value) # Integer for current gcode layer
+            elif marker == "MESH":
+                mesh = value # String for gcode mesh name
+            else:
+                feature_type = value # String for gcode feature
+            start, line_end = line_start, match.end()
+
+        spans.append(GcodeSpan(marker, layer_nr, extruder_nr, mesh, feature_type, start, line_end, len(layer)))
+        self.spans = spans
+
+
+def applyInsertions(layer: str, insertions: List[tuple]) -> str:
+    """Returns gcode layer rebuilt from slices with new text at each insertion offset.
+
+     * insertions: List of (offset, text) sorted by offset.
+    """
+    output = [] # type: List[str]
+    append = output.append
+    position = 0
+    for offset, text in insertions:
+        append(layer[position:offset])
+        append(text)
+        position = offset
+    append(layer[position:])
+
+    return "".join(output)
+
+
+class GcodePatchSet:
+    """Sparse set of text insertions into gcode layers.
+
+    Insertions are keyed by layer number and offset in the unmodified layer;
+    Offsets are stored in compact arrays and repeated commands share one string.
+    """
+    def __init__(self) -> None:
+        self._texts = [] # type: List[str]
+        self._text_ids = {} # type: Dict[str, int]
+        self._layers = {} # type: Dict[int, tuple]
+
+    def __len__(self) -> int:
+        return sum(len(offsets) for offsets, _ in self._layers.values())
+
+    def __bool__(self) -> bool:
+        return bool(self._layers)
+
+    def addInsertions(self, layer_nr: int, insertions: List[tuple]) -> None:
+        """Records insertions into a gcode layer, replacing any existing patch of the layer.
+
+         * insertions: List of (offset, text) sorted by offset.
+        """
+        if not insertions:
+            self._layers.pop(layer_nr, None)
+            return
+
+        offsets = array('q')
+        text_ids = array('l')
+        for offset, text in insertions:
+            text_id = self._text_ids.get(text)
+            if text_id is None:
+                text_id = self._text_ids[text] = len(self._texts)
+                self._texts.append(text)
+            offsets.append(offset)
+            text_ids.append(text_id)
+
+        self._layers[layer_nr] = (offsets, text_ids)
+
+    def getInsertions(self, layer_nr: int) -> List[tuple]:
+        """Returns (offset, text) insertions of a gcode layer.
+
+        """
+        if layer_nr not in self._layers:
+            return []
+
+        offsets, text_ids = self._layers[layer_nr]
+        texts = self._texts
+        return [(offset, texts[text_id]) for offset, text_id in zip(offsets, text_ids)]
+
+    def hasPatch(self, layer_nr: int) -> bool:
+        return layer_nr in self._layers
+
+    def getLayerNumbers(self) -> List[int]:
+        return sorted(self._layers)
+
+    def apply(self, layer_nr: int, layer: str) -> str:
+        """Returns a gcode layer with its insertions applied.
+
+        """
+        if layer_nr not in self._layers:
+            return layer
+
+        return applyInsertions(layer, self.getInsertions(layer_nr))
+
+    def discard(self, layer_nr: int) -> None:
+        self._layers.pop(layer_nr, None)
+
+    def shift(self, start: int, delta: int) -> None:
+        """Moves patches of every layer from start by delta after layers are inserted or removed.
+
+        """
+        self._layers = {layer_nr + delta if layer_nr >= start else layer_nr: patch
+                        for layer_nr, patch in self._layers.items()}
+
+    def toJson(self, **kwargs: Any) -> str:
+        """Returns patch set as JSON to audit inserted commands.
+
+        Each layer lists [offset, text_id] pairs referring to the shared 'texts' list.
+         + kwargs: Keyword arguments passed to json.dumps.
+        """
+        return json.dumps({
+            "texts": self._texts,
+            "layers": {str(layer_nr): [list(insertion) for insertion in zip(*self._layers[layer_nr])]
+                       for layer_nr in self.getLayerNumbers()}
+        }, **kwargs)
+
+    @classmethod
+    def fromJson(cls, data: str) -> "GcodePatchSet":
+        patches = cls()
+        patch_data = json.loads(data)
+        texts = patch_data["texts"]
+        for layer_nr, insertions in patch_data["layers"].items():
+            patches.addInsertions(int(layer_nr), [(offset, texts[text_id]) for offset, text_id in insertions])
+
+        return patches
+
+
+class PatchedGcodeList(MutableSequence):
+    """Gcode list view that applies a patch set as each layer is read.
+
+    Writers iterate the view one layer at a time, so only a single patched layer exists in memory.
+    Assigning a layer stores the new string and drops its patch.
+     * gcode_list: List of unmodified gcode strings.
+     * patches: GcodePatchSet of insertions into gcode_list.
+    """
+    def __init__(self, gcode_list: List[str], patches: GcodePatchSet) -> None:
+        self._gcode_list = gcode_list
+        self._patches = patches
+
+    def getPatches(self) -> GcodePatchSet:
+        return self._patches
+
+    def materialize(self) -> List[str]:
+        """Returns a plain list of all patched gcode layers.
+
+        """
+        return list(self)
+
+    def __len__(self) -> int:
+        return len(self._gcode_list)
+
+    def __iter__(self) -> Any:
+        apply = self._patches.apply
+        for layer_nr, layer in enumerate(self._gcode_list):
+            yield apply(layer_nr, layer)
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return [self[layer_nr] for layer_nr in range(*index.indices(len(self)))]
+
+        layer_nr = self._layerNumber(index)
+        return self._patches.apply(layer_nr, self._gcode_list[layer_nr])
+
+    def __setitem__(self, index: Any, value: Any) -> None:
+        if isinstance(index, slice):
+            gcode_list = self.materialize()
+            gcode_list[index] = value
+            self._gcode_list, self._patches = gcode_list, GcodePatchSet()
+            return
+
+        layer_nr = self._layerNumber(index)
+        self._gcode_list[layer_nr] = value
+        self._patches.discard(layer_nr)
+
+    def __delitem__(self, index: Any) -> None:
+        if isinstance(index, slice):
+            self[index] = []
+            return
+
+        layer_nr = self._layerNumber(index)
+        del self._gcode_list[layer_nr]
+        self._patches.discard(layer_nr)
+        self._patches.shift(layer_nr + 1, -1)
+
+    def insert(self, index: int, value: str) -> None:
+        layer_nr = min(max(index + len(self) if index < 0 else index, 0), len(self))
+        self._patches.shift(layer_nr, 1)
+        self._gcode_list.insert(layer_nr, value)
+
+    def __add__(self, other: Any) -> List[str]:
+        return self.materialize() + list(other)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, (list, PatchedGcodeList)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return "<PatchedGcodeList layers=%d patched=%d>" % (len(self), len(self._patches.getLayerNumbers()))
+
+    def _layerNumber(self, index: int) -> int:
+        layer_nr = index + len(self) if index < 0 else index
+        if not 0 <= layer_nr < len(self):
+            raise IndexError("gcode layer index out of range")
+        return layer_nr
+
+
+class GcodePipeline:
+    """Applies all enabled Klipper feature stages to gcode in a single streaming pass.
+
+    Each layer is tokenized once into a GcodeLayerIndex; Its marker lines (;LAYER:, ;MESH:, ;TYPE: and
+    tool changes) update the shared gcode state and are dispatched only to stages registered for that event,
+    so disabled stages cost nothing. Layers without any relevant markers are skipped without being indexed.
+    New commands are collected as insertions and each changed layer is rebuilt once from slices,
+    or recorded in a GcodePatchSet so layers are only rebuilt when the gcode is written.
+     * extruder_nr: Integer for the initial extruder of the print.
+     + active_extruders: Set of extruder numbers tracked by tool change commands;
+                         Read when gcode is processed so it can be updated as stages are added.
+    """
+    _event_methods = {
+        "layer": "onLayer",
+        "mesh": "onMesh",
+        "type": "onType",
+        "tool": "onToolChange"
+    }
+    _marker_events = {
+        "LAYER": "layer",
+        "MESH": "mesh",
+        "TYPE": "type",
+        "T": "tool"
+    }
+
+    def __init__(self, extruder_nr: int, active_extruders: Optional[Set[int]]=None) -> None:
+        self._extruder_nr = extruder_nr
+        self._active_extruders = active_extruders if active_extruders is not None else set() # type: Set[int]
+        self._stages = [] # type: List[GcodeStage]
+
+        ## Bound event handlers
+        self._handlers = {} # type: Dict[str, List[Callable]]
+        self._line_handlers = [] # type: List[(GcodeStage, Callable)]
+        self._tool_change_lines = set() # type: Set[str]
+        self._feature_markers = () # type: tuple
+        self._scan_layers = False
+        self._layers_processed = 0
+
+    def addStage(self, stage: GcodeStage) -> None:
+        self._stages.append(stage)
+
+    def getStages(self) -> List[GcodeStage]:
+        return list(self._stages)
+
+    def process(self, gcode_list: List[str], timings: Optional[Dict[str, float]]=None, workers: int=1,
+                patches: Optional[GcodePatchSet]=None) -> bool:
+        """Applies every stage to gcode_list in place and returns true if the gcode changed.
+
+         * gcode_list: List of gcode strings; [0] header, [1] start gcode, then each layer.
+         + timings: Dict updated with time in seconds spent in each stage.
+         + workers: Integer for number of processes used to rewrite layers;
+                    Timings are only recorded by a single worker.
+         + patches: GcodePatchSet to record layer insertions instead of rewriting layers;
+                    Start gcode edits are still made in gcode_list.
+        """
+        ## Start gcode edits
+        # Made before layers are processed so recorded offsets remain valid
+        start_gcode = self._editStartGcode(gcode_list[1])
+        gcode_changed = start_gcode is not gcode_list[1]
+        gcode_list[1] = start_gcode
+
+        ## Gcode layer edits
+        self._bindHandlers(timings if workers <= 1 else None)
+
+        if self._line_handlers or self._scan_layers:
+            start_time = time.perf_counter()
+            self._layers_processed = 0
+
+            if workers > 1:
+                gcode_changed |= self._processLayersParallel(gcode_list, workers, patches)
+            else:
+                gcode_changed |= self._processLayers(gcode_list, patches)
+                Logger.log('d', "Klipper gcode pipeline processed %d of %d layers", self._layers_processed, len(gcode_list))
+
+            if timings is not None:
+                timings["pipeline"] = timings.get("pipeline", 0.0) + time.perf_counter() - start_time
+
+        return gcode_changed
+
+    def processStream(self, gcode_chunks: Iterable[str], timings: Optional[Dict[str, float]]=None,
+                      patches: Optional[GcodePatchSet]=None) -> Iterator[str]:
+        """Yields each gcode chunk with every stage applied as it is read.
+
+        Only a single chunk is held in memory so gcode can be streamed from and to files.
+         * gcode_chunks: Iterable of gcode strings in the same order as the gcode list used by process.
+         + timings: Dict updated with time in seconds spent in each stage.
+         + patches: GcodePatchSet that also records the insertions of each layer.
+        """
+        self._bindHandlers(timings)
+        process_layers = bool(self._line_handlers or self._scan_layers)
+        state = GcodeState(self._extruder_nr)
+        self._layers_processed = 0
+
+        for layer_nr, layer in enumerate(gcode_chunks):
+            if layer_nr == 1:
+                layer = self._editStartGcode(layer)
+
+            if process_layers:
+                start_time = time.perf_counter()
+                insertions = self._processLayer(layer, state)
+                if insertions:
+                    if patches is not None:
+                        patches.addInsertions(layer_nr, insertions)
+                    layer = applyInsertions(layer, insertions)
+                if timings is not None:
+                    timings["pipeline"] = timings.get("pipeline", 0.0) + time.perf_counter() - start_time
+
+            yield layer
+
+    def _editStartGcode(self, start_gcode: str) -> str:
+        """Returns start gcode with the header, prefix and suffix of every stage.
+
+        The same string is returned if no stage changes the start gcode.
+        """
+        for stage in self._stages:
+            if stage.prefix or stage.suffix:
+                start_gcode = stage.prefix + start_gcode + stage.suffix
+
+        ## Adds new commands to start of gcode
+        header = "".join(stage.header for stage in self._stages)
+        if not header:
+            Logger.log('d', "Klipper start gcode commands were not added.")
+        else:
+            start_gcode = header + "\n" + start_gcode
+
+        return start_gcode
+
+    def _bindHandlers(self, timings: Optional[Dict[str, float]]=None) -> None:
+        """Registers event handlers of all stages.
+
+        """
+        self._handlers = {event: [] for event in self._event_methods}
+        self._line_handlers = []
+
+        for stage in self._stages:
+            for event in stage.events:
+                handler = getattr(stage, "onLines" if event == "line" else self._event_methods[event])
+                if timings is not None:
+                    handler = self._timedHandler(handler, stage.name, timings)
+
+                if event == "line":
+                    self._line_handlers.append((stage, handler))
+                else:
+                    self._handlers[event].append(handler)
+
+        # Tool changes are only tracked between multiple active extruders
+        self._tool_change_lines = set()
+        if len(self._active_extruders) > 1:
+            self._tool_change_lines = {"T%d" % extruder_nr for extruder_nr in self._active_extruders}
+        else:
+            self._handlers["tool"] = []
+
+        # Markers that change the gcode state used by active stages
+        self._feature_markers = (";MESH:", ";TYPE:") if self._handlers["mesh"] or self._handlers["type"] else ()
+        # Layers are only indexed if marker events can change the gcode
+        self._scan_layers = bool(self._feature_markers or self._handlers["tool"])
+
+    def _processLayers(self, gcode_list: List[str], patches: Optional[GcodePatchSet]=None) -> bool:
+        """Streams every gcode layer through the stage event handlers.
+
+        """
+        state = GcodeState(self._extruder_nr)
+        gcode_changed = False
+
+        for layer_nr, layer in enumerate(gcode_list):
+            insertions = self._processLayer(layer, state)
+
+            if insertions:
+                self._patchLayer(gcode_list, layer_nr, insertions, patches)
+                gcode_changed = True
+
+        return gcode_changed
+
+    @staticmethod
+    def _patchLayer(gcode_list: List[str], layer_nr: int, insertions: List[tuple],
+                    patches: Optional[GcodePatchSet]) -> None:
+        """Records insertions of a layer in the patch set or rewrites the layer if there is none.
+
+        """
+        if patches is not None:
+            patches.addInsertions(layer_nr, insertions)
+        else:
+            gcode_list[layer_nr] = applyInsertions(gcode_list[layer_nr], insertions)
+
+    def _processLayersParallel(self, gcode_list: List[str], workers: int, patches: Optional[GcodePatchSet]=None) -> bool:
+        """Rewrites gcode layers across a process pool.
+
+        A sequential prepass only records the gcode state at the start of each layer with substring search;
+        Workers index and rewrite contiguous batches of layers. Each batch first replays the layer before it
+        to restore stage states carried between layers. Batches are accepted in order if they started from
+        the gcode and stage states at the end of the previous batch, otherwise they are processed again here.
+        """
+        layer_states = self._prepass(gcode_list)
+        initial_state = (GcodeState(self._extruder_nr).save(), [stage.saveState() for stage in self._stages])
+
+        # Contiguous batches of similar size keep results in order and limit transfers
+        total_size = sum(len(layer) for layer in gcode_list)
+        batch_size = max(total_size // (workers * 4), 1)
+        batches = [] # type: List[(int, int)]
+        batch_start = batch_length = 0
+        for layer_nr, layer in enumerate(gcode_list):
+            batch_length += len(layer)
+            if batch_length >= batch_size or layer_nr == len(gcode_list) - 1:
+                batches.append((batch_start, layer_nr + 1))
+                batch_start, batch_length = layer_nr + 1, 0
+
+        gcode_changed = False
+        expected_state = initial_state
+        reprocessed = 0
+
+        with ProcessPoolExecutor(max_workers = workers, initializer = _initLayerWorker,
+                                 initargs = (self._extruder_nr, self._active_extruders, self._stages)) as executor:
+            futures = [executor.submit(_processLayerBatch, start, gcode_list[max(start - 1, 0):end],
+                                       layer_states[max(start - 1, 0)])
+                       for start, end in batches]
+
+            for (start, end), future in zip(batches, futures):
+                batch_state, changed_layers, end_state = future.result()
+                if batch_state != expected_state: # Replayed layer did not restore the carried states
+                    changed_layers, end_state = self._processBatch(start, gcode_list[start:end], expected_state)
+                    reprocessed += 1
+                expected_state = end_state
+
+                for layer_nr, insertions in changed_layers:
+                    self._patchLayer(gcode_list, layer_nr, insertions, patches)
+                    gcode_changed = True
+
+        for stage, stage_state in zip(self._stages, expected_state[1]):
+            stage.restoreState(stage_state)
+        Logger.log('d', "Klipper gcode pipeline processed %d layers in %d batches with %d workers; %d batches processed again",
+                   len(gcode_list), len(batches), workers, reprocessed)
+
+        return gcode_changed
+
+    def _processBatch(self, start: int, layers: List[str], entry_state: tuple) -> Tuple[List[tuple], tuple]:
+        """Returns (layer_nr, insertions) of each changed layer in a batch and the state after the batch.
+
+         * start: Integer for the number of the first layer in the batch.
+         * entry_state: Tuple of the gcode state and list of stage states at the start of the batch.
+        """
+        state = GcodeState(self._extruder_nr)
+        state.restore(entry_state[0])
+        for stage, stage_state in zip(self._stages, entry_state[1]):
+            stage.restoreState(stage_state)
+
+        changed_layers = [] # type: List[tuple]
+        for index, layer in enumerate(layers):
+            insertions = self._processLayer(layer, state)
+            if insertions:
+                changed_layers.append((start + index, insertions))
+
+        return changed_layers, (state.save(), [stage.saveState() for stage in self._stages])
+
+    def _prepass(self, gcode_list: List[str]) -> List[tuple]:
+        """Returns the gcode state at the start of every gcode layer.
+
+        Only the last marker lines of each layer are found; Layers are not indexed and no handlers are called.
+        """
+        state = GcodeState(self._extruder_nr)
+        layer_states = [] # type: List[tuple]
+
+        for layer in gcode_list:
+            layer_states.append(state.save())
+            self._scanLayerState(layer, state)
+
+        return layer_states
+
+    def _scanLayerState(self, layer: str, state: GcodeState) -> None:
+        """Updates the gcode state to the end of a layer from its last marker lines.
+
+        Markers are read as they would be by a GcodeLayerIndex of the layer in _processLayer.
+        """
+        if self._hasRelevantMarkers(layer):
+            tool_change_lines = self._tool_change_lines
+        elif self._needsLineEvents(layer, state):
+            tool_change_lines = set() # type: Set[str]
+        else:
+            marker_layer_nr = self._findLayerNumber(layer)
+            if marker_layer_nr is not None:
+                state.layer_nr = marker_layer_nr
+            return
+
+        for value in self._markerValues(layer, ";LAYER:"):
+            try:
+                state.layer_nr = int(value)
+                break
+            except ValueError:
+                continue
+        for value in self._markerValues(layer, ";MESH:"):
+            if value != "NONMESH":
+                state.mesh = value
+                break
+        for value in self._markerValues(layer, ";TYPE:"):
+            state.feature_type = value
+            break
+        if tool_change_lines:
+            for value in self._markerValues(layer, "T"):
+                if "T" + value in tool_change_lines:
+                    state.extruder_nr = int(value)
+                    break
+
+    @staticmethod
+    def _markerValues(layer: str, marker: str) -> Iterator[str]:
+        """Yields the rest of each line of a layer starting with a marker, from the last line to the first.
+
+        """
+        search = "\n" + marker
+        end = len(layer)
+        index = layer.rfind(search, 0, end)
+        while index >= 0:
+            line_end = layer.find("\n", index + 1)
+            yield layer[index + len(search):line_end if line_end >= 0 else len(layer)]
+            index = layer.rfind(search, 0, index)
+
+        if layer.startswith(marker):
+            line_end = layer.find("\n")
+            yield layer[len(marker):line_end if line_end >= 0 else len(layer)]
+
+    def _lineHandlers(self, layer_nr: int) -> List[Callable]:
+        """Returns line handlers of stages that accept a gcode layer.
+
+        """
+        return [handler for stage, handler in self._line_handlers if stage.acceptsLayer(layer_nr)]
+
+    def _indexLayer(self, layer: str, state: GcodeState) -> Optional[GcodeLayerIndex]:
+        """Returns index of a layer with relevant markers or None if the layer can be skipped.
+
+        Substring search is used to skip layers before they are indexed.
+        """
+        if not self._hasRelevantMarkers(layer):
+            return None
+
+        return GcodeLayerIndex(layer, state, self._tool_change_lines)
+
+    def _hasRelevantMarkers(self, layer: str) -> bool:
+        """Returns true if a layer has marker lines that can change the gcode.
+
+        """
+        if not self._scan_layers:
+            return False
+
+        return (any(marker in layer for marker in self._feature_markers)
+                or bool(self._tool_change_lines and (layer.startswith("T") or "\nT" in layer)))
+
+    def _needsLineEvents(self, layer: str, state: GcodeState) -> bool:
+        """Returns true if line stages accept any part of a layer.
+
+        """
+        if not self._line_handlers:
+            return False
+        if not layer.startswith(";LAYER:") and self._lineHandlers(state.layer_nr):
+            return True
+
+        marker_layer_nr = self._findLayerNumber(layer)
+        return marker_layer_nr is not None and bool(self._lineHandlers(marker_layer_nr))
+
+    def _carryLayerState(self, layer: str, state: GcodeState) -> None:
+        """Carries gcode state across a layer without relevant markers.
+
+        """
+        marker_layer_nr = self._findLayerNumber(layer)
+        if marker_layer_nr is None:
+            return
+
+        state.layer_nr = marker_layer_nr
+        for handler in self._handlers["layer"]:
+            handler(state)
+
+    def _processLayer(self, layer: str, state: GcodeState, layer_index: Optional[GcodeLayerIndex]=None) -> Optional[List[tuple]]:
+        """Returns (offset, text) insertions sorted by offset or None if the layer is unchanged.
+
+        Updates the gcode state to the end of the layer.
+         + layer_index: Existing GcodeLayerIndex of the layer.
+        """
+        if layer_index is None:
+            layer_index = self._indexLayer(layer, state)
+
+        if layer_index is None: # Layer has no relevant markers
+            if not self._needsLineEvents(layer, state):
+                self._carryLayerState(layer, state)
+                return None
+            layer_index = GcodeLayerIndex(layer, state) # Line stages need the layer
+
+        self._layers_processed += 1
+        handlers = self._handlers
+        insertions = [] # type: List[(int, str)]
+        line_handlers = self._lineHandlers(state.layer_nr) if self._line_handlers else []
+
+        for span in layer_index.spans:
+            state.restore(span[1:5])
+            event = self._marker_events.get(span.marker)
+
+            if event == "layer":
+                for handler in handlers["layer"]:
+                    handler(state)
+                if self._line_handlers:
+                    line_handlers = self._lineHandlers(state.layer_nr)
+
+            elif event and handlers[event]:
+                line = layer[span.start:span.line_end]
+                edit = None
+                for handler in handlers[event]:
+                    edit = self._mergeEdit(edit, handler(line, state))
+                if edit is not None:
+                    self._addInsertions(insertions, edit, span.start, span.line_end)
+
+            if line_handlers: # All other lines of the span
+                self._lineEvents(layer, span.line_end + 1 if span.marker else span.start, span.end,
+                                 state, line_handlers, insertions)
+
+        if not insertions:
+            return None
+        if line_handlers or self._line_handlers:
+            insertions.sort(key = lambda insertion: insertion[0]) # Stable merge with line stage edits
+
+        return insertions
+
+    def _lineEvents(self, layer: str, start: int, end: int, state: GcodeState,
+                    line_handlers: List[Callable], insertions: List[tuple]) -> None:
+        """Sends the lines between two offsets of a layer to the line handlers.
+
+        """
+        if start >= end:
+            return
+
+        for handler in line_handlers:
+            for line_start, line_end, edit in handler(layer, start, end, state):
+                self._addInsertions(insertions, edit, line_start, line_end)
+
+    @staticmethod
+    def _addInsertions(insertions: List[tuple], edit: LineEdit, line_start: int, line_end: int) -> None:
+        """Adds text insertions of a line edit in offset order.
+
+        """
+        if edit.before is not None:
+            insertions.append((line_start, edit.before + "\n"))
+        if edit.append is not None:
+            insertions.append((line_end, edit.append))
+        if edit.after is not None:
+            insertions.append((line_end, "\n" + edit.after))
+
+    @staticmethod
+    def _findLayerNumber(layer: str) -> Optional[int]:
+        """Returns number of the ;LAYER: marker line in a gcode layer or None if there is none.
+
+        """
+        index = layer.find(";LAYER:")
+        while index > 0 and layer[index - 1] != "\n": # Marker must start a line
+            index = layer.find(";LAYER:", index + 1)
+        if index < 0:
+            return None
+
+        end = layer.find("\n", index)
+        try:
+            return int(layer[index + 7:end if end >= 0 else len(layer)])
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _mergeEdit(edit: Optional[LineEdit], new_edit: Optional[LineEdit]) -> Optional[LineEdit]:
+        """Combines line edits from multiple stages in stage order.
+
+        """
+        if edit is None or new_edit is None:
+            return new_edit if edit is None else edit
+
+        return LineEdit(*(
+            "\n".join(text for text in (old, new) if text is not None) if (old, new) != (None, None) else None
+            for old, new in zip(edit, new_edit)))
+
+    @staticmethod
+    def _timedHandler(handler: Callable, name: str, timings: Dict[str, float]) -> Callable:
+        """Wraps an event handler to accumulate its run time for benchmarking.
+
+        """
+        def timedHandler(*args: Any) -> Any:
+            start_time = time.perf_counter()
+            result = handler(*args)
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start_time
+            return result
+
+        return timedHandler
+
+
+## Parallel layer workers
+_worker_pipeline = None # type: Optional[GcodePipeline]
+_worker_stage_states = [] # type: List[Any]
+
+def _initLayerWorker(extruder_nr: int, active_extruders: Set[int], stages: List[GcodeStage]) -> None:
+    """Creates the gcode pipeline used by a worker process.
+
+    """
+    global _worker_pipeline, _worker_stage_states
+    _worker_pipeline = GcodePipeline(extruder_nr, active_extruders)
+    for stage in stages:
+        _worker_pipeline.addStage(stage)
+    _worker_pipeline._bindHandlers()
+    _worker_stage_states = [stage.saveState() for stage in stages] # Stages have not processed any layer
+
+def _processLayerBatch(start: int, layers: List[str], layer_state: tuple) -> Tuple[tuple, List[tuple], tuple]:
+    """Returns the states at the start of a batch, (layer_nr, insertions) of each changed layer and the end states.
+
+    Layers include the layer before the batch unless it starts at 0; It is processed from its
+    gcode state with the initial stage states to restore stage states carried between layers.
+    """
+    pipeline = _worker_pipeline
+    batch_state = (layer_state, _worker_stage_states)
+    if start > 0:
+        batch_state = pipeline._processBatch(start - 1, layers[:1], batch_state)[1]
+        layers = layers[1:]
+
+    changed_layers, end_state = pipeline._processBatch(start, layers, batch_state)
+
+    return batch_state, changed_layers, end_state
@@ -0,0 +1,522 @@
+# Copyright (c) 2023 J.Jarrard / JJFX
+# The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
+
+'''
+KLIPPER HEADLESS POST-PROCESSING
+--------------------------------
+Applies Klipper settings to gcode files on disk without launching Cura; Requires Python 3.7 or newer.
+    python -m KlipperSettingsPlugin print.gcode settings.json -o print_klipper.gcode
+
+Settings are read from a JSON file using the keys of klipper_settings.def.json;
+Missing settings use the definition 'value' or 'default_value' as in Cura.
+Per-extruder and per-object settings are optional nested dicts:
+    {
+        "klipper_pressure_advance_enable": true,
+        "klipper_pressure_advance_factor": 0.04,
+        "extruders": {"1": {"klipper_pressure_advance_factor": 0.05}},
+        "meshes": {"part.stl": {"extruder_nr": 0, "klipper_pressure_advance_wall_0": 0.03}}
+    }
+
+Input files are memory-mapped and streamed to the output one layer at a time.
+A directory or glob pattern processes every file on a process pool:
+    python -m KlipperSettingsPlugin "prints/*.gcode" settings.json -o processed/ --workers 4
+Layers of a single large file can be rewritten on a process pool instead of being streamed:
+    python -m KlipperSettingsPlugin print.gcode settings.json -o print_klipper.gcode --layer-workers 4
+Commands inserted into each layer can be saved as a JSON patch set to audit the changes:
+    python -m KlipperSettingsPlugin print.gcode settings.json --dump-patches print.patches.json
+'''
+
+import argparse
+import glob
+import itertools
+import json
+import logging
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, Optional
+
+from .KlipperGcode import GcodePatchSet, GcodePipeline, Logger, PatchedGcodeList
+from .KlipperProcessor import KlipperGcodeProcessor, processed_marker
+from .KlipperDefinitions import definition_file, flattenDefinitions, parseDefinitions
+
+comment = ";KlipperSettingsPlugin" # Plugin signature added to all new gcode commands
+patches_suffix = ".patches.json" # Patch sets of batch processed files
+
+# Cura settings used by klipper settings; Values are the Cura defaults
+_cura_definitions = {
+    "extruder_nr": {"default_value": 0},
+    "machine_start_gcode": {"default_value": None}, # Start gcode of the file is searched instead
+    "layer_height_0": {"default_value": 0.3},
+    "material_bed_temperature_layer_0": {"default_value": 60},
+    "material_print_temperature": {"default_value": 210},
+    "material_print_temperature_layer_0": {"default_value": 0},
+    "retraction_amount": {"default_value": 6.5},
+    "retraction_speed": {"default_value": 25},
+    "retraction_retract_speed": {"default_value": 25, "value": "retraction_speed"},
+    "retraction_prime_speed": {"default_value": 25, "value": "retraction_speed"}
+}
+
+
+def loadSettingDefinitions(file_path: str=definition_file) -> Dict[str, Dict[str, Any]]:
+    """Returns flat dict of all setting definitions including the Cura settings they depend on.
+
+    """
+    definitions = OrderedDict(_cura_definitions) # type: Dict[str, Dict[str, Any]]
+    definitions.update(flattenDefinitions(parseDefinitions(file_path)))
+
+    return definitions
+
+
+class SettingStack:
+    """Setting values with the property interface of a Cura container stack.
+
+    Values are resolved from the stack, then its parent stack, then the setting definition;
+    Definition 'value' functions are only resolved when they refer to another setting.
+     * values: Dict of setting keys and values.
+     * definitions: Dict of setting definitions from loadSettingDefinitions.
+     + parent: SettingStack used for values not set in this stack.
+    """
+    _setting_reference = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+    def __init__(self, values: Dict[str, Any], definitions: Dict[str, Dict[str, Any]],
+                 parent: Optional["SettingStack"]=None) -> None:
+        self._values = values
+        self._definitions = definitions
+        self._parent = parent
+
+    def getProperty(self, key: str, property_name: str) -> Any:
+        if property_name != "value":
+            return self._definitions.get(key, {}).get(property_name)
+
+        stack = self # type: Optional[SettingStack]
+        while stack is not None:
+            if key in stack._values:
+                return stack._values[key]
+            stack = stack._parent
+
+        definition = self._definitions.get(key)
+        if definition is None:
+            Logger.log('w', "Unknown setting: %s", key)
+            return None
+
+        value_function = definition.get("value")
+        if isinstance(value_function, str) and self._setting_reference.match(value_function) and value_function != key:
+            return self.getProperty(value_function, "value")
+
+        return definition.get("default_value")
+
+    def hasValue(self, key: str) -> bool:
+        """Returns true if a setting is set in this stack rather than inherited.
+
+        """
+        return key in self._values
+
+
+class SceneNode:
+    """Mesh object with per-object settings and the decorations of a Cura scene node.
+
+     * name: String of the mesh name used in ;MESH: gcode comments.
+     + settings: Dict of per-object setting keys and values.
+     + extruder_nr: Integer for the extruder that prints the mesh.
+    """
+    def __init__(self, name: str, settings: Optional[Dict[str, Any]]=None, extruder_nr: int=0) -> None:
+        self._name = name
+        self._settings = _MeshSettingContainer(settings or {})
+        self._extruder_nr = extruder_nr
+
+    def getName(self) -> str:
+        return self._name
+
+    def callDecoration(self, function: str) -> Any:
+        if function == "getStack":
+            return self._settings
+        if function == "getActiveExtruderPosition":
+            return str(self._extruder_nr)
+        return None
+
+
+class _MeshSettingContainer:
+    """Per-object settings with the instance interface of the top container of a Cura stack.
+
+    """
+    _SettingInstance = namedtuple("SettingInstance", ["value"])
+
+    def __init__(self, values: Dict[str, Any]) -> None:
+        self._values = values
+
+    def getTop(self) -> "_MeshSettingContainer":
+        return self
+
+    def getInstance(self, key: str) -> Any:
+        if key not in self._values:
+            return None
+        return self._SettingInstance(self._values[key])
+
+
+class HeadlessSettings:
+    """Global, extruder and per-object settings loaded from a JSON settings file.
+
+     * settings_dict: Dict of global setting values with optional 'extruders' and 'meshes' dicts.
+     + definitions: Dict of setting definitions from loadSettingDefinitions.
+    """
+    def __init__(self, settings_dict: Dict[str, Any], definitions: Optional[Dict[str, Dict[str, Any]]]=None) -> None:
+        settings_dict = dict(settings_dict)
+        extruder_dict = settings_dict.pop("extruders", None) or {"0": {}}
+        mesh_dict = settings_dict.pop("meshes", None) or {}
+
+        self._definitions = definitions if definitions is not None else loadSettingDefinitions()
+        self.global_stack = SettingStack(settings_dict, self._definitions)
+
+        self.extruder_stacks = OrderedDict() # type: Dict[int, SettingStack]
+        for extruder_nr in sorted(extruder_dict, key = int):
+            values = dict(extruder_dict[extruder_nr], extruder_nr = int(extruder_nr))
+            self.extruder_stacks[int(extruder_nr)] = SettingStack(values, self._definitions, self.global_stack)
+
+        self.mesh_settings = OrderedDict(mesh_dict) # type: Dict[str, Dict[str, Any]]
+        self._default_extruder_nr = int(self.global_stack.getProperty("extruder_nr", "value"))
+
+    @classmethod
+    def fromFile(cls, file_path: str, definitions: Optional[Dict[str, Dict[str, Any]]]=None) -> "HeadlessSettings":
+        with open(file_path, encoding = "utf-8") as f:
+            return cls(json.load(f), definitions)
+
+    def getExtruderStack(self, extruder_nr: int) -> SettingStack:
+        """Returns stack of an extruder or a new stack that inherits all global values.
+
+        """
+        if extruder_nr not in self.extruder_stacks:
+            return SettingStack({"extruder_nr": extruder_nr}, self._definitions, self.global_stack)
+
+        return self.extruder_stacks[extruder_nr]
+
+    def getMeshNodes(self) -> List[SceneNode]:
+        """Returns scene nodes of all per-object settings.
+
+        Gcode is assumed to contain an object, so a node without settings is returned if there are none.
+        """
+        if not self.mesh_settings:
+            return [SceneNode("")]
+
+        return [SceneNode(mesh_name, {key: value for key, value in mesh_settings.items() if key != "extruder_nr"},
+                          int(mesh_settings.get("extruder_nr", self._default_extruder_nr)))
+                for mesh_name, mesh_settings in self.mesh_settings.items()]
+
+    def createProcessor(self, warnings: Optional[List[str]]=None) -> KlipperGcodeProcessor:
+        """Returns gcode processor for these settings.
+
+         + warnings: List of warning messages to add to.
+        """
+        return KlipperGcodeProcessor(self.global_stack, list(self.extruder_stacks.values()), self.getMeshNodes(),
+            comment, active_extruder_stack = self.getExtruderStack(self._default_extruder_nr),
+            get_extruder_stack = self.getExtruderStack, warnings = warnings)
+
+
+def buildPipeline(settings: HeadlessSettings, start_gcode: str, warnings: Optional[List[str]]=None) -> Optional[GcodePipeline]:
+    """Returns gcode pipeline with every enabled Klipper feature or None if settings are invalid.
+
+     * settings: HeadlessSettings to apply.
+     * start_gcode: String of the start gcode in the file to process.
+     + warnings: List of warning messages to add to.
+    """
+    gcode_processor = settings.createProcessor(warnings)
+    gcode_pipeline = gcode_processor.buildPipeline(start_gcode)
+
+    if warnings is not None:
+        warnings.extend(message.text for message in gcode_processor.messages if message.msg_type == "WARNING")
+
+    return gcode_pipeline
+
+
+def mappedGcodeChunks(gcode_map: mmap.mmap) -> Iterator[str]:
+    """Yields gcode of a memory-mapped file in the chunks of a Cura gcode list.
+
+    [0] is the block of comment lines at the start of the file, [1] the start gcode
+    up to the first ;LAYER: line, then one chunk for each layer. Only one chunk is decoded at a time.
+    """
+    size = len(gcode_map)
+
+    ## Header comments
+    position = 0
+    while position < size and gcode_map[position:position + 1] == b";" and (
+            gcode_map[position:position + 7] != b";LAYER:"):
+        line_end = gcode_map.find(b"\n", position)
+        position = size if line_end < 0 else line_end + 1
+    yield _decodeGcode(gcode_map[:position])
+
+    ## Start gcode and layers
+    chunk_start = position
+    if gcode_map[position:position + 7] == b";LAYER:": # File has no start gcode
+        yield ""
+    while chunk_start < size:
+        chunk_end = gcode_map.find(b"\n;LAYER:", chunk_start)
+        chunk_end = size if chunk_end < 0 else chunk_end + 1
+        yield _decodeGcode(gcode_map[chunk_start:chunk_end])
+        chunk_start = chunk_end
+
+
+def _decodeGcode(data: bytes) -> str:
+    return data.decode("utf-8", "surrogateescape") # Invalid bytes are written back unchanged
+
+
+def processGcodeFile(input_path: str, output_path: str, settings: HeadlessSettings,
+                     timings: Optional[Dict[str, float]]=None, layer_workers: int=1,
+                     patches_path: Optional[str]=None) -> Dict[str, Any]:
+    """Applies Klipper settings to a gcode file and returns a dict of processing results.
+
+    The input is memory-mapped and processed layers are streamed to a temporary file
+    that replaces the output when complete, so the output may be the input file.
+    Files with the processed marker are skipped.
+     + timings: Dict updated with time in seconds spent in each stage.
+     + layer_workers: Integer for number of processes used to rewrite layers;
+                      All layers are read into memory if more than 1.
+     + patches_path: Path of a JSON file for the GcodePatchSet of inserted commands.
+    """
+    start_time = time.perf_counter()
+    result = {"input": input_path, "output": output_path, "skipped": False,
+              "bytes": os.path.getsize(input_path), "warnings": []} # type: Dict[str, Any]
+
+    if result["bytes"] == 0:
+        raise ValueError("Gcode file is empty: %s" % input_path)
+
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    temp_file = tempfile.NamedTemporaryFile("wb", dir = output_dir, suffix = ".gcode.tmp", delete = False)
+    gcode_patches = GcodePatchSet() if patches_path else None
+    try:
+        with temp_file, open(input_path, "rb") as input_file:
+            with mmap.mmap(input_file.fileno(), 0, access = mmap.ACCESS_READ) as gcode_map:
+                gcode_chunks = mappedGcodeChunks(gcode_map)
+                header = next(gcode_chunks)
+                if processed_marker.strip() in header:
+                    result["skipped"] = True
+                else:
+                    start_gcode = next(gcode_chunks, "")
+                    gcode_pipeline = buildPipeline(settings, start_gcode, result["warnings"])
+                    if gcode_pipeline is None:
+                        raise ValueError("Klipper settings could not be applied to %s" % input_path)
+
+                    if gcode_pipeline.getStages():
+                        header += processed_marker
+                    if layer_workers > 1:
+                        gcode_list = [header, start_gcode] + list(gcode_chunks)
+                        gcode_pipeline.process(gcode_list, timings, layer_workers, gcode_patches)
+                        processed_chunks = iter(PatchedGcodeList(gcode_list, gcode_patches) if gcode_patches is not None
+                                                else gcode_list) # type: Iterator[str]
+                    else:
+                        processed_chunks = gcode_pipeline.processStream(
+                            itertools.chain([header, start_gcode], gcode_chunks), timings, gcode_patches)
+                    for chunk in processed_chunks:
+                        temp_file.write(chunk.encode("utf-8", "surrogateescape"))
+
+        if not result["skipped"]:
+            os.replace(temp_file.name, output_path)
+            if gcode_patches is not None:
+                with open(patches_path, "w", encoding = "utf-8") as patches_file:
+                    patches_file.write(gcode_patches.toJson(indent = 1))
+                result["patches"] = patches_path
+    finally:
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+
+    result["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+def findGcodeFiles(path: str) -> List[str]:
+    """Returns sorted gcode files of a directory or glob pattern, or the path of a single file.
+
+    """
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.gcode")))
+    if glob.has_magic(path):
+        return sorted(file_path for file_path in glob.glob(path) if os.path.isfile(file_path))
+
+    return [path]
+
+
+## Batch process workers
+_batch_settings = None # type: Optional[HeadlessSettings]
+
+def _initBatchWorker(settings: HeadlessSettings, verbose: bool=False) -> None:
+    """Stores the settings used by a worker process.
+
+    """
+    global _batch_settings
+    _batch_settings = settings
+    if verbose:
+        logging.basicConfig(level = logging.DEBUG, format = "%(levelname)s: %(message)s")
+
+def _processBatchFile(input_path: str, output_path: str, record_timings: bool=False,
+                      patches_path: Optional[str]=None) -> Dict[str, Any]:
+    """Returns results of processing a gcode file; Errors are returned rather than raised.
+
+    Any error only fails its own file, so the rest of a batch is still processed.
+    """
+    timings = {} if record_timings else None # type: Optional[Dict[str, float]]
+    try:
+        result = processGcodeFile(input_path, output_path, _batch_settings, timings, patches_path = patches_path)
+    except (OSError, ValueError) as e:
+        error = str(e)
+    except Exception as e: # Unexpected errors are logged with a traceback
+        Logger.logException('e', "Could not process %s", input_path)
+        error = "Could not process %s: %r" % (input_path, e)
+    else:
+        result["timings"] = timings
+        return result
+
+    return {"input": input_path, "output": output_path, "skipped": False, "bytes": 0, "warnings": [],
+            "seconds": 0.0, "error": error}
+
+
+def processGcodeFiles(files: List[str], settings: HeadlessSettings, output_dir: Optional[str]=None,
+                      workers: int=1, record_timings: bool=False, verbose: bool=False,
+                      patches_dir: Optional[str]=None) -> Iterator[Dict[str, Any]]:
+    """Applies Klipper settings to many gcode files and yields the results of each file as it completes.
+
+    Files are processed in parallel by a process pool if workers is more than 1.
+     * files: List of gcode file paths.
+     * settings: HeadlessSettings to apply to every file.
+     + output_dir: Directory for processed files; Files are replaced if not set.
+     + workers: Integer for number of processes.
+     + record_timings: True adds time spent in each stage to the results of each file.
+     + patches_dir: Directory for the patch set of each processed file, named with patches_suffix.
+    """
+    jobs = [(file_path, os.path.join(output_dir, os.path.basename(file_path)) if output_dir else file_path,
+             os.path.join(patches_dir, os.path.basename(file_path) + patches_suffix) if patches_dir else None)
+            for file_path in files]
+
+    if workers <= 1 or len(jobs) <= 1:
+        _initBatchWorker(settings)
+        for input_path, output_path, patches_path in jobs:
+            yield _processBatchFile(input_path, output_path, record_timings, patches_path)
+        return
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = _initBatchWorker,
+                             initargs = (settings, verbose)) as executor:
+        futures = [executor.submit(_processBatchFile, input_path, output_path, record_timings, patches_path)
+                   for input_path, output_path, patches_path in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main(argv: Optional[List[str]]=None) -> int:
+    """Command line entry point.
+
+    """
+    parser = argparse.ArgumentParser(prog = "python -m KlipperSettingsPlugin",
+        description = "Apply Klipper settings to gcode files without Cura.")
+    parser.add_argument("gcode", help = "gcode file, directory of gcode files or quoted glob pattern to process")
+    parser.add_argument("settings", help = "JSON file of klipper_settings.def.json setting values")
+    parser.add_argument("-o", "--output", help = "output gcode file, or directory if processing multiple files; "
+                                                 "replaces the input files if not set")
+    parser.add_argument("-j", "--workers", type = int, default = os.cpu_count() or 1,
+                        help = "number of processes used for multiple files (default: %(default)s)")
+    parser.add_argument("--layer-workers", type = int, default = 1,
+                        help = "number of processes used to rewrite the layers of a single file (default: %(default)s)")
+    parser.add_argument("--dump-patches", metavar = "PATH",
+                        help = "write commands inserted into each layer as a JSON patch set to PATH; "
+                               "a directory of patch sets if processing multiple files")
+    parser.add_argument("--timings", action = "store_true", help = "print time spent in each feature")
+    parser.add_argument("-v", "--verbose", action = "store_true", help = "show debug messages")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, format = "%(levelname)s: %(message)s")
+
+    files = findGcodeFiles(args.gcode)
+    batch_mode = len(files) != 1 or os.path.isdir(args.gcode) or glob.has_magic(args.gcode)
+    if not files:
+        print("Error: No gcode files found: %s" % args.gcode, file = sys.stderr)
+        return 1
+
+    output_dir = None # type: Optional[str]
+    if batch_mode and args.output:
+        output_dir = args.output
+        os.makedirs(output_dir, exist_ok = True)
+    if batch_mode and args.dump_patches:
+        os.makedirs(args.dump_patches, exist_ok = True)
+
+    try:
+        settings = HeadlessSettings.fromFile(args.settings)
+    except (OSError, ValueError) as e:
+        print("Error: %s" % e, file = sys.stderr)
+        return 1
+
+    if not batch_mode:
+        result = _processFile(files[0], args.output or files[0], settings, args.timings, args.layer_workers,
+                              args.dump_patches)
+        return 1 if "error" in result else 0
+
+    start_time = time.perf_counter()
+    warnings = OrderedDict() # type: Dict[str, None]
+    timings = {} # type: Dict[str, float]
+    processed = skipped = failed = processed_bytes = 0
+
+    for result in processGcodeFiles(files, settings, output_dir, args.workers, args.timings, args.verbose,
+                                    args.dump_patches):
+        if "error" in result:
+            failed += 1
+            print("Error: %s" % result["error"], file = sys.stderr)
+            continue
+
+        warnings.update(OrderedDict.fromkeys(result["warnings"])) # Same settings warn once
+        if result["skipped"]:
+            skipped += 1
+            Logger.log('i', "Skipped %s: already processed", result["input"])
+        else:
+            processed += 1
+            processed_bytes += result["bytes"]
+            for name, seconds in (result["timings"] or {}).items():
+                timings[name] = timings.get(name, 0.0) + seconds
+
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    _printWarnings(list(warnings))
+    print("Processed %d files, skipped %d, failed %d in %.2f s with %d workers" % (
+        processed, skipped, failed, elapsed, min(max(args.workers, 1), len(files))))
+    print("Throughput: %.1f files/s, %.1f MB/s" % (processed / elapsed, processed_bytes / 1e6 / elapsed))
+    _printTimings(timings)
+
+    return 1 if failed else 0
+
+
+def _processFile(input_path: str, output_path: str, settings: HeadlessSettings, record_timings: bool,
+                 layer_workers: int=1, patches_path: Optional[str]=None) -> Dict[str, Any]:
+    """Processes a single gcode file and prints its results.
+
+    """
+    timings = {} if record_timings else None # type: Optional[Dict[str, float]]
+    try:
+        result = processGcodeFile(input_path, output_path, settings, timings, layer_workers, patches_path)
+    except (OSError, ValueError) as e:
+        print("Error: %s" % e, file = sys.stderr)
+        return {"error": str(e)}
+    except Exception as e: # Unexpected errors are logged with a traceback
+        Logger.logException('e', "Could not process %s", input_path)
+        print("Error: Could not process %s: %r" % (input_path, e), file = sys.stderr)
+        return {"error": repr(e)}
+
+    _printWarnings(result["warnings"])
+    if result["skipped"]:
+        print("Skipped %s: already processed" % result["input"])
+    else:
+        print("Processed %s -> %s (%.1f MB in %.2f s)" % (
+            result["input"], result["output"], result["bytes"] / 1e6, result["seconds"]))
+        if "patches" in result:
+            print("Patch set written to %s" % result["patches"])
+    _printTimings(timings or {})
+
+    return result
+
+
+def _printWarnings(warnings: List[str]) -> None:
+    for warning in warnings:
+        print("Warning: %s" % re.sub(r"<[^>]+>", "", warning).lstrip("• "), file = sys.stderr)
+
+
+def _printTimings(timings: Dict[str, float]) -> None:
+    for name, seconds in sorted(timings.items()):
+        print("  %-20s %.3f s" % (name, seconds))
@@ -0,0 +1,162 @@
+# Copyright (c) 2023 J.Jarrard / JJFX
+# The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
+
+'''
+KLIPPER SETTING OVERRIDES
+-------------------------
+Suggested tuning tower settings are held in override containers that replace the user changes
+container of each affected stack while active. Override containers read through to the user
+changes they replace, so user values are never copied, backed up or modified by a preset.
+'''
+
+from collections import OrderedDict
+from typing import Any, Dict, Set, Tuple
+
+from UM.Logger import Logger
+from UM.Settings.InstanceContainer import InstanceContainer
+
+
+class OverrideInstanceContainer(InstanceContainer):
+    """User changes container with override values layered over the user changes it replaces.
+
+    Settings without an override are read from the user changes; Changes made while active are
+    copied on write into this container and carried back when the override is removed.
+     * user_changes: InstanceContainer of user changes in the stack.
+    """
+    def __init__(self, user_changes: InstanceContainer) -> None:
+        # Same ID as the user changes so a saved stack always refers to the user changes
+        super().__init__(user_changes.getId())
+        self._user_changes = user_changes
+        self._override_keys = set() # type: Set[str]
+        # User values hidden by overrides or resets
+        self._hidden_keys = set() # type: Set[str]
+
+        self.setMetaData(dict(user_changes.getMetaData()))
+        self.setName(user_changes.getName())
+        self.setDefinition(user_changes.getDefinition().getId())
+
+    def getUserChanges(self) -> InstanceContainer:
+        return self._user_changes
+
+    def setOverride(self, key: str, value: Any) -> None:
+        """Sets override value of a setting.
+
+        """
+        self._override_keys.add(key)
+        self._hidden_keys.discard(key)
+        self.setProperty(key, "value", value)
+
+    def hideUserValue(self, key: str) -> None:
+        """Hides user value of a setting so it follows its parent or default value.
+
+        """
+        self._override_keys.add(key)
+        self.removeInstance(key)
+        self._hidden_keys.add(key)
+
+    def applyUserEdits(self) -> None:
+        """Copies changes made while active, except to overridden settings, to the user changes.
+
+        """
+        for key in set(super().getAllKeys()) - self._override_keys:
+            self._user_changes.setProperty(key, "value", super().getProperty(key, "value"))
+        for key in self._hidden_keys - self._override_keys:
+            self._user_changes.removeInstance(key)
+
+    def _isOwnKey(self, key: str) -> bool:
+        return key in self._instances or key in self._hidden_keys
+
+    def getProperty(self, key: str, property_name: str, context: Any=None) -> Any:
+        if self._isOwnKey(key):
+            return super().getProperty(key, property_name, context)
+        return self._user_changes.getProperty(key, property_name, context)
+
+    def hasProperty(self, key: str, property_name: str) -> bool:
+        if self._isOwnKey(key):
+            return super().hasProperty(key, property_name)
+        return self._user_changes.hasProperty(key, property_name)
+
+    def getInstance(self, key: str) -> Any:
+        if self._isOwnKey(key):
+            return super().getInstance(key)
+        return self._user_changes.getInstance(key)
+
+    def getAllKeys(self) -> Set[str]:
+        return (set(self._user_changes.getAllKeys()) - self._hidden_keys) | set(super().getAllKeys())
+
+    def setProperty(self, key: str, property_name: str, property_value: Any, *args: Any, **kwargs: Any) -> None:
+        if property_name == "value": # New value replaces a user value hidden by a reset
+            self._hidden_keys.discard(key)
+        super().setProperty(key, property_name, property_value, *args, **kwargs)
+
+    def removeInstance(self, key: str, postpone_emit: bool=False) -> None:
+        if key in self._instances:
+            super().removeInstance(key, postpone_emit)
+        if key not in self._hidden_keys and self._user_changes.getInstance(key) is not None:
+            self._hidden_keys.add(key) # User value is only removed when the override is removed
+            for property_name in ["value", "state"]:
+                self.propertyChanged.emit(key, property_name)
+
+
+class SettingOverrideLayer:
+    """Suggested setting values over the user changes of container stacks.
+
+    Overrides are collected for each stack, then added or removed by replacing
+    the user changes container of every stack.
+    """
+    def __init__(self) -> None:
+        self._containers = OrderedDict() # type: Dict[str, Tuple[Any, OverrideInstanceContainer]]
+        self._added = False
+
+    def isActive(self) -> bool:
+        return bool(self._containers)
+
+    def setValue(self, stack: Any, key: str, value: Any) -> None:
+        """Sets override value of a setting in the stack.
+
+         * stack: Global or extruder container stack.
+        """
+        self._getContainer(stack).setOverride(key, value)
+
+    def hideUserValue(self, stack: Any, key: str) -> None:
+        """Hides user value of a setting in the stack while the override is active.
+
+         * stack: Global or extruder container stack.
+        """
+        self._getContainer(stack).hideUserValue(key)
+
+    def _getContainer(self, stack: Any) -> OverrideInstanceContainer:
+        if stack.getId() not in self._containers:
+            container = OverrideInstanceContainer(stack.userChanges)
+            self._containers[stack.getId()] = (stack, container)
+            if self._added: # Layer already active
+                stack.setUserChanges(container)
+        return self._containers[stack.getId()][1]
+
+    def add(self) -> None:
+        """Places override containers on top of their stacks.
+
+        """
+        if self._added or not self._containers: # Nothing to add
+            return
+        for stack, container in self._containers.values():
+            stack.setUserChanges(container)
+        self._added = True
+        Logger.log('d', "Setting override added to %d stacks", len(self._containers))
+
+    def remove(self) -> bool:
+        """Restores user changes containers, including changes made while the override was active.
+
+        Returns true if an override was removed.
+        """
+        if not self._containers:
+            self._added = False
+            return False
+        for stack, container in self._containers.values():
+            container.applyUserEdits()
+            if self._added:
+                stack.setUserChanges(container.getUserChanges())
+        Logger.log('d', "Setting override removed from %d stacks", len(self._containers))
+        self._containers.clear()
+        self._added = False
+        return True
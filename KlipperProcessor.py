@@ -0,0 +1,547 @@
+# Copyright (c) 2023 J.Jarrard / JJFX
+# The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
+
+'''
+KLIPPER GCODE PROCESSOR
+-----------------------
+Builds the gcode pipeline of every enabled Klipper feature from setting stacks.
+Only the Cura stack and scene node interfaces used to read setting values are required,
+so the plugin, command line and benchmarks share the same processing with real or stand-in objects.
+'''
+
+import re
+from collections import namedtuple, OrderedDict
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from .KlipperGcode import GcodePipeline, GcodeStage, ZOffsetStage, FirmwareRetractionStage, PressureAdvanceStage
+from .KlipperGcode import GcodePatchSet, PatchedGcodeList, Logger
+from .KlipperGcode import GcodeCommandIndex, indexGcodeCommands, gcodeSearch, gcodeUiSupport, gcodePressureAdvance, gcodeVelocityLimits
+from .KlipperGcode import gcodeFirmwareRetraction, gcodeInputShaper, gcodeTuningTower, pressureAdvanceFeatures
+from .KlipperGcode import pressure_advance_setting_key, tuning_tower_setting_key, velocity_limit_setting_key
+from .KlipperGcode import firmware_retraction_setting_key, input_shaper_setting_key
+
+processed_marker = ";KLIPPERSETTINGSPROCESSED\n"
+
+# Message for the user with the arguments of KlipperSettingsPlugin.showMessage
+GcodeMessage = namedtuple("GcodeMessage", ["text", "msg_type", "msg_title", "stack_msg"])
+
+# Settings that enable a Klipper feature without the experimental features control
+feature_setting_keys = [
+    'machine_firmware_retract',
+    'klipper_pressure_advance_enable',
+    'klipper_smooth_time_enable',
+    'klipper_velocity_limits_enable',
+    'klipper_input_shaper_enable',
+    'klipper_tuning_tower_enable',
+    'klipper_z_offset_control_enable'
+]
+experimental_setting_keys = ['klipper_mesh_calibrate_enable', 'klipper_ui_temp_support_enable']
+
+
+class SettingsSnapshot(namedtuple("SettingsSnapshot", ["global_values", "extruder_values", "used_extruders",
+                                                       "active_extruder_nr", "mesh_values", "extruder_keys"])):
+    """Read-only values of every Klipper setting used to process gcode.
+
+    Values are read from the stacks once and shared by every build plate;
+    Only settings of enabled features are read.
+     * global_values: Mapping of global setting keys and values.
+     * extruder_values: Mapping of extruder numbers and their setting values.
+     * used_extruders: Tuple of extruder numbers used by the print in stack order.
+     * active_extruder_nr: Integer for the active extruder number.
+     * mesh_values: Tuple of (mesh_name, extruder_nr, values) for per-object pressure advance settings.
+     * extruder_keys: Tuple of setting keys read from each extruder stack.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def capture(cls, global_stack: Any, used_extruder_stacks: List[Any], mesh_nodes: List[Any],
+                active_extruder_stack: Any,
+                get_mesh_values: Optional[Callable[[], Iterable[Tuple[str, int, Mapping[str, Any]]]]]=None
+                ) -> "SettingsSnapshot":
+        """Returns snapshot of the current setting values.
+
+        Stacks and scene nodes have the same interface as KlipperGcodeProcessor.
+         + get_mesh_values: Function returning per-object values already read from the mesh nodes;
+                            Only called if per-object settings are used.
+        """
+        global_keys = feature_setting_keys + ['klipper_experimental_enable'] + experimental_setting_keys
+        global_values = _readValues(global_stack, global_keys)
+        extruder_keys = ['extruder_nr']
+
+        if global_values['klipper_experimental_enable']:
+            if global_values['klipper_mesh_calibrate_enable']:
+                global_keys += ['machine_start_gcode', 'material_bed_temperature_layer_0']
+            if global_values['klipper_ui_temp_support_enable']:
+                extruder_keys += ['material_bed_temperature_layer_0', 'material_print_temperature',
+                                  'material_print_temperature_layer_0']
+        if global_values['machine_firmware_retract']:
+            extruder_keys += list(firmware_retraction_setting_key.values())
+        if global_values['klipper_velocity_limits_enable']:
+            global_keys += list(velocity_limit_setting_key.values())
+        if global_values['klipper_input_shaper_enable']:
+            global_keys += list(input_shaper_setting_key.values())
+        if global_values['klipper_tuning_tower_enable']:
+            global_keys += list(tuning_tower_setting_key.values())
+        if global_values['klipper_z_offset_control_enable']:
+            global_keys += ['klipper_z_offset_set_enable', 'klipper_z_offset_layer_0',
+                            'klipper_z_offset_set_total', 'layer_height_0']
+        if global_values['klipper_smooth_time_enable']:
+            extruder_keys += ['klipper_smooth_time_factor']
+        if global_values['klipper_pressure_advance_enable']:
+            extruder_keys += list(pressure_advance_setting_key.values())
+
+        global_values = _readValues(global_stack, global_keys, global_values)
+        extruder_values = OrderedDict() # type: Dict[int, Mapping[str, Any]]
+        used_extruders = [] # type: List[int]
+        for extruder_stack in used_extruder_stacks:
+            values = _readValues(extruder_stack, extruder_keys)
+            used_extruders.append(int(values['extruder_nr']))
+            extruder_values[used_extruders[-1]] = MappingProxyType(values)
+
+        active_extruder_nr = int(active_extruder_stack.getProperty('extruder_nr', 'value'))
+        if active_extruder_nr not in extruder_values:
+            extruder_values[active_extruder_nr] = MappingProxyType(_readValues(active_extruder_stack, extruder_keys))
+
+        mesh_values = [] # type: List[Tuple[str, int, Mapping[str, Any]]]
+        if not global_values['klipper_pressure_advance_enable']:
+            pass # Per-object settings are only used by pressure advance
+        elif get_mesh_values is not None:
+            mesh_values = list(get_mesh_values())
+        else:
+            for node in mesh_nodes:
+                mesh_settings = node.callDecoration('getStack').getTop()
+                values = OrderedDict() # type: Dict[str, Any]
+                for setting_key in pressure_advance_setting_key.values():
+                    setting_instance = mesh_settings.getInstance(setting_key)
+                    if setting_instance is not None:
+                        values[setting_key] = setting_instance.value
+                mesh_values.append((node.getName(), int(node.callDecoration('getActiveExtruderPosition')),
+                                    MappingProxyType(values)))
+
+        return cls(MappingProxyType(global_values), MappingProxyType(extruder_values), tuple(used_extruders),
+                   active_extruder_nr, tuple(mesh_values), tuple(extruder_keys))
+
+    def hasEnabledFeatures(self) -> bool:
+        """Returns true if any Klipper feature is enabled.
+
+        """
+        global_values = self.global_values
+        if global_values['klipper_experimental_enable'] and any(
+                global_values[setting_key] for setting_key in experimental_setting_keys):
+            return True
+        return any(global_values[setting_key] for setting_key in feature_setting_keys)
+
+    def readExtruder(self, extruder_stack: Any) -> Mapping[str, Any]:
+        """Returns setting values of an extruder stack that is not in the snapshot.
+
+        """
+        return MappingProxyType(_readValues(extruder_stack, self.extruder_keys))
+
+
+def _readValues(stack: Any, setting_keys: List[str], values: Optional[Dict[str, Any]]=None) -> Dict[str, Any]:
+    """Returns dict of setting values read from a stack, skipping keys already in values.
+
+    """
+    values = OrderedDict(values or ()) # type: Dict[str, Any]
+    for setting_key in setting_keys:
+        if setting_key not in values:
+            values[setting_key] = stack.getProperty(setting_key, 'value')
+    return values
+
+
+class KlipperGcodeProcessor:
+    """Applies enabled Klipper settings to sliced gcode.
+
+    Stacks only need getProperty(key, 'value'); Scene nodes need getName() and the
+    'getStack' and 'getActiveExtruderPosition' decorations used for per-object settings.
+    Setting values are read once into a SettingsSnapshot shared by every build plate.
+     * global_stack: Global container stack.
+     * used_extruder_stacks: List of extruder stacks used by the print.
+     * mesh_nodes: List of printable scene nodes for per-object settings.
+     * comment: String of the plugin signature added to all new gcode commands.
+     + active_extruder_stack: Extruder stack for settings of the active extruder;
+                              First used extruder if not set.
+     + get_extruder_stack: Function returning the extruder stack of an extruder number.
+     + warnings: List of final warning messages to add to.
+     + override_on: True if tuning tower suggested settings are applied;
+                    Warnings for values set by the preset are not added.
+     + get_mesh_values: Function returning a list of (mesh_name, extruder_nr, values) of per-object
+                        settings already read, such as from MeshSettingsTracker; Used instead of reading mesh_nodes.
+    """
+    def __init__(self, global_stack: Any, used_extruder_stacks: List[Any], mesh_nodes: List[Any], comment: str,
+                 active_extruder_stack: Any=None, get_extruder_stack: Optional[Callable[[int], Any]]=None,
+                 warnings: Optional[List[str]]=None, override_on: bool=False,
+                 get_mesh_values: Optional[Callable[[], List[Tuple[str, int, Mapping[str, Any]]]]]=None) -> None:
+        self._global_stack = global_stack
+        self._used_extruder_stacks = used_extruder_stacks
+        self._mesh_nodes = mesh_nodes
+        self._comment = comment
+        self._active_extruder_stack = active_extruder_stack if active_extruder_stack is not None else used_extruder_stacks[0]
+        self._get_extruder_stack = get_extruder_stack or self._findExtruderStack
+        self._override_on = override_on
+        self._get_mesh_values = get_mesh_values
+        self._snapshot = None # type: Optional[SettingsSnapshot]
+
+        self.warnings = warnings if warnings is not None else [] # type: List[str]
+        self.messages = [] # type: List[GcodeMessage]
+
+    def processGcodeDict(self, gcode_dict: Dict[Any, List[str]], lazy: bool=True,
+                         timings: Optional[Dict[str, float]]=None, workers: int=1) -> bool:
+        """Processes the gcode of every build plate and returns true if any gcode changed.
+
+        Each changed plate is marked so it is only processed once; Plates with errors are skipped.
+         * gcode_dict: Dict of build plate number and gcode list, updated in place.
+         + lazy: True keeps layer insertions as patches applied when the gcode is read.
+         + timings: Dict updated with time in seconds spent in each stage.
+         + workers: Integer for number of processes used to rewrite layers.
+        """
+        gcode_changed = False
+
+        if not self.getSnapshot().hasEnabledFeatures(): # Nothing to apply
+            Logger.log('d', "All Klipper features are disabled")
+            return gcode_changed
+
+        for plate_id in gcode_dict:
+            gcode_list = gcode_dict[plate_id]
+            if len(gcode_list) < 2:
+                Logger.log('w', "Plate %s does not contain any layers", plate_id)
+                continue
+            if processed_marker in gcode_list[0]: # Only process new files
+                Logger.log('d', "Plate %s has already been processed", plate_id)
+                continue
+
+            gcode_pipeline = self.buildPipeline(gcode_list[1])
+            if gcode_pipeline is None: # Skip plate on error; Changes to other plates are kept
+                Logger.log('w', "Plate %s was not processed", plate_id)
+                continue
+
+            ## POST-PROCESS GCODE PIPELINE --------------------------
+            # Layer insertions are kept as patches and applied as the gcode is written
+            gcode_patches = GcodePatchSet() if lazy else None
+            if not gcode_pipeline.process(gcode_list, timings, workers, gcode_patches):
+                continue
+            if gcode_patches:
+                gcode_list = gcode_dict[plate_id] = PatchedGcodeList(gcode_list, gcode_patches)
+                Logger.log('d', "Plate %s has %d gcode insertions in %d layers", plate_id,
+                           len(gcode_patches), len(gcode_patches.getLayerNumbers()))
+
+            gcode_list[0] += processed_marker
+            gcode_changed = True
+
+        return gcode_changed
+
+    def getSnapshot(self) -> SettingsSnapshot:
+        """Returns snapshot of setting values, read from the stacks on first use.
+
+        """
+        if self._snapshot is None:
+            self._snapshot = SettingsSnapshot.capture(self._global_stack, self._used_extruder_stacks,
+                                                      self._mesh_nodes, self._active_extruder_stack, self._get_mesh_values)
+        return self._snapshot
+
+    def buildPipeline(self, start_gcode: str) -> Optional[GcodePipeline]:
+        """Returns gcode pipeline with a stage for every enabled Klipper feature or None on error.
+
+         * start_gcode: String of the start gcode of the gcode being processed.
+        """
+        snapshot = self.getSnapshot()
+        global_values = snapshot.global_values
+        used_extruders = snapshot.used_extruders
+        comment = self._comment
+
+        # Extruders currently affected by klipper settings
+        active_extruder_list = set() # type: Set[int]
+        # Mesh features for pressure advance
+        active_mesh_features = set() # type: Set[str]
+
+        # Gets global state of klipper setting controls (bool)
+        firmware_retract_enabled = global_values['machine_firmware_retract']
+        pressure_advance_enabled = global_values['klipper_pressure_advance_enable']
+        velocity_limits_enabled = global_values['klipper_velocity_limits_enable']
+        input_shaper_enabled = global_values['klipper_input_shaper_enable']
+        tuning_tower_enabled = global_values['klipper_tuning_tower_enable']
+        smooth_time_enabled = global_values['klipper_smooth_time_enable']
+        z_offset_enabled = global_values['klipper_z_offset_control_enable']
+        # Experimental features
+        experimental_features_enabled = global_values['klipper_experimental_enable']
+        mesh_calibrate_enabled = global_values['klipper_mesh_calibrate_enable']
+        ui_temp_support_enabled = global_values['klipper_ui_temp_support_enable']
+
+        # Commands the start gcode already sets are not added again
+        start_commands = indexGcodeCommands(start_gcode)
+
+        # Searches start gcode for tool change command
+        # Compatibility for cura versions without getInitialExtruder
+        initial_toolchange = re.search(r"(?m)^T([0-9])+$", start_gcode)
+
+        if initial_toolchange: # Set initial extruder number
+            start_extruder_nr = int(initial_toolchange.group(1))
+        else: # Set active extruder number
+            start_extruder_nr = snapshot.active_extruder_nr
+
+        start_extruder_values = snapshot.extruder_values.get(start_extruder_nr)
+        if start_extruder_values is None: # Extruder is not used by the print
+            start_extruder_values = snapshot.readExtruder(self._get_extruder_stack(start_extruder_nr))
+
+        # Each enabled Klipper feature is added as a stage of the gcode pipeline
+        gcode_pipeline = GcodePipeline(start_extruder_nr, active_extruder_list)
+
+        ## EXPERIMENTAL FEATURES --------------------------------
+        if not experimental_features_enabled:
+            Logger.log('d', "Klipper Experimental Features Disabled")
+        else:
+            ## BED MESH CALIBRATE COMMAND
+            if not mesh_calibrate_enabled:
+                Logger.log('d', "Klipper Bed Mesh Calibration is Disabled")
+            else:
+                # Search start gcode for existing command
+                cura_start_gcode = global_values['machine_start_gcode']
+                mesh_calibrate_exists = gcodeSearch(
+                    cura_start_gcode if cura_start_gcode is not None else start_gcode, 'BED_MESH_CALIBRATE')
+
+                if mesh_calibrate_exists: # Do not add commands
+                    self.messages.append(GcodeMessage(
+                        "<i>Calibration command is already active in Cura start gcode.</i>",
+                        "WARNING", "Bed Mesh Calibrate Not Applied", True))
+
+                else: # Add mesh calibration command sequence to gcode
+                    preheat_bed_temp = global_values['material_bed_temperature_layer_0']
+                    mesh_calibrate_gcode = "M190 S%s %s\n" % (preheat_bed_temp, comment) + (
+                                           "G28 %s\n" % comment) + (
+                                           "BED_MESH_CALIBRATE %s\n\n" % comment)
+                    gcode_pipeline.addStage(GcodeStage("mesh_calibrate", prefix = mesh_calibrate_gcode))
+                    start_gcode = mesh_calibrate_gcode + start_gcode
+
+                    self.messages.append(GcodeMessage(
+                        "<i>Calibration will heat bed then run before the start gcode sequence.</i>",
+                        "NEUTRAL", "Klipper Bed Mesh Calibration Enabled", False))
+
+            ## KLIPPER UI SUPPORT
+            if not ui_temp_support_enabled:
+                Logger.log('d', "Klipper UI Temp Support is Disabled")
+            else:
+                # Checks if M190 and M109 commands exist in start gcode
+                extruder_values = snapshot.extruder_values[snapshot.active_extruder_nr]
+                gcode_pipeline.addStage(GcodeStage("ui_temp_support", header = gcodeUiSupport(start_gcode, comment,
+                    extruder_values['material_bed_temperature_layer_0'],
+                    extruder_values['material_print_temperature'],
+                    extruder_values['material_print_temperature_layer_0'])))
+
+        ## FIRMWARE RETRACTION COMMAND --------------------------
+        if not firmware_retract_enabled:
+            Logger.log('d', "Klipper Firmware Retraction is Disabled")
+        else:
+            initial_retraction_settings = {}   # type: Dict[str, float]
+            extruder_fw_retraction = {}  # type: Dict[int, Dict[str, float]]
+
+            if len(used_extruders) > 1: # Add empty dict for each extruder
+                for extruder_nr in range(len(used_extruders)):
+                    extruder_fw_retraction[extruder_nr] = {} # type: Dict[str, float]
+
+            for klipper_cmd, setting in firmware_retraction_setting_key.items():
+                # Gets initial retraction settings for the print
+                initial_retraction_settings[klipper_cmd] = start_extruder_values[setting]
+
+                if extruder_fw_retraction:
+                    for extruder_nr in used_extruders:
+                        # Gets settings for each extruder and updates active extruders
+                        extruder_fw_retraction.setdefault(extruder_nr, {}).update(
+                            {klipper_cmd: snapshot.extruder_values[extruder_nr][setting]})
+                        active_extruder_list.add(extruder_nr) # type: Set[int]
+
+            for extruder_nr, settings in extruder_fw_retraction.items(): # Create gcode command for each extruder
+                extruder_fw_retraction[extruder_nr] = gcodeFirmwareRetraction(settings) + comment # type: Dict[int, str]
+
+            retraction_gcode = ""
+            try: # Add enabled commands for initial extruder to start gcode
+                retraction_gcode = gcodeFirmwareRetraction(initial_retraction_settings) + comment + "\n"
+
+            except TypeError:
+                Logger.log('d', "Klipper initial firmware retraction was not set.")
+
+            gcode_pipeline.addStage(FirmwareRetractionStage(extruder_fw_retraction,
+                header = self._newCommands(retraction_gcode, start_commands)))
+
+        # Warnings are not added for values set by tuning tower presets
+        preset_warnings = None if self._override_on else self.warnings
+
+        ## VELOCITY LIMITS COMMAND ------------------------------
+        if not velocity_limits_enabled:
+            Logger.log('d', "Klipper Velocity Limit Control is Disabled")
+        else:
+            velocity_limits = {} # type: Dict[str, int]
+            # Get all velocity setting values
+            for limit_key, limit_setting in velocity_limit_setting_key.items():
+                velocity_limits[limit_key] = global_values[limit_setting]
+            try: # Add enabled commands to gcode
+                gcode_pipeline.addStage(GcodeStage("velocity_limits", header = self._newCommands(
+                    gcodeVelocityLimits(velocity_limits, preset_warnings) + comment + "\n", start_commands)))
+
+            except TypeError:
+                Logger.log('d', "Klipper velocity limits were not set.")
+
+        ## INPUT SHAPER COMMAND ---------------------------------
+        if not input_shaper_enabled:
+            Logger.log('d', "Klipper Input Shaper Control is Disabled")
+        else:
+            shaper_settings = {} # type: Dict[str, Any]
+            # Get all input shaper setting values
+            for shaper_key, shaper_setting in input_shaper_setting_key.items():
+                shaper_settings[shaper_key] = global_values[shaper_setting]
+            try: # Add enabled commands to gcode
+                gcode_pipeline.addStage(GcodeStage("input_shaper", header = self._newCommands(
+                    gcodeInputShaper(shaper_settings, preset_warnings) + comment + "\n", start_commands)))
+
+            except TypeError:
+                Logger.log('d', "Klipper input shaper settings were not set.")
+
+        ## TUNING TOWER COMMAND ---------------------------------
+        if not tuning_tower_enabled:
+            Logger.log('d', "Klipper Tuning Tower is Disabled")
+        else:
+            tower_settings = OrderedDict() # type: OrderedDict[str, Any]
+            # Get all tuning tower setting values
+            for tower_key, tower_setting in tuning_tower_setting_key.items():
+                tower_settings[tower_key] = global_values[tower_setting]
+            try: # Add tuning tower sequence to gcode
+                gcode_pipeline.addStage(GcodeStage("tuning_tower",
+                    suffix = gcodeTuningTower(tower_settings, self.warnings, len(used_extruders)) + comment + "\n"))
+
+            except TypeError:
+                Logger.log('w', "Klipper tuning tower could not be processed.")
+                return None # Stop on error
+
+        ## Z OFFSET COMMAND -------------------------------------
+        if not z_offset_enabled:
+            Logger.log('d', "Klipper Z Offset Adjustment is Disabled")
+        else:
+            z_offset_set_pattern = "SET_GCODE_OFFSET Z=%g " + comment
+            z_offset_gcode = ""
+
+            z_offset_override = global_values['klipper_z_offset_set_enable']
+            z_offset_layer_0 = global_values['klipper_z_offset_layer_0']
+
+            if not z_offset_override:
+                Logger.log('d', "Klipper total z offset was not changed.")
+            else:
+                z_offset_total = global_values['klipper_z_offset_set_total']
+                # Overrides any existing z offset with new value
+                # This will compound with any additional first layer z offset adjustment.
+                z_offset_gcode = z_offset_set_pattern % z_offset_total + "\n" # Applied after start gcode
+                # Add z offset override warning
+                self.warnings.insert(0, "•  <i>Z Offset Override</i> is set to <b>%s mm</b>" % z_offset_total)
+
+            if not z_offset_layer_0:
+                Logger.log('d', "Klipper first layer z offset was not changed.")
+                gcode_pipeline.addStage(GcodeStage("z_offset", suffix = z_offset_gcode))
+            else:
+                layer_0_height = global_values['layer_height_0']
+                gcode_pipeline.addStage(ZOffsetStage(
+                    comment, z_offset_layer_0, layer_0_height, suffix = z_offset_gcode))
+
+                self.warnings.insert(0, "•  <i>Initial Layer Z Offset</i> will <b>%s</b> nozzle by <b>%s mm</b>" % (
+                    "lower" if z_offset_layer_0 < 0 else "raise", z_offset_layer_0)) # Add to final warning message
+
+        ## PRESSURE ADVANCE COMMAND -----------------------------
+        if not pressure_advance_enabled and not smooth_time_enabled:
+            Logger.log('d', "Klipper Pressure Advance Control is Disabled")
+
+        else:
+            # Extruder Settings
+            apply_factor_per_feature = {}  # type: Dict[int, bool]
+            extruder_factors = {}          # type: Dict[(int,str), float]
+            current_factor = {}            # type: Dict[int, float]
+            # Mesh Object Settings
+            per_mesh_factors = {}          # type: Dict[(str,str), float]
+
+            smooth_time_factor = 0
+            pressure_advance_factor = -1
+            pressure_advance_gcode = ""
+
+            for extruder_nr in used_extruders: # Get settings for all active extruders
+                extruder_values = snapshot.extruder_values[extruder_nr]
+
+                if not smooth_time_enabled:
+                    Logger.log('d', "Klipper Pressure Advance Smooth Time is Disabled")
+                else:
+                    smooth_time_factor = extruder_values['klipper_smooth_time_factor']
+
+                if not pressure_advance_enabled:
+                    Logger.log('d', "Klipper Pressure Advance Factor is Disabled")
+                else:
+                    pressure_advance_factor = extruder_values['klipper_pressure_advance_factor']
+                    current_factor[extruder_nr] = pressure_advance_factor
+
+                    # Gets feature settings for each extruder
+                    for feature_key, setting_key in pressure_advance_setting_key.items():
+                        extruder_factors[(extruder_nr, feature_key)] = extruder_values[setting_key]
+                        # Checks for unique feature values
+                        if extruder_factors[(extruder_nr, feature_key)] != pressure_advance_factor:
+                            apply_factor_per_feature[extruder_nr] = True # Flag to process gcode
+
+                try: # Add initial pressure advance command for all active extruders
+                    pressure_advance_gcode += gcodePressureAdvance(
+                        str(extruder_nr).strip('0'), comment, pressure_advance_factor, smooth_time_factor) + "\n"
+
+                except TypeError:
+                    Logger.log('w', "Klipper pressure advance values invalid: %s", str((pressure_advance_factor, smooth_time_factor)))
+                    return None
+
+            if pressure_advance_enabled:
+                ## Per Object Settings
+                if not snapshot.mesh_values:
+                    Logger.log('w', "No valid objects in scene to process.")
+                    return None
+
+                # Filename of mesh with extension and its per-object settings
+                for mesh_name, extruder_nr, mesh_settings in snapshot.mesh_values:
+                    # Get active feature settings for mesh object
+                    for feature_key, setting_key in pressure_advance_setting_key.items():
+                        if setting_key in mesh_settings:
+                            mesh_setting_value = mesh_settings[setting_key]
+                        else:
+                            continue
+
+                        # Save the children!
+                        for feature in pressureAdvanceFeatures(feature_key):
+                            per_mesh_factors[(mesh_name, feature)] = mesh_setting_value
+                            active_mesh_features.add(feature) # All per-object features
+                            apply_factor_per_feature[extruder_nr] = True # Flag to process gcode
+
+            # Set gcode loop parameters
+            if any(apply_factor_per_feature.values()):
+                for extruder_nr in list(apply_factor_per_feature):
+                    active_extruder_list.add(extruder_nr)
+            else:
+                extruder_factors.clear() # Only initial commands are added
+
+            gcode_pipeline.addStage(PressureAdvanceStage(comment, extruder_factors, per_mesh_factors,
+                current_factor, active_mesh_features, header = self._newCommands(pressure_advance_gcode, start_commands)))
+
+        return gcode_pipeline
+
+    def _newCommands(self, gcode: str, start_commands: GcodeCommandIndex) -> str:
+        """Returns gcode without commands the start gcode already sets to the same values.
+
+         * gcode: String of new gcode commands added before the start gcode.
+         * start_commands: GcodeCommandIndex of the start gcode.
+        """
+        new_lines = []
+        for line in gcode.splitlines(True):
+            if start_commands.setsValues(line):
+                Logger.log('d', "Command is already set in start gcode: %s", line.strip())
+            else:
+                new_lines.append(line)
+
+        return "".join(new_lines)
+
+    def _findExtruderStack(self, extruder_nr: int) -> Any:
+        """Returns used extruder stack of an extruder number or the active extruder stack.
+
+        """
+        for extruder_stack in self._used_extruder_stacks:
+            if int(extruder_stack.getProperty('extruder_nr', 'value')) == extruder_nr:
+                return extruder_stack
+
+        return self._active_extruder_stack
@@ -0,0 +1,189 @@
+# Copyright (c) 2023 J.Jarrard / JJFX
+# The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
+
+'''
+KLIPPER SETTINGS PROFILER
+-------------------------
+Opt-in latency measurements of plugin hooks called by Cura.
+Records call counts, total and maximum wall time with rolling percentiles of recent calls,
+exported as a JSON report. One call of a hook can also be captured with cProfile.
+Memory held by an object graph can be measured to report memory released at runtime.
+'''
+
+import cProfile
+import functools
+import gc
+import json
+import math
+import os
+import sys
+import time
+import types
+from collections import deque, OrderedDict
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+from .KlipperGcode import Logger
+
+report_file = "klipper_settings_profile.json"
+
+# Objects shared by the whole process are not part of a measured object graph
+_unmeasured_types = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+
+
+def referencedSize(root: Any, shared: Any = None) -> int:
+    """Returns bytes of an object and every object it references.
+
+    Objects also referenced by the shared object are not counted, so the result
+    is the memory released if the root is replaced by the shared object.
+     * root: Object to measure.
+     + shared: Object whose referenced objects stay alive.
+    """
+    def referencedObjects(obj: Any) -> Dict[int, Any]:
+        objects = {} # type: Dict[int, Any]
+        pending = [obj]
+        while pending:
+            obj = pending.pop()
+            if id(obj) in objects or isinstance(obj, _unmeasured_types):
+                continue
+            objects[id(obj)] = obj
+            pending.extend(gc.get_referents(obj))
+        return objects
+
+    kept = referencedObjects(shared) if shared is not None else {}
+    return sum(sys.getsizeof(obj) for obj_id, obj in referencedObjects(root).items() if obj_id not in kept)
+
+
+class _HookStats:
+    """Call count and wall times of a single hook.
+
+     * window: Integer for number of recent calls used for percentiles.
+    """
+    def __init__(self, window: int) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen = window) # type: Deque[float]
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def percentile(self, percent: float, ordered: List[float]) -> float:
+        """Returns nearest-rank percentile of ordered recent call times.
+
+        """
+        if not ordered:
+            return 0.0
+        rank = min(max(math.ceil(percent / 100 * len(ordered)) - 1, 0), len(ordered) - 1)
+        return ordered[rank]
+
+
+class LatencyProfiler:
+    """Records wall time and call counts of named hooks.
+
+     + window: Integer for number of recent calls of each hook used for percentiles.
+     + profile_dir: String of the directory for reports and cProfile dumps.
+    """
+    percentiles = (50, 90, 99)
+
+    def __init__(self, window: int=1000, profile_dir: Optional[str]=None) -> None:
+        self._window = window
+        self._profile_dir = profile_dir
+        self._hooks = OrderedDict() # type: Dict[str, _HookStats]
+        self._profile_once = set() # type: Set[str]
+        self._start_time = time.time()
+
+    def record(self, name: str, seconds: float) -> None:
+        """Adds the wall time of a hook call.
+
+        """
+        stats = self._hooks.get(name)
+        if stats is None:
+            stats = self._hooks[name] = _HookStats(self._window)
+        stats.add(seconds)
+
+    def wrap(self, name: str, function: Callable[..., Any]) -> Callable[..., Any]:
+        """Returns function that records the wall time of every call.
+
+        The first call is captured with cProfile if requested with profileOnce.
+         * name: String for the hook name in the report.
+         * function: Function or bound method to measure.
+        """
+        @functools.wraps(function)
+        def measured(*args: Any, **kwargs: Any) -> Any:
+            if name in self._profile_once:
+                self._profile_once.discard(name)
+                return self._profileCall(name, function, args, kwargs)
+
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start_time)
+
+        return measured
+
+    def profileOnce(self, name: str) -> None:
+        """Captures the next call of a wrapped hook with cProfile.
+
+        The profile is dumped to '<profile_dir>/klipper_settings_<name>.prof'.
+        """
+        self._profile_once.add(name)
+
+    def _profileCall(self, name: str, function: Callable[..., Any], args: Any, kwargs: Any) -> Any:
+        profiler = cProfile.Profile()
+        start_time = time.perf_counter()
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+            if self._profile_dir:
+                profile_path = os.path.join(self._profile_dir, "klipper_settings_%s.prof" % name.strip("_"))
+                try:
+                    profiler.dump_stats(profile_path)
+                except OSError as e:
+                    Logger.log('w', "Could not write profile %s: %s", profile_path, e)
+                else:
+                    Logger.log('d', "Profile of %s written to %s", name, profile_path)
+
+    def report(self) -> Dict[str, Any]:
+        """Returns call counts and wall times in milliseconds of every hook.
+
+        """
+        hooks = OrderedDict() # type: Dict[str, Any]
+        for name, stats in self._hooks.items():
+            ordered = sorted(stats.recent)
+            hook_report = OrderedDict([
+                ("count", stats.count),
+                ("total_ms", stats.total * 1000),
+                ("mean_ms", stats.total * 1000 / max(stats.count, 1)),
+                ("max_ms", stats.max * 1000)
+            ])
+            for percent in self.percentiles:
+                hook_report["p%d_ms" % percent] = stats.percentile(percent, ordered) * 1000
+            hooks[name] = hook_report
+
+        return OrderedDict([
+            ("started", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self._start_time))),
+            ("window", self._window),
+            ("hooks", hooks)
+        ])
+
+    def writeReport(self) -> Optional[str]:
+        """Writes the JSON report to the profile directory and returns its path.
+
+        """
+        if not self._profile_dir:
+            return None
+
+        report_path = os.path.join(self._profile_dir, report_file)
+        try:
+            with open(report_path, "w", encoding = "utf-8") as f:
+                json.dump(self.report(), f, indent = 2)
+        except OSError as e:
+            Logger.log('w', "Could not write profiler report %s: %s", report_path, e)
+            return None
+
+        return report_path
@@ -0,0 +1,170 @@
+# Copyright (c) 2023 J.Jarrard / JJFX
+# The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
+
+'''
+KLIPPER SCENE SETTINGS
+----------------------
+Per-object pressure advance settings of every mesh in the scene, kept up to date from
+scene node and per-object stack signals so saving gcode does not walk the scene.
+Only scene node and stack interfaces are used, so stand-in objects work without Cura.
+'''
+
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from .KlipperGcode import Logger
+
+# Per-object settings that change whether a node is printed as a mesh
+_mesh_type_setting_keys = frozenset(["anti_overhang_mesh", "infill_mesh", "cutting_mesh", "support_mesh"])
+
+
+class _TrackedNode:
+    """Scene node with its tracked children and per-object values read on the last refresh.
+
+    Values are marked dirty by signals and only read again when they are next needed.
+    """
+    __slots__ = ("node", "parent_id", "child_ids", "stack", "values", "extruder_nr", "is_mesh", "dirty",
+                 "_watched_keys", "__weakref__")
+
+    def __init__(self, node: Any, parent_id: Optional[int], watched_keys: Any) -> None:
+        self.node = node
+        self.parent_id = parent_id
+        self.child_ids = [] # type: List[int]
+        self.stack = None # type: Any
+        self.values = MappingProxyType({}) # type: Mapping[str, Any]
+        self.extruder_nr = 0
+        self.is_mesh = False
+        self.dirty = True
+        self._watched_keys = watched_keys
+
+    def onPropertyChanged(self, key: str, property_name: str) -> None:
+        # Per-object stacks also signal changes of every setting they inherit
+        if property_name == "value" and key in self._watched_keys:
+            self.dirty = True
+
+    def onDecoratorsChanged(self, *args: Any) -> None:
+        self.dirty = True # Per-object stack may be added or replaced
+
+
+class MeshSettingsTracker:
+    """Per-object setting values of printable mesh nodes below a scene root.
+
+    Nodes are added and removed as the children of tracked nodes change; Values of a node are
+    read again on the next request only after one of its watched settings or decorators change.
+    Scene nodes need getChildren(), getName(), isSelectable() and the decorations used by
+    KlipperGcodeProcessor; Signals only need connect and disconnect.
+     * setting_keys: Iterable of per-object setting keys to read.
+    """
+    def __init__(self, setting_keys: Iterable[str]) -> None:
+        self._setting_keys = tuple(setting_keys)
+        self._watched_keys = frozenset(self._setting_keys) | _mesh_type_setting_keys | {"extruder_nr"}
+        self._nodes = OrderedDict() # type: Dict[int, _TrackedNode]
+
+    def setRoot(self, root: Any) -> None:
+        """Tracks every node below the scene root.
+
+        Children changes of any tracked node must be connected to onChildrenChanged.
+        """
+        self.clear()
+        self._addNode(root, None)
+
+    def clear(self) -> None:
+        for tracked in self._nodes.values():
+            self._disconnect(tracked)
+        self._nodes.clear()
+
+    def onChildrenChanged(self, parent: Any) -> None:
+        """Adds new children and removes former children of a tracked node.
+
+         * parent: Scene node whose children changed.
+        """
+        tracked = self._nodes.get(id(parent))
+        if tracked is None: # Not below the scene root
+            return
+
+        children = OrderedDict((id(child), child) for child in parent.getChildren())
+        for child_id in tracked.child_ids:
+            if child_id not in children:
+                self._removeNode(child_id)
+        for child_id, child in children.items():
+            self._addNode(child, tracked)
+        tracked.child_ids = list(children)
+
+    def _addNode(self, node: Any, parent: Optional[_TrackedNode]) -> None:
+        tracked = self._nodes.get(id(node))
+        if tracked is not None: # Already tracked or moved to a new parent
+            old_parent = self._nodes.get(tracked.parent_id)
+            if parent is not None and old_parent is not parent:
+                if old_parent is not None and id(node) in old_parent.child_ids:
+                    old_parent.child_ids.remove(id(node))
+                tracked.parent_id = id(parent)
+            return
+
+        tracked = self._nodes[id(node)] = _TrackedNode(node, id(parent) if parent else None, self._watched_keys)
+        node.decoratorsChanged.connect(tracked.onDecoratorsChanged)
+        for child in node.getChildren():
+            self._addNode(child, tracked)
+            tracked.child_ids.append(id(child))
+
+    def _removeNode(self, node_id: int) -> None:
+        tracked = self._nodes.pop(node_id, None)
+        if tracked is None:
+            return
+        self._disconnect(tracked)
+        for child_id in tracked.child_ids:
+            self._removeNode(child_id)
+
+    def _disconnect(self, tracked: _TrackedNode) -> None:
+        tracked.node.decoratorsChanged.disconnect(tracked.onDecoratorsChanged)
+        if tracked.stack is not None:
+            tracked.stack.propertyChanged.disconnect(tracked.onPropertyChanged)
+
+    def _refresh(self, tracked: _TrackedNode) -> None:
+        """Reads per-object values of a node and connects to its per-object stack.
+
+        """
+        node = tracked.node
+        stack = node.callDecoration('getStack')
+        if stack is not tracked.stack:
+            if tracked.stack is not None:
+                tracked.stack.propertyChanged.disconnect(tracked.onPropertyChanged)
+            if stack is not None:
+                stack.propertyChanged.connect(tracked.onPropertyChanged)
+            tracked.stack = stack
+
+        # Support, cutting and other modifier meshes are not printed as objects
+        tracked.is_mesh = stack is not None and not node.callDecoration('isNonThumbnailVisibleMesh')
+        if tracked.is_mesh:
+            mesh_settings = stack.getTop()
+            values = OrderedDict() # type: Dict[str, Any]
+            for setting_key in self._setting_keys:
+                setting_instance = mesh_settings.getInstance(setting_key)
+                if setting_instance is not None:
+                    values[setting_key] = setting_instance.value
+            tracked.values = MappingProxyType(values)
+            tracked.extruder_nr = int(node.callDecoration('getActiveExtruderPosition'))
+
+        tracked.dirty = False
+
+    def getMeshValues(self) -> List[Tuple[str, int, Mapping[str, Any]]]:
+        """Returns (mesh_name, extruder_nr, values) of every printable mesh in scene order.
+
+        Only nodes changed since the last request are read from their stacks.
+        """
+        mesh_values = [] # type: List[Tuple[str, int, Mapping[str, Any]]]
+        refreshed = 0
+        for tracked in self._nodes.values():
+            if tracked.dirty:
+                self._refresh(tracked)
+                refreshed += 1
+            if tracked.is_mesh and tracked.node.isSelectable():
+                mesh_values.append((tracked.node.getName(), tracked.extruder_nr, tracked.values))
+
+        if refreshed:
+            Logger.log('d', "Per-object settings read for %d of %d scene nodes", refreshed, len(self._nodes))
+
+        return mesh_values
+
+    def __len__(self) -> int:
+        return len(self._nodes)
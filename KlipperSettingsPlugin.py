@@ -59,15 +59,19 @@ v1.0.2  + Setting definition compatibility for older versions
 
 '''
 
-import os.path, json, re
-import configparser # To parse settings backup in config file
+import logging # Find the Cura log file
+import os.path, re, time
+import configparser # To import settings backup from Cura config of previous versions
+from contextlib import contextmanager # Batched setting transactions
 from collections import OrderedDict # Ensure order of settings in all Cura versions
-from typing import List, Optional, Any, Dict, Set, TYPE_CHECKING
+from typing import List, Optional, Any, Dict, Iterator, Set, Tuple, TYPE_CHECKING
 
 try:
     from PyQt6.QtCore import QUrl # Import custom images
+    from PyQt6.QtCore import QTimer # Buffered settings backup writes
 except ImportError: # Older cura versions
     from PyQt5.QtCore import QUrl
+    from PyQt5.QtCore import QTimer
 
 from cura.CuraApplication import CuraApplication
 
@@ -79,11 +83,23 @@ from UM.Version import Version # Some features not supported in older versions
 from UM.Resources import Resources # Add local path to plugin resources
 
 from UM.Settings.SettingDefinition import SettingDefinition    # Create and register setting definitions
+from UM.Settings.SettingDefinition import DefinitionPropertyType
+from UM.Settings.SettingFunction import SettingFunction # Setting expressions shared by definitions
 from UM.Settings.DefinitionContainer import DefinitionContainer
+from UM.Settings.ContainerStack import ContainerStack
 from UM.Settings.ContainerRegistry import ContainerRegistry
 
 from UM.Message import Message # Display messages to user
-from UM.Scene.Iterator.DepthFirstIterator import DepthFirstIterator # Get per-object settings
+
+from .KlipperProcessor import KlipperGcodeProcessor # Gcode post-processing
+from .KlipperDefinitions import loadCompiledDefinitions, SettingDispatcher # Cached setting definitions
+from .KlipperProfiler import LatencyProfiler, referencedSize # Opt-in hook latency measurements
+from .KlipperOverride import SettingOverrideLayer # Suggested settings over user values
+from .KlipperBackup import SettingBackupStore # Machine setting backups and presets
+from .KlipperScene import MeshSettingsTracker # Per-object settings of scene nodes
+from .KlipperGcode import gcodeSearch
+from .KlipperGcode import pressure_advance_setting_key, tuning_tower_setting_key, velocity_limit_setting_key
+from .KlipperGcode import firmware_retraction_setting_key, input_shaper_setting_key
 
 from UM.i18n import i18nCatalog # Translations
 catalog = i18nCatalog("cura")
@@ -91,13 +107,25 @@ catalog = i18nCatalog("cura")
 if TYPE_CHECKING:
     from UM.OutputDevice.OutputDevice import OutputDevice
 
+
 class KlipperSettingsPlugin(Extension):
+    # Setting properties read from the Klipper setting definitions instead of a stack
+    _indexed_properties = frozenset(["label", "type", "default_value", "settable_per_extruder"])
+    # Plugin hooks measured when the profiler is enabled
+    _profiled_hooks = ["_onContainerLoadComplete", "_onInitialization", "_onGlobalContainerChanged",
+                       "_onGlobalSettingChanged", "_onExtruderSettingChanged", "_setTuningTowerPreset",
+                       "settingWizard", "_filterGcode"]
+
     def __init__(self, parent=None) -> None:
         super().__init__()
+        start_time = time.perf_counter()
 
         Resources.addSearchPath(os.path.join(os.path.dirname(__file__), "resources")) # Plugin resource path
 
         self._application = CuraApplication.getInstance()
+        self._profiler = self._createProfiler() # type: Optional[LatencyProfiler]
+        # Processes used to rewrite gcode layers when saving; Layers are rewritten in Cura if 1
+        self._application.getPreferences().addPreference("klipper_settings/layer_workers", 1)
         self._cura_version = Version(self._application.getVersion())
         self._i18n_catalog = None  # type: Optional[i18nCatalog]
         self._global_container_stack = None # type: Optional[ContainerStack]
@@ -105,6 +133,16 @@ class KlipperSettingsPlugin(Extension):
         self.comment = ";KlipperSettingsPlugin" # Plugin signature added to all new gcode commands
 
         self._settings_dict = {}   # type: Dict[str, Any]
+        self._setting_table = {}   # type: Dict[str, Dict[str, Any]]
+        self._value_cache = {}     # type: Dict[str, Dict[str, Any]]
+        self._value_dependents = {} # type: Dict[str, Set[str]]
+        self._registered_definitions = set() # type: Set[str]
+        self._machine_definition_ids = None # type: Optional[Set[str]]
+        self._registration_time = 0.0 # Seconds spent registering setting definitions
+        # Setting expressions shared by every registered definition container
+        self._shared_functions = {} # type: Dict[str, SettingFunction]
+        self._released_functions = 0 # Duplicate setting functions replaced with shared ones
+        self._released_bytes = 0 # Measured memory of the released duplicates
         category_icon = self._updateCategoryIcon("Klipper") # Get supported category icon
 
         self._category_key = "klipper_settings"
@@ -122,54 +160,177 @@ class KlipperSettingsPlugin(Extension):
         self._user_settings = {}    # type: Dict[str, Any]
         self._current_preset = None
         self._override_on = False
+        self._override_layer = SettingOverrideLayer() # Suggested settings of the active preset
         # Support for 3 custom presets
         self._custom_presets = {}   # type: Dict[(int, str), Any]
+        # Backups of each machine written together after changes
+        self._backup_timer = QTimer()
+        self._backup_timer.setSingleShot(True)
+        self._backup_timer.setInterval(5000)
+        self._backup_store = SettingBackupStore(os.path.join(Resources.getDataStoragePath(), "klipper_settings_backup.json"),
+                                                schedule_flush = self._backup_timer.start)
+        self._backup_timer.timeout.connect(self._backup_store.flush)
+        # Per-object pressure advance settings updated as the scene changes
+        self._mesh_settings = MeshSettingsTracker(pressure_advance_setting_key.values())
 
         # Current firmware retraction values
         self._firmware_retract = {} # type: Dict[str, float]
-
-        try: # Get setting definitions from json
-            with open(os.path.join(os.path.dirname(__file__), "klipper_settings.def.json"), encoding = "utf-8") as f:
-                self._settings_dict = json.load(f, object_pairs_hook = OrderedDict)
+        # Handlers of changed settings in global and extruder stacks
+        self._global_settings = SettingDispatcher()
+        self._extruder_settings = SettingDispatcher()
+        ## Setting transactions
+        self._setting_batch = None # type: Optional[List[Tuple[Any, str, str, Any]]]
+        # Queued value of each setting and whether it is a user value
+        self._batch_values = {}    # type: Dict[Tuple[int, str], Tuple[Any, bool]]
+        self._batch_changes = None # type: Optional[Set[str]]
+        self._batch_error_check = False
+        # Error checks requested by presets are combined
+        self._error_check_keys = set() # type: Set[str]
+        self._error_check_timer = QTimer()
+        self._error_check_timer.setSingleShot(True)
+        self._error_check_timer.setInterval(250)
+        self._error_check_timer.timeout.connect(self._startErrorCheck)
+        self._reevaluating_preset = False
+
+        try: # Get setting definitions from compiled cache or json
+            self._settings_dict, self._setting_table = loadCompiledDefinitions(Resources.getCacheStoragePath(),
+                self._application.getVersion(), compile_definitions = self._compileDefinitions)
         except:
             Logger.logException('e', "Could not load klipper settings definition")
             return
-        else: # Modify definitions for older Cura compatibility
-            if self._cura_version < Version("4.7.0"):
-                self._fixSettingsCompatibility()
+        self._buildSettingDispatchers()
 
         ContainerRegistry.getInstance().containerLoadComplete.connect(self._onContainerLoadComplete)
+        ContainerRegistry.getInstance().containerAdded.connect(self._onContainerAdded)
         self._application.initializationFinished.connect(self._onInitialization)
 
+        if self._profiler:
+            self._profiler.record("__init__", time.perf_counter() - start_time)
+
+    def _createProfiler(self) -> Optional[LatencyProfiler]:
+        """Returns latency profiler if enabled in Cura config, otherwise None.
+
+        Enabled with 'enabled = True' in the [klipper_profiler] config section;
+        'profile_gcode = True' also captures one gcode post-processing call with cProfile.
+        Reports are written to the Cura log directory after saving gcode and on exit.
+        """
+        preferences = self._application.getPreferences()
+        preferences.addPreference("klipper_profiler/enabled", False)
+        preferences.addPreference("klipper_profiler/profile_gcode", False)
+
+        if str(preferences.getValue("klipper_profiler/enabled")).lower() != "true":
+            return None
+
+        profiler = LatencyProfiler(profile_dir = self._getLogDirectory())
+        for hook in self._profiled_hooks: # Signals connect to the measured methods
+            setattr(self, hook, profiler.wrap(hook, getattr(self, hook)))
+        if str(preferences.getValue("klipper_profiler/profile_gcode")).lower() == "true":
+            profiler.profileOnce("_filterGcode")
+
+        self._application.applicationShuttingDown.connect(self._writeProfilerReport)
+        Logger.log('i', "Klipper settings profiler enabled")
+
+        return profiler
+
+    def _getLogDirectory(self) -> str:
+        """Returns directory of the Cura log file.
+
+        Found from the file handler of the Uranium file logger. Falls back to the
+        Cura data storage path, where Cura writes its log by default.
+        """
+        loggers = [logging.getLogger()] + list(logging.Logger.manager.loggerDict.values())
+        for logger in loggers:
+            for handler in getattr(logger, "handlers", []): # Placeholders have no handlers
+                if isinstance(handler, logging.FileHandler):
+                    return os.path.dirname(handler.baseFilename)
+        return Resources.getDataStoragePath()
+
+    def _writeProfilerReport(self, *args: Any) -> None:
+        # Signal arguments are ignored
+        report_path = self._profiler.writeReport() if self._profiler else None
+        if report_path:
+            Logger.log('d', "Klipper settings profiler report written to %s", report_path)
+
     def _onInitialization(self) -> None:
         ## Connect signals
         self._application.getPreferences().preferenceChanged.connect(self._fixCategoryVisibility)
         self._application.getMachineManager().globalContainerChanged.connect(self._onGlobalContainerChanged)
         self._application.getOutputDeviceManager().writeStarted.connect(self._filterGcode)
+        scene_root = self._application.getController().getScene().getRoot()
+        scene_root.childrenChanged.connect(self._mesh_settings.onChildrenChanged) # Emitted for nodes at any depth
+        self._mesh_settings.setRoot(scene_root)
+        # User settings changed while the override is active are saved by Cura
+        self._application.applicationShuttingDown.connect(self._override_layer.remove)
+        self._application.applicationShuttingDown.connect(self._backup_store.flush)
+        if self._profiler: # Report includes the latest gcode post-processing
+            self._application.getOutputDeviceManager().writeStarted.connect(self._writeProfilerReport)
         ## Startup actions
-        # Checks user settings backup in Cura config
-        self._user_settings = self._getBackup() # type: Dict[str, Any]
+        self._registerMachineDefinitions() # Ensure settings exist for every user machine
+        self._backup_store.load() # Settings backup and presets of every machine
+        self._importConfigBackup() # Backup saved in Cura config by previous versions
         self._fixCategoryVisibility() # Ensure visibility of new settings category
-        self._onGlobalContainerChanged() # Connect to Cura setting changes 
+        self._onGlobalContainerChanged() # Connect to Cura setting changes and load backups
         self._setTuningTowerPreset() # Set status of tuning tower settings
-        # Defines custom preset profiles
-        for profile_nr in [1, 2, 3]:
-            # Checks for preset backup in Cura config
-            self._custom_presets.update(self._getBackup("preset%s" % profile_nr))
 
     def _onContainerLoadComplete(self, container_id: str) -> None:
-        """Checks loaded containers for active definition containers.
+        """Checks loaded containers for definitions used by machine container stacks.
 
-        Registers new Klipper Settings category and setting definitions.
+        Registers Klipper settings as soon as the definition of a user machine loads,
+        before any user changes of its stacks are deserialized. Every other definition
+        container is skipped, which avoids deserializing the settings for hundreds of
+        machine definitions at startup; Their settings are only registered if a machine
+        stack using them loads.
         """
         if not ContainerRegistry.getInstance().isLoaded(container_id):
             return # Skip containers that could not be loaded
+        metadata = ContainerRegistry.getInstance().findContainersMetadata(id = container_id)
+        if not metadata or metadata[0].get('type') != "machine":
+            return # Only machine definitions and stacks need the new settings
         try:
             container = ContainerRegistry.getInstance().findContainers(id = container_id)[0]
         except IndexError:
             return # Sanity check
+        if isinstance(container, ContainerStack):
+            self._registerDefinition(container.getBottom()) # Definitions not found in user changes
+        elif container_id in self._getMachineDefinitionIds():
+            self._registerDefinition(container)
+
+    def _onContainerAdded(self, container: Any) -> None:
+        """Registers Klipper settings in the definition of a newly added machine.
+
+        """
+        if isinstance(container, ContainerStack) and container.getMetaDataEntry('type') == "machine":
+            self._registerDefinition(container.getBottom())
+
+    def _getMachineDefinitionIds(self) -> Set[str]:
+        """Returns IDs of definition containers referenced by user machine stacks.
+
+        Read from container metadata, so no stack needs to be loaded. User changes
+        of every machine stack store the ID of the machine definition.
+        """
+        if self._machine_definition_ids is None:
+            registry = ContainerRegistry.getInstance()
+            machine_ids = {metadata['id'] for metadata in registry.findContainerStacksMetadata(type = "machine")}
+            self._machine_definition_ids = {metadata['definition']
+                for metadata in registry.findInstanceContainersMetadata(type = "user")
+                if metadata.get('machine') in machine_ids and metadata.get('definition')}
+        return self._machine_definition_ids
+
+    def _registerDefinition(self, container: Optional[DefinitionContainer]) -> None:
+        """Registers new Klipper Settings category and setting definitions.
+
+        Each definition container is only registered once.
+         * container: DefinitionContainer of a machine container stack.
+        """
         if not isinstance(container, DefinitionContainer) or container.getMetaDataEntry('type') == "extruder":
             return # Skip non-definition and extruder containers
+        if container.getId() in self._registered_definitions:
+            return # Already registered
+        if container.findDefinitions(key=self._category_key):
+            self._registered_definitions.add(container.getId())
+            return # Category already registered
+
+        start_time = time.perf_counter()
 
         # Create new settings category
         klipper_category = SettingDefinition(self._category_key, container, None, self._i18n_catalog)
@@ -193,9 +354,56 @@ class KlipperSettingsPlugin(Extension):
             container._definition_cache[setting_key] = setting_definition
             if setting_definition.children:
                 self._updateAddedChildren(container, setting_definition)
+            self._shareSettingFunctions(setting_definition)
 
         container._updateRelations(klipper_category) # Update relations for all category settings
 
+        self._registered_definitions.add(container.getId())
+        self._registration_time += time.perf_counter() - start_time
+        Logger.log('d', "Klipper settings registered in definition '%s'", container.getId())
+
+    def _shareSettingFunctions(self, setting_definition: SettingDefinition) -> None:
+        """Replaces setting functions with identical functions shared by all containers.
+
+        Setting functions only hold the compiled expression and are evaluated against
+        the stack they are given, so one instance can serve every definition container.
+         * setting_definition: SettingDefinition to update, including all children.
+        """
+        ## Restricted: Setting definitions only set property values through deserialize,
+        ## which compiles a new function for every expression in every container.
+        property_values = getattr(setting_definition, "_SettingDefinition__property_values", None)
+        if property_values is not None:
+            for property_name in SettingDefinition.getPropertyNames(DefinitionPropertyType.Function):
+                setting_function = getattr(setting_definition, property_name, None)
+                if not isinstance(setting_function, SettingFunction):
+                    continue
+                shared_function = self._shared_functions.setdefault(str(setting_function), setting_function)
+                if shared_function is not setting_function and property_name in property_values:
+                    property_values[property_name] = shared_function
+                    # Only counted if the definition now returns the shared function
+                    if getattr(setting_definition, property_name, None) is shared_function:
+                        self._released_functions += 1
+                        self._released_bytes += referencedSize(setting_function, shared_function)
+
+        for child in setting_definition.children:
+            self._shareSettingFunctions(child)
+
+    def _registerMachineDefinitions(self) -> None:
+        """Registers Klipper settings in the definitions of all existing machines.
+
+        Catches any machine stacks loaded before the plugin connected to the registry.
+        """
+        start_time = time.perf_counter()
+        for machine in ContainerRegistry.getInstance().findContainerStacks(type = "machine"):
+            self._registerDefinition(machine.getBottom())
+
+        Logger.log('d', "Klipper settings registered in %d of %d definition containers in %.1f ms (startup check %.1f ms)",
+                   len(self._registered_definitions),
+                   len(ContainerRegistry.getInstance().findDefinitionContainersMetadata()),
+                   self._registration_time * 1000, (time.perf_counter() - start_time) * 1000)
+        Logger.log('d', "Klipper settings share %d setting functions; %d duplicates released (%.1f KiB measured)",
+                   len(self._shared_functions), self._released_functions, self._released_bytes / 1024)
+
     def _updateAddedChildren(self, container: DefinitionContainer, setting_definition: SettingDefinition) -> None:
         # Updates definition cache for all setting definition children
         for child in setting_definition.children:
@@ -230,6 +438,18 @@ class KlipperSettingsPlugin(Extension):
 
         return category_icon
 
+    def _compileDefinitions(self, settings_dict: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns setting definitions modified for the current Cura version.
+
+        Only called when the compiled definitions cache is missing or outdated.
+         * settings_dict: Setting definition tree parsed from json.
+        """
+        self._settings_dict = settings_dict
+        if self._cura_version < Version("4.7.0"):
+            self._fixSettingsCompatibility()
+
+        return self._settings_dict
+
     def _fixSettingsCompatibility(self) -> None:
         """Update setting definitions for older Cura version compatibility.
 
@@ -272,31 +492,54 @@ class KlipperSettingsPlugin(Extension):
         Signals when a property changes in global or extruder stacks.
         Restores user settings if the active machine changed with preset override enabled.
         """
+        machine_changed = self._global_container_stack is not None
         if self._global_container_stack: # Disconnect inactive container
             self._global_container_stack.propertyChanged.disconnect(self._onGlobalSettingChanged)
+            self._global_container_stack.containersChanged.disconnect(self._clearValueCache)
             for extruder in self._global_container_stack.extruderList:
                 extruder.propertyChanged.disconnect(self._onExtruderSettingChanged)
+                extruder.containersChanged.disconnect(self._clearValueCache)
 
-            if self._user_settings: # Restore user settings when switching machines
-                try: # Get new machine ID
-                    new_active_machine_id = self._application.getMachineManager().activeMachine.getId()
-                except AttributeError:
-                    Logger.log('w', "Could not get active machine ID.")
-                else: # Switch to previous machine because global container already changed
-                    self._application.getMachineManager().setActiveMachine(self._global_container_stack.getId())
-                    self._restoreUserSettings(announce = False)
-                    # Sets the new active machine
-                    self._application.getMachineManager().setActiveMachine(new_active_machine_id)
+            if self._user_settings or self._override_layer.isActive(): # Restore user settings when switching machines
+                # Previous machine stacks are restored directly because the active machine already changed
+                self._restoreUserSettings(announce = False, machine = self._global_container_stack)
 
             self._current_preset = None
-            self._setTuningTowerPreset() # Set tuning tower status
 
         self._global_container_stack = self._application.getMachineManager().activeMachine
+        if self._global_container_stack: # Settings must exist before signals are connected
+            self._registerDefinition(self._global_container_stack.getBottom())
+        self._loadBackups() # Backups of the active machine
+
+        self._clearValueCache() # Values of the previous machine
+        if machine_changed: # Tuning tower status uses presets of the new machine
+            self._setTuningTowerPreset()
 
         if self._global_container_stack: # Connect active container stack
             self._global_container_stack.propertyChanged.connect(self._onGlobalSettingChanged)
+            self._global_container_stack.containersChanged.connect(self._clearValueCache)
             for extruder in self._global_container_stack.extruderList:
                 extruder.propertyChanged.connect(self._onExtruderSettingChanged)
+                extruder.containersChanged.connect(self._clearValueCache)
+
+    def _buildSettingDispatchers(self) -> None:
+        """Creates tables of Klipper setting keys handled when their values change.
+
+        Stack signals fire for every Cura setting; Unrelated keys are rejected by one dict lookup.
+        """
+        self._global_settings = SettingDispatcher()
+        self._global_settings.addHandler([key for key in self._setting_table if key.startswith("klipper_tuning")],
+                                         self._onTuningTowerSettingChanged)
+        self._extruder_settings = SettingDispatcher()
+        self._extruder_settings.addHandler([key for key in self._setting_table if key.startswith("klipper_retract")],
+                                           self._onRetractionSettingChanged)
+
+        # Klipper settings with a value expression of each setting they reference
+        self._value_dependents = {}
+        for setting_key, metadata in self._setting_table.items():
+            if isinstance(metadata.get("value"), str):
+                for name in set(re.findall(r"[A-Za-z_]\w*", metadata["value"])):
+                    self._value_dependents.setdefault(name, set()).add(setting_key)
 
     def _onGlobalSettingChanged(self, setting: str, property: str) -> None:
         """Setting in the global container stack has changed.
@@ -305,36 +548,49 @@ class KlipperSettingsPlugin(Extension):
          * setting: String of the setting key that changed.
          * property: String of the setting property that changed.
         """
-        if setting.startswith("klipper") and property in ["value", "enabled"]:
-            if setting.startswith("klipper_tuning"):
-                self._setTuningTowerPreset() # Update tuning tower presets
+        if property == "value" and self._value_cache: # Values of the setting and its dependents
+            self._evictCachedValues(setting)
+        if self._batch_changes is not None: # Handled once the batch is applied
+            self._batch_changes.add(setting)
+            return
+        self._global_settings.dispatch(setting, property)
 
     def _onExtruderSettingChanged(self, setting: str, property: str) -> None:
         """Setting in an extruder container stack has changed.
 
         Monitors when certain klipper settings in the active extruder stack have new values.
-        Klipper retraction settings mimic Cura values until user changes are detected.
          * setting: String of the setting key that changed.
          * property: String of the setting property that changed.
         """
-        if setting.startswith("klipper") and property in ["value", "enabled"]:
-            is_user_value = self.settingWizard(setting, "Get hasUserValue")
+        if property == "value" and self._value_cache: # Values of the setting and its dependents
+            self._evictCachedValues(setting)
+        if self._batch_changes is not None: # Handled once the batch is applied
+            self._batch_changes.add(setting)
+            return
+        self._extruder_settings.dispatch(setting, property)
 
-            if setting.startswith("klipper_retract"):
-                if setting == "klipper_retraction_speed" and is_user_value:
-                    retraction_speed = self.settingWizard("klipper_retraction_speed")
+    def _onTuningTowerSettingChanged(self, setting: str) -> None:
+        self._setTuningTowerPreset() # Update tuning tower presets
+
+    def _onRetractionSettingChanged(self, setting: str) -> None:
+        """Klipper retraction settings mimic Cura values until user changes are detected.
+
+         * setting: String of the retraction setting key that changed.
+        """
+        if setting == "klipper_retraction_speed" and self.settingWizard(setting, "Get hasUserValue"):
+            retraction_speed = self.settingWizard("klipper_retraction_speed")
 
-                    for child in ["klipper_retract_speed", "klipper_retract_prime_speed"]:
-                        values_match = (self._firmware_retract.get(setting, None) == self._firmware_retract.get(child, None))
-                        value_changed = self.settingWizard(child, "Get hasUserValue")
-                        # Ensures children tied to cura values follow user changes to parent setting
-                        # TODO: Minor bug if parent value is set to default value again;
-                        # Stop-gap until solution is found for changing the 'value' function of existing settings.
-                        if not value_changed or values_match:
-                            self.settingWizard(child, retraction_speed, "Set")
+            for child in ["klipper_retract_speed", "klipper_retract_prime_speed"]:
+                values_match = (self._firmware_retract.get(setting, None) == self._firmware_retract.get(child, None))
+                value_changed = self.settingWizard(child, "Get hasUserValue")
+                # Ensures children tied to cura values follow user changes to parent setting
+                # TODO: Minor bug if parent value is set to default value again;
+                # Stop-gap until solution is found for changing the 'value' function of existing settings.
+                if not value_changed or values_match:
+                    self.settingWizard(child, retraction_speed, "Set")
 
-                # Saves previously set values to compare changes
-                self._firmware_retract[setting] = self.settingWizard(setting)
+        # Saves previously set values to compare changes
+        self._firmware_retract[setting] = self.settingWizard(setting)
 
 
     def _forceErrorCheck(self, setting_key: str=None) -> None:
@@ -343,21 +599,36 @@ class KlipperSettingsPlugin(Extension):
         Ensures user can't slice if Cura doesn't recognize default value as error.
         May not be necessary for all Cura versions but best to play it safe.
         All tuning tower settings checked if no setting_key specified.
+        Requests are debounced so rapid preset changes start a single error check.
          + setting_key: String for specific setting to check.
         """
-        error_checker = self._application.getMachineErrorChecker()
+        if self._setting_batch is not None: # Checked once the batch is applied
+            self._batch_error_check = True
+            return
 
         if setting_key:
-            error_checker.startErrorCheckPropertyChanged(setting_key, "value")
+            self._error_check_keys.add(setting_key)
         else:
-            for setting in self.__tuning_tower_setting_key.values():
-                error_checker.startErrorCheckPropertyChanged(setting, "value")
+            self._error_check_keys.update(self.__tuning_tower_setting_key.values())
+        self._error_check_timer.start() # Restarts delay of pending check
+
+    def _startErrorCheck(self) -> None:
+        """Starts error checks of the settings requested by _forceErrorCheck.
+
+        Only the requested settings are checked; Cura coalesces the keyed checks into one pass.
+        """
+        setting_keys, self._error_check_keys = self._error_check_keys, set()
+        error_checker = self._application.getMachineErrorChecker()
+        for setting_key in sorted(setting_keys):
+            error_checker.startErrorCheckPropertyChanged(setting_key, "value")
 
 
     def _filterGcode(self, output_device: "OutputDevice") -> None:
         """Inserts command strings for enabled Klipper settings into final gcode.
 
         Cura gcode is post-processed at the time of saving a new sliced file.
+        Settings are applied by KlipperGcodeProcessor, which only reads the stacks;
+        Per-object settings are read from the scene as it changes.
         """
         scene = self._application.getController().getScene()
         global_stack = self._application.getGlobalContainerStack()
@@ -367,393 +638,30 @@ class KlipperSettingsPlugin(Extension):
         if not global_stack or not used_extruder_stacks:
             return
 
-        # Extruders currently affected by klipper settings
-        active_extruder_list = set() # type: Set[int]
-        # Mesh features for pressure advance
-        active_mesh_features = set() # type: Set[str]
-
-        cura_start_gcode = global_stack.getProperty('machine_start_gcode', 'value') # To search for existing commands
-
-        # Gets global state of klipper setting controls (bool)
-        firmware_retract_enabled = global_stack.getProperty('machine_firmware_retract', 'value')
-        pressure_advance_enabled = global_stack.getProperty('klipper_pressure_advance_enable', 'value')
-        velocity_limits_enabled = global_stack.getProperty('klipper_velocity_limits_enable', 'value')
-        input_shaper_enabled = global_stack.getProperty('klipper_input_shaper_enable', 'value')
-        tuning_tower_enabled = global_stack.getProperty('klipper_tuning_tower_enable', 'value')
-        smooth_time_enabled = global_stack.getProperty('klipper_smooth_time_enable', 'value')
-        z_offset_enabled = global_stack.getProperty('klipper_z_offset_control_enable', 'value')
-        # Experimental features
-        experimental_features_enabled = global_stack.getProperty('klipper_experimental_enable', 'value')
-        mesh_calibrate_enabled = global_stack.getProperty('klipper_mesh_calibrate_enable', 'value')
-        ui_temp_support_enabled = global_stack.getProperty('klipper_ui_temp_support_enable', 'value')
-
         gcode_dict = getattr(scene, 'gcode_dict', {})
         if not gcode_dict:
             Logger.log('w', "Scene has no gcode to process")
             return
 
-        gcode_changed = False
-
-        new_gcode_commands = "" # String container for all new commands
-
-        for plate_id in gcode_dict:
-            gcode_list = gcode_dict[plate_id]
-            if len(gcode_list) < 2:
-                Logger.log('w', "Plate %s does not contain any layers", plate_id)
-                continue
-            if ";KLIPPERSETTINGSPROCESSED\n" in gcode_list[0]: # Only process new files
-                Logger.log('d', "Plate %s has already been processed", plate_id)
-                continue
-
-            # Searches start gcode for tool change command
-            # Compatibility for cura versions without getInitialExtruder
-            initial_toolchange = re.search(r"(?m)^T([0-9])+$", gcode_list[1])
-
-            if initial_toolchange: # Set initial extruder number
-                start_extruder_nr = int(initial_toolchange.group(1))
-            else: # Set active extruder number
-                start_extruder_nr = int(self.settingWizard('extruder_nr'))
-
-            start_extruder_stack = extruder_manager.getExtruderStack(start_extruder_nr)
-
-            ## EXPERIMENTAL FEATURES --------------------------------
-            if not experimental_features_enabled:
-                Logger.log('d', "Klipper Experimental Features Disabled")
-            else:
-                ## BED MESH CALIBRATE COMMAND
-                if not mesh_calibrate_enabled:
-                    Logger.log('d', "Klipper Bed Mesh Calibration is Disabled")
-                else:
-                    # Search start gcode for existing command
-                    mesh_calibrate_exists = self.gcodeSearch(cura_start_gcode, 'BED_MESH_CALIBRATE')
-
-                    if mesh_calibrate_exists: # Do not add commands
-                        self.showMessage(
-                            "<i>Calibration command is already active in Cura start gcode.</i>",
-                            "WARNING", "Bed Mesh Calibrate Not Applied", stack_msg = True)
-
-                    else: # Add mesh calibration command sequence to gcode
-                        preheat_bed_temp = global_stack.getProperty("material_bed_temperature_layer_0", 'value')
-                        gcode_list[1] = "M190 S%s %s\n" % (preheat_bed_temp, self.comment) + (
-                                        "G28 %s\n" % self.comment) + (
-                                        "BED_MESH_CALIBRATE %s\n\n" % self.comment) + gcode_list[1]
-                        gcode_changed = True
-
-                        self.showMessage(
-                            "<i>Calibration will heat bed then run before the start gcode sequence.</i>",
-                            "NEUTRAL", "Klipper Bed Mesh Calibration Enabled")
-
-                ## KLIPPER UI SUPPORT
-                if not ui_temp_support_enabled:
-                    Logger.log('d', "Klipper UI Temp Support is Disabled")
-                else:
-                    # Checks if M190 and M109 commands exist in start gcode
-                    new_gcode_commands += self._gcodeUiSupport(gcode_list[1])
-
-            ## FIRMWARE RETRACTION COMMAND --------------------------
-            if not firmware_retract_enabled:
-                Logger.log('d', "Klipper Firmware Retraction is Disabled")
-                extruder_fw_retraction = None
-            else:
-                initial_retraction_settings = {}   # type: Dict[str, float]
-                extruder_fw_retraction = {}  # type: Dict[int, Dict[str, float]]
-
-                if len(used_extruder_stacks) > 1: # Add empty dict for each extruder
-                    for extruder_nr in range(len(used_extruder_stacks)):
-                        extruder_fw_retraction[extruder_nr] = {} # type: Dict[str, float]
-
-                for klipper_cmd, setting in self.__firmware_retraction_setting_key.items():
-                    # Gets initial retraction settings for the print
-                    initial_retraction_settings[klipper_cmd] = start_extruder_stack.getProperty(setting, 'value')
-
-                    if extruder_fw_retraction:
-                        for extruder in used_extruder_stacks:
-                            extruder_nr = int(extruder.getProperty('extruder_nr', 'value'))
-                            # Gets settings for each extruder and updates active extruders
-                            extruder_fw_retraction[extruder_nr].update({klipper_cmd: extruder.getProperty(setting, 'value')})
-                            active_extruder_list.add(extruder_nr) # type: Set[int]
-
-                for extruder_nr, settings in extruder_fw_retraction.items(): # Create gcode command for each extruder
-                    extruder_fw_retraction[extruder_nr] = self._gcodeFirmwareRetraction(settings) + self.comment # type: Dict[int, str]
+        # Per-object settings of printable meshes that are not support
+        gcode_processor = KlipperGcodeProcessor(global_stack, used_extruder_stacks, [], self.comment,
+            active_extruder_stack = extruder_manager.getActiveExtruderStack(),
+            get_extruder_stack = extruder_manager.getExtruderStack,
+            warnings = self._warning_msg, override_on = self._override_on,
+            get_mesh_values = self._mesh_settings.getMeshValues) # Only read if gcode is processed
 
-                try: # Add enabled commands for initial extruder to start gcode
-                    new_gcode_commands += (self._gcodeFirmwareRetraction(initial_retraction_settings) + self.comment + "\n")
-
-                except TypeError:
-                    Logger.log('d', "Klipper initial firmware retraction was not set.")
-
-            ## VELOCITY LIMITS COMMAND ------------------------------
-            if not velocity_limits_enabled:
-                Logger.log('d', "Klipper Velocity Limit Control is Disabled")
-            else:
-                velocity_limits = {} # type: Dict[str, int]
-                # Get all velocity setting values
-                for limit_key, limit_setting in self.__velocity_limit_setting_key.items():
-                    velocity_limits[limit_key] = global_stack.getProperty(limit_setting, 'value')
-                try: # Add enabled commands to gcode
-                    new_gcode_commands += (self._gcodeVelocityLimits(velocity_limits) + self.comment + "\n")
-
-                except TypeError:
-                    Logger.log('d', "Klipper velocity limits were not set.")
-
-            ## INPUT SHAPER COMMAND ---------------------------------
-            if not input_shaper_enabled:
-                Logger.log('d', "Klipper Input Shaper Control is Disabled")
-            else:
-                shaper_settings = {} # type: Dict[str, Any]
-                # Get all input shaper setting values
-                for shaper_key, shaper_setting in self.__input_shaper_setting_key.items():
-                    shaper_settings[shaper_key] = global_stack.getProperty(shaper_setting, 'value')
-                try: # Add enabled commands to gcode
-                    new_gcode_commands += (self._gcodeInputShaper(shaper_settings) + self.comment + "\n")
-
-                except TypeError:
-                    Logger.log('d', "Klipper input shaper settings were not set.")
-
-            ## TUNING TOWER COMMAND ---------------------------------
-            if not tuning_tower_enabled:
-                Logger.log('d', "Klipper Tuning Tower is Disabled")
-            else:
-                tower_settings = OrderedDict() # type: OrderedDict[str, Any]
-                # Get all tuning tower setting values
-                for tower_key, tower_setting in self.__tuning_tower_setting_key.items():
-                    tower_settings[tower_key] = global_stack.getProperty(tower_setting, 'value')
-                try: # Add tuning tower sequence to gcode
-                    gcode_list[1] += (self._gcodeTuningTower(tower_settings) + self.comment + "\n")
-                    gcode_changed = True
-
-                except TypeError:
-                    Logger.log('w', "Klipper tuning tower could not be processed.")
-                    return # Stop on error
-
-            ## Z OFFSET COMMAND -------------------------------------
-            if not z_offset_enabled:
-                Logger.log('d', "Klipper Z Offset Adjustment is Disabled")
-                z_offset_layer_0 = 0
-            else:
-                z_offset_adjust_pattern = "SET_GCODE_OFFSET Z_ADJUST=%g " + self.comment
-                z_offset_set_pattern = "SET_GCODE_OFFSET Z=%g " + self.comment
-
-                z_offset_override = global_stack.getProperty('klipper_z_offset_set_enable', 'value')
-                z_offset_layer_0 = global_stack.getProperty('klipper_z_offset_layer_0', 'value')
-
-                if not z_offset_override:
-                    Logger.log('d', "Klipper total z offset was not changed.")
-                else:
-                    z_offset_total = global_stack.getProperty('klipper_z_offset_set_total', 'value')
-                    # Overrides any existing z offset with new value
-                    # This will compound with any additional first layer z offset adjustment.
-                    gcode_list[1] += z_offset_set_pattern % z_offset_total + "\n" # Applied after start gcode
-                    gcode_changed = True
-                    # Add z offset override warning
-                    self._warning_msg.insert(0, "•  <i>Z Offset Override</i> is set to <b>%s mm</b>" % z_offset_total)
-
-                if not z_offset_layer_0:
-                    Logger.log('d', "Klipper first layer z offset was not changed.")
-                else:
-                    layer_0_height = global_stack.getProperty('layer_height_0', 'value')
-                    # Matches z axis coordinate in gcode lines that haven't been processed
-                    # Z offset only applies if z axis coordinate equals the layer 0 height;
-                    # This is safer and necessary to avoid conflicts with settings such as z hop.
-                    z_axis_regex = re.compile(r"^G[01]\s.*Z(%g)(?!.*%s)" % (layer_0_height, self.comment))
-
-                    self._warning_msg.insert(0, "•  <i>Initial Layer Z Offset</i> will <b>%s</b> nozzle by <b>%s mm</b>" % (
-                        "lower" if z_offset_layer_0 < 0 else "raise", z_offset_layer_0)) # Add to final warning message
+        try:
+            layer_workers = int(self._application.getPreferences().getValue("klipper_settings/layer_workers"))
+        except (TypeError, ValueError):
+            layer_workers = 1
+        gcode_changed = gcode_processor.processGcodeDict(gcode_dict, workers = layer_workers)
 
-            ## PRESSURE ADVANCE COMMAND -----------------------------
-            if not pressure_advance_enabled and not smooth_time_enabled:
-                Logger.log('d', "Klipper Pressure Advance Control is Disabled")
-
-            else:
-                # Extruder Settings
-                apply_factor_per_feature = {}  # type: Dict[int, bool]
-                extruder_factors = {}          # type: Dict[(int,str), float]
-                current_factor = {}            # type: Dict[int, float]
-                # Mesh Object Settings
-                per_mesh_factors = {}          # type: Dict[(str,str), float]
-                non_mesh_features = [*self.__pressure_advance_setting_key][8:] # SUPPORT, SKIRT, etc.
-
-                smooth_time_factor = 0
-                pressure_advance_factor = -1
-
-                for extruder_stack in used_extruder_stacks: # Get settings for all active extruders
-                    extruder_nr = int(extruder_stack.getProperty('extruder_nr', 'value'))
-
-                    if not smooth_time_enabled:
-                        Logger.log('d', "Klipper Pressure Advance Smooth Time is Disabled")
-                    else:
-                        smooth_time_factor = extruder_stack.getProperty('klipper_smooth_time_factor', 'value')
-
-                    if not pressure_advance_enabled:
-                        Logger.log('d', "Klipper Pressure Advance Factor is Disabled")
-                    else:
-                        pressure_advance_factor = extruder_stack.getProperty('klipper_pressure_advance_factor', 'value')
-                        current_factor[extruder_nr] = pressure_advance_factor
-
-                        # Gets feature settings for each extruder
-                        for feature_key, setting_key in self.__pressure_advance_setting_key.items():
-                            extruder_factors[(extruder_nr, feature_key)] = extruder_stack.getProperty(setting_key, 'value')
-                            # Checks for unique feature values
-                            if extruder_factors[(extruder_nr, feature_key)] != pressure_advance_factor:
-                                apply_factor_per_feature[extruder_nr] = True # Flag to process gcode
-
-                    try: # Add initial pressure advance command for all active extruders
-                        new_gcode_commands += self._gcodePressureAdvance(
-                            str(extruder_nr).strip('0'), pressure_advance_factor, smooth_time_factor) + "\n"
-
-                    except TypeError:
-                        Logger.log('w', "Klipper pressure advance values invalid: %s", str(pressure_adv_values))
-                        return
-
-
-                if pressure_advance_enabled:
-                    ## Per Object Settings
-                    # Gets printable mesh objects that are not support
-                    nodes = [node for node in DepthFirstIterator(scene.getRoot())
-                             if node.isSelectable()and not node.callDecoration('isNonThumbnailVisibleMesh')]
-                    if not nodes:
-                        Logger.log('w', "No valid objects in scene to process.")
-                        return
-
-                    for node in nodes:
-                        mesh_name = node.getName() # Filename of mesh with extension
-                        mesh_settings = node.callDecoration('getStack').getTop()
-                        extruder_nr = int(node.callDecoration('getActiveExtruderPosition'))
-
-                        # Get active feature settings for mesh object
-                        for feature_key, setting_key in self.__pressure_advance_setting_key.items():
-                            if mesh_settings.getInstance(setting_key) is not None:
-                                mesh_setting_value = mesh_settings.getInstance(setting_key).value
-                            else:
-                                continue
-
-                            # Save the children!
-                            for feature in (
-                                ["WALL-OUTER", "WALL-INNER", "SKIN", "FILL"] if feature_key == "_FACTORS"
-                                    else ['WALL-OUTER', 'WALL-INNER'] if feature_key == "_WALLS"
-                                    else ['SUPPORT', 'SUPPORT-INTERFACE'] if feature_key == "_SUPPORTS"
-                                    else [feature_key]):
-
-                                    per_mesh_factors[(mesh_name, feature)] = mesh_setting_value
-                                    active_mesh_features.add(feature) # All per-object features
-                                    apply_factor_per_feature[extruder_nr] = True # Flag to process gcode
-
-                # Set gcode loop parameters
-                if any(apply_factor_per_feature.values()):
-                    for extruder_nr in list(apply_factor_per_feature):
-                        active_extruder_list.add(extruder_nr)
-                else:
-                    pressure_advance_enabled = False
-
-
-            ## POST-PROCESS GCODE LOOP ------------------------------
-            # TODO: This should eventually get reworked into a function.
-            if pressure_advance_enabled or (z_offset_layer_0 or extruder_fw_retraction):
-                extruder_nr = start_extruder_nr
-                current_layer_nr = -1
-                current_mesh = None
-                feature_type_error = False
-
-                for layer_nr, layer in enumerate(gcode_list):
-                    lines = layer.split("\n")
-                    lines_changed = False
-                    for line_nr, line in enumerate(lines):
-                        apply_new_factor = False
-
-                        if line.startswith(";LAYER:"):
-                            try:
-                                current_layer_nr = int(line[7:]) # Integer for current gcode layer
-                            except ValueError:
-                                Logger.log('w', "Could not get layer number: %s", line)
-
-                            new_layer = bool(active_mesh_features) # Sanity check for mesh features
-
-                        if z_offset_layer_0 and current_layer_nr == 0:
-                            # Matches new line with z coordinate equal to layer 0 height
-                            z_axis_change = z_axis_regex.fullmatch(line)
-
-                            if z_axis_change:
-                                # Inserts z offset command before matched line, then instructs klipper to
-                                # revert the offset on the next z axis change even if the print is stopped.
-                                lines.insert(line_nr + 1, z_offset_adjust_pattern % -(z_offset_layer_0))
-                                lines[line_nr] = line + self.comment # Append line to prevent infinite match
-                                lines.insert(line_nr, z_offset_adjust_pattern % z_offset_layer_0)
-                                lines_changed = True
-
-                        if len(active_extruder_list) > 1:
-                            # Sets extruder number from tool change commands (T0,T1...)  
-                            if line in ["T" + str(i) for i in active_extruder_list]:
-                                try:
-                                    extruder_nr = int(line[1:]) # Active extruder number
-                                except ValueError:
-                                    Logger.log('w', "Could not get extruder number: %s", line)
-
-                                # Applies retraction values for the current extruder
-                                if extruder_fw_retraction and current_layer_nr >= 0:
-                                    lines.insert(line_nr + 1, extruder_fw_retraction[extruder_nr])
-                                    lines_changed = True
-
-                        if not pressure_advance_enabled:
-                            if extruder_fw_retraction or (current_layer_nr <= 0 and z_offset_layer_0):
-                                continue
-                            else:
-                                break
-
-                        if line.startswith(";MESH:") and line[6:] != "NONMESH":
-                            current_mesh = line[6:] # String for gcode mesh name 
-
-                            if not feature_type_error:
-                                continue
-
-                            apply_new_factor = True # Command will insert before current line
-                            feature_type_error = False
-
-                        if line.startswith(";TYPE:"):
-                            feature_type = line[6:] # String for gcode feature
-
-                            if current_layer_nr <= 0 and feature_type != "SKIRT":
-                                feature_type = "LAYER_0"
-
-                            # Fixes when MESH name is not specified prior to its feature TYPE
-                            # Mostly an issue in older cura versions.
-                            if new_layer and feature_type in active_mesh_features:
-                                feature_type_error = True
-                                continue # Error corrected at next MESH line
-
-                            apply_new_factor = True
-                            line_nr += 1 # Command will insert after current line
-
-                        if apply_new_factor:
-                            # Sets current extruder value if no mesh setting exists
-                            pressure_advance_factor = per_mesh_factors.get((current_mesh, feature_type),
-                                                      extruder_factors[(extruder_nr, feature_type)])
-                            new_layer = False
-
-                            # Sets new factor if different from the active value
-                            if pressure_advance_factor != current_factor.get(extruder_nr, None):
-                                current_factor[extruder_nr] = pressure_advance_factor
-
-                                lines.insert(line_nr, self._gcodePressureAdvance(
-                                    str(extruder_nr).strip('0'), pressure_advance_factor))
-                                lines_changed = True
-
-                    ## Restores gcode layer formatting
-                    if lines_changed:
-                        gcode_list[layer_nr] = "\n".join(lines)
-                        gcode_changed = True
-
-            ## Adds new commands to start of gcode
-            if not new_gcode_commands:
-                Logger.log('d', "Klipper start gcode commands were not added.")
-            else:
-                gcode_list[1] = new_gcode_commands + "\n" + gcode_list[1]
-                gcode_changed = True
+        for message in gcode_processor.messages:
+            self.showMessage(message.text, message.msg_type, message.msg_title, stack_msg = message.stack_msg)
 
         ## Finalize processed gcode
         if gcode_changed:
             self._showWarningMessage(60) # Display any active setting warnings
-            gcode_list[0] += ";KLIPPERSETTINGSPROCESSED\n"
-            gcode_dict[plate_id] = gcode_list
             setattr(scene, 'gcode_dict', gcode_dict)
 
 
@@ -761,185 +669,26 @@ class KlipperSettingsPlugin(Extension):
         """Returns true if command exists in gcode string.
 
         Regex multi-line search for active or inactive gcode command string.
-        Any characters on the line after the search string are ignored.
          * gcode: String containing gcode to search in.
          * command: String for gcode command to find.
          + ignore_comment: True includes commented command as a match.
         """
-        # Command is assumed to be the start of the line, ignoring white space;
-        # Technically treats any preceding character as a comment which is functionally
-        # identical for this purpose because the command would be invalid anyway.
-        result = re.search(r"(?mi)^(?P<comment>.*)(%s)[.]*" % re.escape(command), gcode)
-
-        if result:
-            line_match = result.group().lstrip(" \t")
-            if line_match == command:
-                Logger.log('i', "Active command found in gcode: '%s'", line_match)
-                result = bool(result)
-            elif result.group('comment') and ignore_comment:
-                Logger.log('i', "Inactive command found in gcode: '%s'", line_match)
-                result = line_match # Full line returned
-            else:
-                result = False
-
-        return result
-
-    def _gcodeUiSupport(self, gcode = List[str]) -> str:
-        """Command string of commented print start temps.
-
-        Allows fluidd/mainsail to detect gcode print temps when start gcode uses
-        klipper macros without visible M190 and M109 gcode commands.
-         * gcode: String containing gcode to search in.
-        """
-        bed_temp = self.settingWizard("material_bed_temperature_layer_0", 'value')
-        nozzle_temp = self.settingWizard("material_print_temperature", 'value')
-        nozzle_start_temp = self.settingWizard("material_print_temperature_layer_0", 'value')
-
-        bed_temp_exists = self.gcodeSearch(gcode, "M190", True)
-        nozzle_temp_exists = self.gcodeSearch(gcode, "M109", True)
-
-        gcode_comment = ""
-        if not bed_temp_exists:
-            gcode_comment += ";M190 S%s %s\n" % (bed_temp, self.comment)
-        if not nozzle_temp_exists:
-            nozzle_temp = nozzle_start_temp if nozzle_start_temp > 0 else nozzle_temp
-            gcode_comment += ";M109 S%s %s\n" % (nozzle_temp, self.comment)
-
-        if gcode_comment:
-           gcode_comment = ";Support for Klipper UI\n" + gcode_comment
-
-        return gcode_comment
-
-    def _gcodePressureAdvance(self, extruder_nr: str, pressure_advance: float=-1, smooth_time: float=0) -> str:
-        """Returns enabled pressure advance settings as gcode command string.
-
-        """
-        gcode_command = "SET_PRESSURE_ADVANCE"
-
-        if pressure_advance >= 0:
-            gcode_command += " ADVANCE=%g" % pressure_advance
-
-        if smooth_time > 0:
-            gcode_command += " SMOOTH_TIME=%g" % smooth_time
-        
-        gcode_command += " EXTRUDER=extruder%s %s" % (extruder_nr, self.comment)
-
-        return gcode_command
-
-    def _gcodeVelocityLimits(self, velocity_limits: Dict[str, float]) -> str:
-        """Returns enabled velocity settings as gcode command string.
-
-        """
-        # Remove disabled settings
-        velocity_limits = {key: d for key, d in velocity_limits.items() if (
-            key != "square_corner_velocity" and d > 0) or (
-            key == "square_corner_velocity" and d >= 0)}
-
-        if velocity_limits:
-            gcode_command = "SET_VELOCITY_LIMIT "
-
-            for key, value in velocity_limits.items():
-                gcode_command += "%s=%d " % (key.upper(), value)
-
-                if not self._override_on and (key == "square_corner_velocity" and value == 0):
-                    self._warning_msg.append("•  Square Corner Velocity Limit = <b>0</b>")
-
-            return gcode_command # TypeError msg if no return
-
-    def _gcodeFirmwareRetraction(self, retraction_settings: Dict[str, float]) -> str:
-        """Returns enabled firmware retraction settings as gcode command string.
-
-        """
-        # Remove disabled settings
-        retraction_settings = {key: d for key, d in retraction_settings.items() if (
-            key.endswith("speed") and d > 0) or (key.endswith("length") and d >= 0)}
-
-        if retraction_settings:
-            gcode_command = "SET_RETRACTION "
-
-            for key, value in retraction_settings.items():
-                gcode_command += "%s=%g " % (key.upper(), value) # Create gcode command
-
-            return gcode_command # TypeError msg if no return
-
-    def _gcodeInputShaper(self, shaper_settings: Dict[str, Any]) -> str:
-        """Returns enabled input shaper settings as gcode command string.
-
-        """
-        if shaper_settings['shaper_type_x'] == shaper_settings['shaper_type_y']:
-            shaper_settings['shaper_type'] = shaper_settings.pop('shaper_type_x')
-            del shaper_settings['shaper_type_y'] # Use single command for both axes
-
-        # Remove all disabled settings
-        shaper_settings = {key: v for key, v in shaper_settings.items() if (
-            key.startswith("type", 7) and v != "disabled") or (not key.startswith("type", 7) and v >= 0)}
-
-        value_warnings = len([v for v in shaper_settings.values() if v == 0]) # Number of values set to 0
-
-        if shaper_settings:
-            gcode_command = "SET_INPUT_SHAPER "
-
-            for key, value in shaper_settings.items():
-                value = value.upper() if key.startswith("type", 7) else value
-                gcode_command += "%s=%s " % (key.upper(), value) # Create gcode command
-
-            if not self._override_on and value_warnings:
-                self._warning_msg.append("•  <b>%d</b> Input Shaper setting(s) = <b>0</b>" % value_warnings)
-
-            return gcode_command # TypeError msg if no return
-
-    def _gcodeTuningTower(self, tower_settings: Dict[str, Any]) -> str:
-        """Returns enabled tuning tower settings as gcode command string.
-
-        Real-time string input validation done with regex patterns in setting definitions;
-        Accepts only word characters but 'command' also allows spaces, 'single-quotes' and '='.
-        'command' allows multiple words, up to arbitrary limit of 60 approved characters.
-        'parameter' allows single word up to arbitrary limit of 40 word characters.
-        """
-        used_extruder_stacks = self._application.getExtruderManager().getUsedExtruderStacks()
-        gcode_settings = OrderedDict() # Preserve dict order in all Cura versions
-
-        # Remove disabled and optional values
-        for setting, value in tower_settings.items():
-            if not (setting in ['skip', 'band'] and value == 0):
-                gcode_settings[setting] = value
-
-        # Strips any white space, quotes and '=' from ends of 'command' string
-        gcode_settings['command'] = gcode_settings['command'].strip(" \t'=")
-        # Add single quotes if 'command' has multiple words
-        if len(gcode_settings['command'].split()) > 1:
-            gcode_settings['command'] = "'%s'" % gcode_settings['command']
-
-        gcode_command = "TUNING_TOWER "
-        method = gcode_settings.pop('tuning_method')
-
-        for key, value in gcode_settings.items():
-            if method == "factor" and key in ['step_delta', 'step_height']:
-                continue
-            if method == "step" and key in ['factor', 'band']:
-                continue
-
-            gcode_command += "%s=%s " % (key.upper(), value)
-
-        ## Final Tuning Tower Warning Message
-        warning_msg = "<i>Tuning Tower is Active:</i><br/>%s<br/><br/>" % gcode_command
-        if len(used_extruder_stacks) > 1:
-            warning_msg += "<b><i>Tuning Tower</i> with multiple extruders could be unpredictable!</b><br/><br/>"
-        warning_msg += "<i>Tuning tower calibration affects <b>all objects</b> on the build plate.</i>"
-
-        self._warning_msg.append(warning_msg)
-
-        return gcode_command # TypeError stop if no return
+        return gcodeSearch(gcode, command, ignore_comment)
 
     def _setTuningTowerPreset(self) -> None:
         """Monitors and controls changes to tuning tower preset options.
 
-        User settings overridden by a preset are preserved in config file in case Cura closes.
-        Support for up to 3 user presets stored in Cura config sections.
+        Suggested settings of a preset are held in an override layer over user settings.
+        Support for up to 3 user presets stored in the machine settings backup.
         """
         if not self._global_container_stack: # Cura needs to finish loading
             return
 
+        with self.settingTransaction(): # Preset settings are applied together
+            self._updateTuningTowerPreset()
+
+    def _updateTuningTowerPreset(self) -> None:
+        # Preset changes made in the setting transaction of _setTuningTowerPreset
         tuning_tower_enabled = self.settingWizard("klipper_tuning_tower_enable")
 
         if not tuning_tower_enabled:
@@ -1028,21 +777,24 @@ class KlipperSettingsPlugin(Extension):
             setting_label = self.settingWizard(setting, action = "Get label")
             # TODO: Should eventually check every setting for conflicting children.
             if setting == "klipper_pressure_advance_factor":
-                # Ensures all defined sub-settings are saved and cleared
+                # Ensures all defined sub-settings follow the suggested factor
                 for subsetting in self.__pressure_advance_setting_key.values():
-                    self.settingWizard(subsetting, value, "Save&Reset")
+                    self.settingWizard(subsetting, action = "OverrideReset")
 
-            if setting.startswith("klipper_tuning"):
-                 self.settingWizard(setting, value, "Set") # No setting backup
+            # Suggested tuning tower factor is removed with the override
+            if setting.startswith("klipper_tuning") and not (override_enabled and setting.endswith("tower_factor")):
+                 self.settingWizard(setting, value, "Set") # No setting override
 
             else: # Override is enabled
-                self.settingWizard(setting, value, "Save&Set")
-                if setting in self._user_settings: # Add name and value to string of changed settings
+                if self.settingWizard(setting) != value: # Add name and value to string of changed settings
                     if not setting.startswith("klipper"):
                         setting_label = "<b>(Cura)</b> %s" % setting_label # Non-Klipper setting
 
                     settings_changed += "%s = %s<br />" % (setting_label, value)
                     Logger.log('d', "Klipper preset setting override: %s = %s", setting, value)
+                self.settingWizard(setting, value, "Override")
+
+        self._override_layer.add() # Suggested settings replace user values together
 
         ## Klipper Preset Message Box
         if settings_changed or preset_message:
@@ -1068,7 +820,6 @@ class KlipperSettingsPlugin(Extension):
                 user_value = self.settingWizard(setting, "Get hasUserValue")
                 # Applies suggested factor a unless user value already defined
                 if override and setting.endswith("tower_factor"):
-                    self.settingWizard(setting, action = "Save") # Backup value to restore
                     preset_dict[setting] = suggested_factor if not user_value else current_value
 
             return preset_dict
@@ -1131,64 +882,102 @@ class KlipperSettingsPlugin(Extension):
               stack_msg = bool(settings_changed))
 
 
+    def _getMachineId(self) -> Optional[str]:
+        global_stack = self._application.getGlobalContainerStack()
+        return global_stack.getId() if global_stack else None
+
+    def _loadBackups(self) -> None:
+        """Loads user settings backup and custom presets of the active machine.
+
+        """
+        # Checks user settings backup
+        self._user_settings = self._getBackup() # type: Dict[str, Any]
+        # Defines custom preset profiles
+        self._custom_presets = {}
+        for profile_nr in [1, 2, 3]:
+            self._custom_presets.update(self._getBackup("preset%s" % profile_nr))
+
     def _getBackup(self, section: str="") -> Dict[Any, Any]:
-        """Dict of settings stored in Cura user config.
+        """Dict of settings stored in the backup of the active machine.
 
-        Uses existing config parser to get preference data from [klipper_settings] sections.
         The user settings backup is only needed if Cura closes with override enabled.
         Preset section 'preset<int>' returns user preset values or defaults if none exist.
-         * section: Str for [klipper_settings_<str>] config section
+         * section: Str for 'preset<int>' backup section; User settings if empty.
         """
-        ## Restricted: Uses Cura config parser for simplicity.
-        config_parser = self._application.getPreferences()._parser
+        machine_id = self._getMachineId()
+        if not machine_id:
+            return {}
 
-        config_key = "klipper_settings" + ("_%s" % section.lstrip("_") if section else "")
-        config_settings = {} # type: Dict[str, Any]
-        preset_settings = {} # type: Dict[str, Any]
-
-        try: # Get preset section key
-            preset_key = int(section[-1])
-        except IndexError:
-            preset_key = None
+        section = section.lstrip("_") or "user"
+        config_settings = self._backup_store.getBackup(machine_id, section) # type: Dict[str, Any]
 
-        try: # Get any settings in config section
-            config_settings.update(config_parser.items(config_key))
-        except configparser.NoSectionError:
-            Logger.log('d', "[%s] not found in Cura config", config_key)
-        except:
-            Logger.logException('e', "Could not load Cura config file.")
-
-        if not preset_key:
+        if not section.startswith("preset"):
             return config_settings
 
         if not config_settings: # Get default preset settings
             config_settings = self.getPresetDefinition("default")
 
-        for setting, value in config_settings.items():
-            try: value = float(value) if value != None else "" # Convert number values back into float
-            except ValueError: pass
+        preset_key = int(section[-1])
+        return {(preset_key, setting): value for setting, value in config_settings.items()} # type: Dict[(int, str), Any]
 
-            preset_settings[preset_key, setting] = value
+    def _importConfigBackup(self) -> None:
+        """Moves settings backup and presets from Cura config sections to the active machine backup.
 
-        return preset_settings # type: Dict[(int, str), Any]
+        Previous versions stored backups in [klipper_settings] and [klipper_settings_preset<int>].
+        """
+        machine_id = self._getMachineId()
+        if not machine_id:
+            return
+
+        preferences = self._application.getPreferences()
+        ## Restricted: Uses Cura config parser to find sections written by previous versions.
+        config_parser = preferences._parser
+
+        for section in ["", "preset1", "preset2", "preset3"]:
+            config_key = "klipper_settings" + ("_%s" % section if section else "")
+            try:
+                config_settings = config_parser.items(config_key)
+            except configparser.NoSectionError:
+                continue
+            except:
+                Logger.logException('e', "Could not load Cura config file.")
+                return
 
-    def _restoreUserSettings(self, reset_override: bool=True, announce: bool=True) -> None:
+            for setting, value in config_settings:
+                if section: # Preset values were saved as strings
+                    try: value = float(value) if value != None else "" # Convert number values back into float
+                    except ValueError: pass
+                self._backup_store.setValue(machine_id, section or "user", setting, value)
+
+                config_setting = "%s/%s" % (config_key, setting)
+                preferences.addPreference(config_setting, None)
+                preferences.removePreference(config_setting)
+
+            Logger.log('d', "[%s] moved from Cura config to settings backup", config_key)
+
+    def _restoreUserSettings(self, reset_override: bool=True, announce: bool=True,
+                             machine: Optional[ContainerStack]=None) -> None:
         """Restore non tuning tower settings changed by preset.
 
-        All user settings are restored from backup in real time.
+        Removes the suggested settings override and restores any settings backup in real time.
          + announce: False disables status message when complete.
          + reset_override: True ensures suggested settings option is disabled.
+         + machine: Global stack of an inactive machine to restore instead of the active machine.
         """
-        if reset_override: # Disables suggested settings option if enabled
-            self.settingWizard("klipper_tuning_tower_override", action = 'Reset')
+        override_removed = self._override_layer.remove() # User values were never changed
+
+        with self.settingTransaction(): # User settings are restored together
+            if reset_override: # Disables suggested settings option if enabled
+                self.settingWizard("klipper_tuning_tower_override", action = 'Reset', machine = machine)
+
+            # Settings saved in the machine backup
+            for setting, value in self._user_settings.items():
+                self.settingWizard(setting, value, "Restore", machine = machine)
 
-        if not self._user_settings:
+        if not self._user_settings and not override_removed:
             if self._override_on:
                 Logger.log('d', "No saved user settings to restore.")
         else:
-            for setting, value in self._user_settings.items():
-                self.settingWizard(setting, value, "Restore")
-
             self._user_settings.clear()
             Logger.log('d', "All user settings have been restored.")
 
@@ -1200,26 +989,34 @@ class KlipperSettingsPlugin(Extension):
             self._override_on = False
 
 
-    def settingWizard(self, setting_key: str, new_value: Any=None, action: str='Get') -> Optional[Any]:
-        """Action manager to control Cura settings and store values to local Cura config.
+    def settingWizard(self, setting_key: str, new_value: Any=None, action: str='Get',
+                      machine: Optional[ContainerStack]=None) -> Optional[Any]:
+        """Action manager to control Cura settings and store values to the machine settings backup.
 
         Returns Cura setting from either global or active extruder stack.
         Clears setting instance if new set value same as default value.
-        User setting changes are stored in Cura config under [klipper_settings].
-        Custom preset values stored in Cura config under [klipper_settings_preset<int>].
+        User setting changes are stored in the machine backup under 'user'.
+        Custom preset values stored in the machine backup under 'preset<int>'.
          * setting_key: String for existing Cura setting.
          + new_value: Any value for setting_key or comparative for 'Save' action.
          + action: String specifying the operation for setting_key;
             Get (default)       : Return value from global or active extruder stack
             Get <str>           : Return any existing setting property (e.g. 'Get label')
-            Save, Set, Save&Set : Save value to config and temp dict [and/or] set new_value
-            SaveCustom          : Save current preset value to config and preset dict
-            Restore             : Restore setting_key value from local config
-            Reset, Save&Reset   : Save value to config and temp dict [and/or] reset to default value
+            Save, Set, Save&Set : Save value to backup and temp dict [and/or] set new_value
+            SaveCustom          : Save current preset value to backup and preset dict
+            Restore             : Restore setting_key value from backup
+            Reset, Save&Reset   : Save value to backup and temp dict [and/or] reset to default value
+            Override            : Set new_value over the user value until the override is removed
+            OverrideReset       : Hide the user value until the override is removed
+         + machine: Global stack of an inactive machine to use instead of the active machine.
         """
         # TODO: Only active extruder is currently supported.
-        extruder_stack = self._application.getExtruderManager().getActiveExtruderStack()
-        global_stack = self._application.getGlobalContainerStack()
+        if machine is None:
+            extruder_stack = self._application.getExtruderManager().getActiveExtruderStack()
+            global_stack = self._application.getGlobalContainerStack()
+        else: # First extruder of an inactive machine
+            extruder_stack = machine.extruderList[0] if machine.extruderList else None
+            global_stack = machine
 
         if not global_stack or not extruder_stack:
             return
@@ -1228,15 +1025,26 @@ class KlipperSettingsPlugin(Extension):
             custom_key = setting_key
             setting_key = setting_key[1]
 
-        if action.startswith(("Save", "Restore")): # Set and check config key
-            preferences = self._application.getPreferences()
-            config_setting = "klipper_settings/%s" % setting_key
+        if action.startswith(("Save", "Restore")): # Backup of the active machine
+            machine_id = global_stack.getId()
 
-        extruder_setting = True if setting_key.startswith("extruder") else (
-                           global_stack.getProperty(setting_key,'settable_per_extruder'))
+        if setting_key.startswith("extruder"):
+            extruder_setting = True
+        elif setting_key in self._setting_table: # Klipper settings are known without a stack lookup
+            extruder_setting = self._setting_table[setting_key].get('settable_per_extruder')
+        else:
+            extruder_setting = global_stack.getProperty(setting_key,'settable_per_extruder')
 
         for stack in [extruder_stack] if extruder_setting else [global_stack]:
-            current_value = stack.getProperty(setting_key, 'value')
+            if machine is None: # Active stack values are cached until a setting changes
+                current_value = self._getCachedValue(stack, setting_key)
+            else:
+                current_value = stack.getProperty(setting_key, 'value')
+            queued_value = None # type: Optional[Tuple[Any, bool]]
+            if self._setting_batch is not None: # Value set or reset earlier in the batch
+                queued_value = self._batch_values.get((id(stack), setting_key))
+                if queued_value is not None:
+                    current_value = queued_value[0]
             value_changed = current_value != new_value
 
             if action.startswith("Get"):
@@ -1244,7 +1052,9 @@ class KlipperSettingsPlugin(Extension):
                     property = "".join(action.split()).lower()[3:]
                     try: # Get requested property
                         if property.endswith("uservalue"): # Return true if user value
-                            current_value = stack.hasUserValue(setting_key)
+                            current_value = queued_value[1] if queued_value else stack.hasUserValue(setting_key)
+                        elif property in self._indexed_properties and setting_key in self._setting_table:
+                            current_value = self._setting_table[setting_key].get(property) # Klipper definition
                         else: # Return value of property
                             current_value = stack.getProperty(setting_key, property)
                     except:
@@ -1252,35 +1062,160 @@ class KlipperSettingsPlugin(Extension):
 
                 return current_value
 
+            if action.startswith("Override"): # User value is not changed
+                if action.endswith("Reset"):
+                    self._override_layer.hideUserValue(stack, setting_key)
+                else:
+                    self._override_layer.setValue(stack, setting_key, new_value)
+                continue
+
             if action.startswith("Save"):
-                if action.endswith("Custom"): # Value saved to global dict and preset in user config
-                    config_setting = "klipper_settings_preset%i/%s" % (custom_key[0], custom_key[1])
+                if action.endswith("Custom"): # Value saved to global dict and preset backup
                     self._custom_presets[custom_key] = current_value  # type: Dict[(int, str), Any]
-                    preferences.addPreference(config_setting, None)
-                    preferences.setValue(config_setting, str(current_value))
+                    self._backup_store.setValue(machine_id, "preset%i" % custom_key[0], setting_key, current_value)
 
-                elif value_changed: # New value saved to global dict and user config
+                elif value_changed: # New value saved to global dict and user backup
                     self._user_settings[setting_key] = current_value  # type: Dict[str, Any]
-                    preferences.addPreference(config_setting, None)
-                    preferences.setValue(config_setting, current_value)
+                    self._backup_store.setValue(machine_id, "user", setting_key, current_value)
 
             if action == "Restore":
-                # Clear redundant config backup
-                preferences.removePreference(config_setting) # Logged by cura
+                # Clear redundant backup
+                self._backup_store.removeValue(machine_id, "user", setting_key)
 
                 action += "Set" # Set original user value
                 Logger.log('d', "%s restored to original value.", setting_key)
 
             if action.endswith("Set") and value_changed:
-                stack.setProperty(setting_key, 'value', new_value)
+                if self._setting_batch is not None: # Applied when the transaction ends
+                    self._setting_batch.append((stack, setting_key, "Set", new_value))
+                    self._batch_values[(id(stack), setting_key)] = (new_value, True)
+                else:
+                    stack.setProperty(setting_key, 'value', new_value)
 
                 # Clear setting instance if new value same as default value
-                if new_value == stack.getProperty(setting_key, 'default_value'):
+                if new_value == self._getDefaultValue(stack, setting_key):
                     action += "Reset"
 
             if action.endswith("Reset"): # Removes setting instance
                 # TODO: Settings tied to multiple extruders may not get reset.
-                stack.getTop().removeInstance(setting_key)
+                if self._setting_batch is not None: # Applied when the transaction ends
+                    self._setting_batch.append((stack, setting_key, "Reset", None))
+                    # Reads in the batch see the value the stack has once the reset is applied
+                    self._batch_values[(id(stack), setting_key)] = (self._getResetValue(stack, setting_key), False)
+                else:
+                    stack.getTop().removeInstance(setting_key)
+
+    def _getCachedValue(self, stack: ContainerStack, setting_key: str) -> Any:
+        """Returns setting value of a stack, cached until the value of the setting changes.
+
+        """
+        stack_values = self._value_cache.get(setting_key)
+        if stack_values is None:
+            stack_values = self._value_cache[setting_key] = {}
+        try:
+            return stack_values[stack.getId()]
+        except KeyError:
+            value = stack_values[stack.getId()] = stack.getProperty(setting_key, 'value')
+            return value
+
+    def _evictCachedValues(self, setting_key: str) -> None:
+        """Removes cached values of a setting in every stack and of Klipper settings that depend on it.
+
+        Cura also signals value changes of settings related by Cura definitions.
+        """
+        pending = [setting_key]
+        evicted = set() # type: Set[str]
+        while pending:
+            key = pending.pop()
+            if key not in evicted:
+                evicted.add(key)
+                self._value_cache.pop(key, None)
+                pending.extend(self._value_dependents.get(key, ()))
+
+    def _clearValueCache(self, *args: Any) -> None:
+        # Signal arguments are ignored
+        if self._value_cache:
+            self._value_cache.clear()
+
+    def _getResetValue(self, stack: ContainerStack, setting_key: str) -> Any:
+        """Returns setting value of a stack as if the instance in its top container was removed.
+
+        Read from the containers below the top container, or the next stack, like getProperty
+        after the reset; Value functions are evaluated against the whole stack.
+        """
+        containers = stack.getContainers()
+        if len(containers) < 2: # Only the top container
+            return self._getDefaultValue(stack, setting_key)
+
+        value = stack.getRawProperty(setting_key, 'value', skip_until_container = containers[1].getId())
+        if isinstance(value, SettingFunction):
+            value = value(stack)
+        return value
+
+    def _getDefaultValue(self, stack: ContainerStack, setting_key: str) -> Any:
+        if setting_key in self._setting_table: # Klipper definition
+            return self._setting_table[setting_key].get('default_value')
+        return stack.getProperty(setting_key, 'default_value')
+
+    @contextmanager
+    def settingTransaction(self) -> Iterator[None]:
+        """Queues settings set or reset by settingWizard and applies them together.
+
+        Plugin setting handlers are suppressed while the batch is applied, then changed settings
+        are handled with a single error check and tuning tower preset evaluation.
+        Nested transactions are applied with the outermost transaction.
+        """
+        if self._setting_batch is not None:
+            yield
+            return
+
+        self._setting_batch = []
+        try:
+            yield
+        finally:
+            setting_batch = self._setting_batch
+            self._setting_batch = None
+            self._batch_values = {}
+            self._applySettingBatch(setting_batch)
+
+    def _applySettingBatch(self, setting_batch: List[Tuple[Any, str, str, Any]]) -> None:
+        """Sets and resets queued setting values, then handles every changed setting once.
+
+         * setting_batch: List of stack, setting key, action and value tuples in queued order.
+        """
+        error_check, self._batch_error_check = self._batch_error_check, False
+        if not setting_batch:
+            if error_check:
+                self._forceErrorCheck()
+            return
+
+        self._batch_changes = set()
+        try:
+            for stack, setting_key, action, value in setting_batch:
+                if action == "Set":
+                    stack.setProperty(setting_key, 'value', value)
+                else: # Removes setting instance
+                    stack.getTop().removeInstance(setting_key)
+        finally:
+            changed_settings = self._batch_changes
+            self._batch_changes = None
+
+        Logger.log('d', "Applied %d setting changes in one batch", len(setting_batch))
+
+        for setting in changed_settings: # Retraction values follow their changed settings
+            self._extruder_settings.dispatch(setting, "value")
+
+        # Changed settings are checked by Cura; Default value error check was deferred by the batch
+        if error_check:
+            self._forceErrorCheck()
+
+        preset_changed = any(setting in self._global_settings for setting in changed_settings)
+        if preset_changed and not self._reevaluating_preset: # Presets react to their own changes once
+            self._reevaluating_preset = True
+            try:
+                self._setTuningTowerPreset()
+            finally:
+                self._reevaluating_preset = False
 
 
     def _showWarningMessage(self, msg_time: int=45) -> None:
@@ -1448,52 +1383,8 @@ class KlipperSettingsPlugin(Extension):
 
 
     # Dict order must be preserved
-    __pressure_advance_setting_key = [
-        ("_FACTORS", "klipper_pressure_advance_factor"),  ## [0-3] Parent settings
-        ("_WALLS", "klipper_pressure_advance_wall"),
-        ("_SUPPORTS", "klipper_pressure_advance_support"),
-        ("LAYER_0", "klipper_pressure_advance_layer_0"),
-        ("WALL-OUTER", "klipper_pressure_advance_wall_0"),  ## [4-7] Gcode mesh features
-        ("WALL-INNER", "klipper_pressure_advance_wall_x"),
-        ("SKIN", "klipper_pressure_advance_topbottom"),
-        ("FILL", "klipper_pressure_advance_infill"),
-        ("SUPPORT", "klipper_pressure_advance_support_infill"),  ## [8-11] Gcode non-mesh features
-        ("SUPPORT-INTERFACE", "klipper_pressure_advance_support_interface"),
-        ("PRIME-TOWER", "klipper_pressure_advance_prime_tower"),
-        ("SKIRT", "klipper_pressure_advance_skirt_brim")
-    ]
-    __pressure_advance_setting_key = OrderedDict(__pressure_advance_setting_key) # Older cura compatibility
-
-    __tuning_tower_setting_key = [
-        ("tuning_method", "klipper_tuning_tower_method"),
-        ("command", "klipper_tuning_tower_command"),
-        ("parameter", "klipper_tuning_tower_parameter"),
-        ("start", "klipper_tuning_tower_start"),
-        ("skip", "klipper_tuning_tower_skip"),
-        ("factor", "klipper_tuning_tower_factor"),
-        ("band", "klipper_tuning_tower_band"),
-        ("step_delta", "klipper_tuning_tower_step_delta"),
-        ("step_height", "klipper_tuning_tower_step_height")
-    ]
-    __tuning_tower_setting_key = OrderedDict(__tuning_tower_setting_key)
-
-    __velocity_limit_setting_key = {
-        "velocity": "klipper_velocity_limit",
-        "accel": "klipper_accel_limit",
-        "accel_to_decel": "klipper_accel_to_decel_limit",
-        "square_corner_velocity": "klipper_corner_velocity_limit"
-    }
-    __firmware_retraction_setting_key = {
-        "retract_length": "klipper_retract_length",
-        "unretract_extra_length": "klipper_retract_prime_length",
-        "retract_speed": "klipper_retract_speed",
-        "unretract_speed": "klipper_retract_prime_speed"
-    }
-    __input_shaper_setting_key = {
-        "shaper_freq_x": "klipper_shaper_freq_x",
-        "shaper_freq_y": "klipper_shaper_freq_y",
-        "shaper_type_x": "klipper_shaper_type_x",
-        "shaper_type_y": "klipper_shaper_type_y",
-        "damping_ratio_x": "klipper_damping_ratio_x",
-        "damping_ratio_y": "klipper_damping_ratio_y"
-    }
+    __pressure_advance_setting_key = pressure_advance_setting_key
+    __tuning_tower_setting_key = tuning_tower_setting_key
+    __velocity_limit_setting_key = velocity_limit_setting_key
+    __firmware_retraction_setting_key = firmware_retraction_setting_key
+    __input_shaper_setting_key = input_shaper_setting_key
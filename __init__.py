@@ -1,11 +1,11 @@
 # Copyright (c) 2023 J.Jarrard / JJFX
 # The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
 
-from . import KlipperSettingsPlugin
-
 
 def getMetaData():
     return {}
 
 def register(app):
+    # Imported by Cura only; Gcode can be processed without Cura with 'python -m KlipperSettingsPlugin'
+    from . import KlipperSettingsPlugin
     return {"extension": KlipperSettingsPlugin.KlipperSettingsPlugin()}
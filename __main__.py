@@ -0,0 +1,9 @@
+# Copyright (c) 2023 J.Jarrard / JJFX
+# The KlipperSettingsPlugin is released under the terms of the AGPLv3 or higher.
+
+import sys
+
+from .KlipperHeadless import main # Headless gcode post-processing
+
+if __name__ == "__main__":
+    sys.exit(main())